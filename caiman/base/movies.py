@@ -25,6 +25,8 @@ from builtins import range
 from past.utils import old_div
 import cv2
 import os
+import json
+import struct
 import sys
 import scipy.ndimage
 import scipy
@@ -43,7 +45,7 @@ import pickle as cpk
 from scipy.io import loadmat
 from matplotlib import animation
 import pylab as pl
-from skimage.external.tifffile import imread
+from skimage.external.tifffile import imread, TiffFile
 from tqdm import tqdm
 from . import timeseries
 try:
@@ -1143,10 +1145,18 @@ def load(file_name,fr=30,start_time=0,meta_data=None,subindices=None,shape=None,
 
         if extension == '.tif' or extension == '.tiff':  # load avi file
             if subindices is not None:
+                # read only the requested pages when the frames are the pages of the file
+                try:
+                    reader = TiffPageReader(file_name)
+                    if not reader.is_stack:
+                        reader = imread(file_name)
+                except Exception as e:
+                    print('Could not index ' + file_name + ' (' + str(e) + '), using imread')
+                    reader = imread(file_name)
                 if type(subindices) is list:
-                    input_arr = imread(file_name)[subindices[0], subindices[1], subindices[2]]
+                    input_arr = reader[subindices[0], subindices[1], subindices[2]]
                 else:
-                    input_arr = imread(file_name)[subindices, :, :]
+                    input_arr = reader[subindices, :, :]
             else:
                 input_arr = imread(file_name)
             input_arr = np.squeeze(input_arr)
@@ -1342,6 +1352,264 @@ def load_movie_chain(file_list, fr=30, start_time=0,
     return ts.concatenate(mov, axis=0)
 
 
+#%%
+_TIFF_TYPES = {1: 'B', 2: 'B', 3: 'H', 4: 'I', 6: 'b', 7: 'B', 8: 'h', 9: 'i',
+               11: 'f', 12: 'd', 13: 'I', 16: 'Q', 17: 'q', 18: 'Q'}
+_TIFF_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def tiff_index_name(file_name):
+    """ name of the file where the page index of a tif file is cached """
+    return file_name + '.idx.npz'
+
+
+def _read_ifd(f, bo, big, offset, tags):
+    """ read the requested tags of the image file directory starting at offset
+
+    Returns:
+    --------
+    values: dict
+        tag -> tuple of values (str for ascii tags)
+
+    next_offset: int
+        offset of the next image file directory (0 for the last one)
+    """
+    count_fmt, offset_fmt, value_size = ('Q', 'Q', 8) if big else ('H', 'I', 4)
+    f.seek(offset)
+    n_entries = struct.unpack(bo + count_fmt, f.read(struct.calcsize(count_fmt)))[0]
+    entries = struct.unpack(bo + ('HH' + offset_fmt + '%ds' % value_size) * n_entries + offset_fmt,
+                            f.read(n_entries * (4 + 2 * value_size) + value_size))
+    values = {}
+    for idx in range(0, 4 * n_entries, 4):
+        tag, typ, count, value = entries[idx:idx + 4]
+        if tag not in tags or typ not in _TIFF_TYPES:
+            continue
+        fmt = bo + _TIFF_TYPES[typ] * count
+        size = struct.calcsize(fmt)
+        if size > value_size:
+            f.seek(struct.unpack(bo + offset_fmt, value)[0])
+            value = f.read(size)
+        if typ == 2:
+            values[tag] = value[:count].split(b'\x00')[0].decode('latin-1')
+        else:
+            values[tag] = struct.unpack(fmt, value[:size])
+
+    return values, entries[-1]
+
+
+def index_tiff_pages(file_name):
+    """ walk once through the image file directories of a tif file and index its pages
+
+    Parameters:
+    -----------
+    file_name: str
+        name of the tif file
+
+    Returns:
+    --------
+    index: dict
+        offsets: ndarray of int, offset in bytes of the pixels of each frame
+        shape: tuple, (frames, d1, d2)
+        dtype: str, data type of the pixels, including the byte order of the file
+        raw: bool, whether the pixels of each frame are stored uncompressed and contiguous
+             at its offset (otherwise frames are decoded by tifffile)
+        n_pages: int, number of image file directories in the file
+        is_stack: bool, whether the frames are the first axis of the array returned by imread
+    """
+    tags = (256, 257, 258, 259, 270, 273, 277, 279, 339)
+    with open(file_name, 'rb') as f:
+        header = f.read(16)
+        bo = {b'II': '<', b'MM': '>'}[header[:2]]
+        big = struct.unpack(bo + 'H', header[2:4])[0] == 43
+        offset = struct.unpack(bo + 'Q', header[8:16])[0] if big else struct.unpack(bo + 'I', header[4:8])[0]
+        pages = []
+        while offset:
+            values, offset = _read_ifd(f, bo, big, offset, tags if not pages else tags[:-1])
+            if not pages:
+                first = values
+            pages.append(values)
+
+    d1, d2 = first[257][0], first[256][0]
+    bits = first.get(258, (1,))[0]
+    sample_format = _TIFF_SAMPLE_FORMATS.get(first.get(339, (1,))[0], 'u')
+    dtype = np.dtype(bo + sample_format + str(max(bits // 8, 1)))
+    frame_bytes = d1 * d2 * dtype.itemsize
+    raw = bits % 8 == 0 and first.get(277, (1,))[0] == 1
+    if any(273 not in page or 279 not in page for page in pages):
+        # tiled (or otherwise not stored in strips) pages are decoded by tifffile
+        return _index_tiff_with_tifffile(file_name)
+    offsets = []
+    for page in pages:
+        strip_offsets, strip_bytes = page[273], page[279]
+        raw = raw and (page.get(259, (1,))[0] == 1 and page[257][0] == d1 and page[256][0] == d2 and
+                       sum(strip_bytes) == frame_bytes and
+                       all(o + b == o_next for o, b, o_next in zip(strip_offsets, strip_bytes, strip_offsets[1:])))
+        offsets.append(strip_offsets[0])
+    offsets = np.array(offsets, dtype=np.int64)
+
+    # imagej and tifffile describe the dimensions of the stack in the first page
+    description = first.get(270, '')
+    info = dict(line.split('=', 1) for line in description.splitlines() if '=' in line)
+    is_stack = len(pages) > 1
+    if description.startswith('ImageJ'):
+        T = int(info.get('images', len(pages)))
+        if T > len(pages):
+            # large imagej files only store the directory of the first page
+            offsets = offsets[0] + frame_bytes * np.arange(T, dtype=np.int64)
+        is_stack = T > 1 and sum(int(info.get(dim, 1)) > 1 for dim in ('channels', 'slices', 'frames')) <= 1
+    elif description.startswith('{'):
+        try:
+            is_stack = len(pages) > 1 and len(json.loads(description)['shape']) == 3
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    return {'offsets': offsets, 'shape': (len(offsets), d1, d2), 'dtype': dtype.str,
+            'raw': bool(raw), 'n_pages': len(pages), 'is_stack': bool(is_stack)}
+
+
+def _index_tiff_with_tifffile(file_name):
+    """ index of a tif file whose frames are decoded by tifffile (raw=False), see index_tiff_pages """
+    with TiffFile(file_name) as tf:
+        shape = tuple(tf.series[0].shape)
+        dtype = np.dtype(tf.series[0].dtype)
+        offsets = []
+        for page in tf.pages:
+            if hasattr(page, 'dataoffsets'):
+                data_offsets = page.dataoffsets
+            else:
+                data_offsets = page._byte_counts_offsets[1]
+            offsets.append(data_offsets[0] if len(data_offsets) else 0)
+
+    is_stack = len(shape) == 3
+    if len(shape) == 2:
+        shape = (1,) + shape
+    offsets = np.array(offsets, dtype=np.int64)
+    return {'offsets': offsets, 'shape': (shape[0],) + shape[-2:], 'dtype': dtype.str,
+            'raw': False, 'n_pages': len(offsets), 'is_stack': is_stack}
+
+
+def load_tiff_index(file_name, cache=True):
+    """ index of the pages of a tif file, read from the cache next to the file when it is
+    up to date, built with index_tiff_pages (and cached) otherwise
+
+    Parameters:
+    -----------
+    file_name: str
+        name of the tif file
+
+    cache: bool
+        whether to read and write the cached index
+
+    Returns:
+    --------
+    index: dict
+        see index_tiff_pages
+    """
+    stat = os.stat(file_name)
+    stamp = np.array([stat.st_size, stat.st_mtime])
+    index_name = tiff_index_name(file_name)
+    if cache and os.path.exists(index_name):
+        try:
+            with np.load(index_name) as ld:
+                if np.array_equal(ld['stamp'], stamp):
+                    return {'offsets': ld['offsets'], 'shape': tuple(int(s) for s in ld['shape']),
+                            'dtype': str(ld['dtype']), 'raw': bool(ld['raw']),
+                            'n_pages': int(ld['n_pages']), 'is_stack': bool(ld['is_stack'])}
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+    try:
+        index = index_tiff_pages(file_name)
+    except (KeyError, IndexError, ValueError, struct.error):
+        print('Could not index the pages of ' + file_name + ', using tifffile')
+        index = _index_tiff_with_tifffile(file_name)
+    if cache:
+        tmp_name = index_name[:-4] + '.' + str(os.getpid()) + '.tmp.npz'
+        try:
+            np.savez(tmp_name, stamp=stamp, **index)
+            if os.path.exists(index_name):
+                os.remove(index_name)
+            os.rename(tmp_name, index_name)
+        except (IOError, OSError):
+            print('Could not cache the page index of ' + file_name)
+
+    return index
+
+
+class TiffPageReader(object):
+    """ Lazy reader of multipage tif files
+
+    The offsets of the pages are indexed once (and cached next to the file, see
+    load_tiff_index), then indexing the reader along the first axis only reads the
+    requested frames from disk. It can be indexed like the array of shape
+    (frames, d1, d2) that imread would return, eg reader[1000:2000], reader[::30] or
+    reader[[3, 5, 7], 10:20, :].
+
+    Parameters:
+    -----------
+    file_name: str
+        name of the tif file
+
+    cache: bool
+        whether to cache the page index next to the file
+    """
+
+    def __init__(self, file_name, cache=True):
+        self.file_name = file_name
+        index = load_tiff_index(file_name, cache=cache)
+        self.offsets = index['offsets']
+        self.shape = index['shape']
+        self.dtype = np.dtype(index['dtype']).newbyteorder('=')
+        self.file_dtype = np.dtype(index['dtype'])
+        self.raw = index['raw']
+        self.n_pages = index['n_pages']
+        self.is_stack = index['is_stack']
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        pages = np.arange(self.shape[0])[key[0]]
+        Y = self.read_pages(np.atleast_1d(pages))
+        if np.ndim(pages) == 0:
+            return Y[(0,) + key[1:]]
+        return Y[(slice(None),) + key[1:]]
+
+    def read_pages(self, pages):
+        """ read the frames of the given indices
+
+        Parameters:
+        -----------
+        pages: array of int
+            indices of the frames
+
+        Returns:
+        --------
+        Y: ndarray
+            frames x d1 x d2
+        """
+        pages = np.asarray(pages, dtype=np.int64)
+        if not self.raw:
+            if self.n_pages < self.shape[0]:
+                return np.reshape(imread(self.file_name), self.shape)[pages]
+            return np.reshape(imread(self.file_name, key=[int(p) for p in pages]),
+                              (len(pages),) + self.shape[1:])
+
+        Y = np.empty((len(pages),) + self.shape[1:], dtype=self.dtype)
+        frame_bytes = self.file_dtype.itemsize * self.shape[1] * self.shape[2]
+        with open(self.file_name, 'rb') as f:
+            for idx, page in enumerate(pages):
+                f.seek(self.offsets[page])
+                Y[idx] = np.frombuffer(f.read(frame_bytes), self.file_dtype).reshape(self.shape[1:])
+        return Y
+
+
 def loadmat_sbx(filename):
     """
     this function should be called instead of direct spio.loadmat
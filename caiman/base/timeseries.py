@@ -223,6 +223,7 @@ class timeseries(np.ndarray):
                     
 
         elif extension == '.mmap':
+            from ..mmapping import save_memmap_header
             base_name=name
             
             T = self.shape[0]
@@ -240,6 +241,7 @@ class timeseries(np.ndarray):
             big_mov[:] = np.asarray(Yr, dtype=np.float32)
             big_mov.flush()
             del big_mov
+            save_memmap_header(fname_tot, dims, T, dtype=np.float32, order=order, fr=self.fr)
             return fname_tot
         
             
@@ -28,8 +28,9 @@ import shlex
 import psutil
 import sys
 import os
+import tempfile
 import numpy as np
-from .mmapping import load_memmap
+from .mmapping import load_memmap, save_memmap_header
 from multiprocessing import Pool            
 import multiprocessing
 #%%
@@ -112,6 +113,367 @@ def extract_patch_coordinates(dims, rf, stride, border_pix = 0):
     return map(np.sort, coords_flat), shapes
 
 
+#%%
+def _copy_rows(dst, dst_start, src, src_start, n_rows, tile_bytes=2**26):
+    """ copy n_rows rows of a (pixels x time) memory mapped file to another, by tiles """
+    T = src.shape[-1]
+    itemsize = src.dtype.itemsize
+    side = max(1, int(np.sqrt(tile_bytes // itemsize)))
+    step_pix = max(1, min(n_rows, side))
+    step_frames = max(1, tile_bytes // (step_pix * itemsize))
+    for p0 in range(0, n_rows, step_pix):
+        p1 = min(p0 + step_pix, n_rows)
+        for t0 in range(0, T, step_frames):
+            t1 = min(t0 + step_frames, T)
+            dst[dst_start + p0:dst_start + p1, t0:t1] = src[src_start + p0:src_start + p1, t0:t1]
+
+
+#%%
+def iter_shared_patch_groups(file_name, idx_flat, shared_dir=None, max_shared_bytes=None, tile_bytes=2**26):
+    """
+    Stage the pixels of the patches in shared memory, one group of patches at a time
+
+    Patches are grouped by their extent along the last dimension of the FOV, so that
+    the pixels of each group form a contiguous block of rows of the (pixels x time)
+    memory mapped file. The block is read once and copied to a memory mapped file in
+    shared memory (/dev/shm when available), from which the workers get zero-copy
+    views. Rows shared with the previously staged group are copied from shared memory
+    rather than read again from disk, so pixels in the overlap between patches are
+    read only once. Groups are staged in waves of at most max_shared_bytes bytes and
+    are removed once the caller requests the next wave.
+
+    Parameters:
+    ----------
+    file_name: str
+        memory mapped file (pixels x time) containing the movie
+
+    idx_flat: list of ndarrays
+        flattened (order='F') indices of the pixels of each patch
+
+    shared_dir: str
+        folder where the groups are staged. By default /dev/shm if it exists, the
+        temporary folder otherwise. All the workers must have access to it
+
+    max_shared_bytes: int
+        maximum size of the groups staged at the same time. By default half of the
+        available memory. At least one group is always staged
+
+    tile_bytes: int
+        size of the tiles copied at once when staging
+
+    Yields:
+    ------
+    wave: list of tuples
+        (patch number, name of the staged file, offset) for each patch of the wave.
+        The indices of the patch in the staged file are its indices minus offset
+    """
+    Yr, dims, T = load_memmap(file_name)
+    plane = int(np.prod(dims[:-1]))
+    if shared_dir is None:
+        shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    if max_shared_bytes is None:
+        max_shared_bytes = psutil.virtual_memory().available // 2
+
+    groups = dict()
+    for count, idx_ in enumerate(idx_flat):
+        groups.setdefault((np.min(idx_) // plane, np.max(idx_) // plane), []).append(count)
+
+    prefix = os.path.splitext(os.path.basename(file_name))[0][:40] + '_'
+    prev = None
+    leftover = None
+    wave, wave_files, wave_bytes = [], [], 0
+    try:
+        for z0, z1 in sorted(groups):
+            n_rows = (z1 - z0 + 1) * plane
+            if wave and wave_bytes + n_rows * T * Yr.dtype.itemsize > max_shared_bytes:
+                yield wave
+                # keep the last group, it might overlap with the next one
+                for fname in wave_files[:-1]:
+                    _remove_staged(fname)
+                leftover = wave_files[-1]
+                wave, wave_files, wave_bytes = [], [], 0
+
+            fd, fname = tempfile.mkstemp(suffix='.mmap', prefix=prefix, dir=shared_dir)
+            os.close(fd)
+            wave_files.append(fname)
+            staged = np.memmap(fname, mode='w+', dtype=Yr.dtype, shape=(n_rows, T), order='C')
+            save_memmap_header(fname, tuple(dims[:-1]) + (z1 - z0 + 1,), T, dtype=Yr.dtype, order='C')
+            z_start = z0
+            if prev is not None and prev[1] >= z0:
+                # rows in common with the previous group are already in shared memory
+                z_start = min(prev[1], z1) + 1
+                _copy_rows(staged, 0, prev[2], (z0 - prev[0]) * plane,
+                           (z_start - z0) * plane, tile_bytes)
+            if z_start <= z1:
+                _copy_rows(staged, (z_start - z0) * plane, Yr, z_start * plane,
+                           (z1 - z_start + 1) * plane, tile_bytes)
+            staged.flush()
+            prev = (z0, z1, staged)
+
+            if leftover is not None:
+                _remove_staged(leftover)
+                leftover = None
+
+            wave_bytes += n_rows * T * Yr.dtype.itemsize
+            wave += [(count, fname, z0 * plane) for count in groups[(z0, z1)]]
+
+        if wave:
+            yield wave
+    finally:
+        prev = None
+        for fname in wave_files + ([] if leftover is None else [leftover]):
+            _remove_staged(fname)
+
+
+def _remove_staged(fname):
+    """ remove a file staged in shared memory and its header """
+    for ff in [fname, fname + '.json']:
+        if os.path.exists(ff):
+            os.remove(ff)
+
+
+#%%
+# bytes per pixel and frame used when the footprint of a stage cannot be measured. It
+# corresponds to the constant previously used by CNMF.fit to set n_pixels_per_process
+DEFAULT_BYTES_PER_PIXEL_FRAME = 32.
+
+
+def measure_peak_memory(fun, *args, **kwargs):
+    """ call fun(*args, **kwargs) and measure the peak of the memory it allocates
+
+    The peak is the largest of the peak traced by tracemalloc (python 3 only) and of the
+    increase of the resident memory of the process, sampled by a background thread, which
+    also accounts for the memory allocated by compiled libraries.
+
+    Returns:
+    --------
+    result:
+        output of fun
+
+    peak: int
+        bytes allocated at the peak (0 if nothing could be measured)
+    """
+    import threading
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    process = psutil.Process(os.getpid())
+    rss_start = process.memory_info().rss
+    rss_peak = [rss_start]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(.001):
+            rss_peak[0] = max(rss_peak[0], process.memory_info().rss)
+
+    tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+    try:
+        result = fun(*args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+        traced = tracemalloc.get_traced_memory()[1] if tracing else 0
+        if tracing:
+            tracemalloc.stop()
+
+    rss_peak[0] = max(rss_peak[0], process.memory_info().rss)
+    return result, max(traced, rss_peak[0] - rss_start)
+
+
+def _noise_stage(Y, shape):
+    from .source_extraction.cnmf.pre_processing import get_noise_fft
+    return get_noise_fft(Y)
+
+
+def _spatial_stage(Y, shape, K=10):
+    from .source_extraction.cnmf.spatial import regression_ipyparallel, center_and_scale
+    C = np.maximum(np.random.randn(K, Y.shape[1]), 0)
+    Cn, scale = center_and_scale(C)
+    px = list(range(len(Y)))
+    return regression_ipyparallel([Y, Cn, np.ones(len(Y)), [np.arange(K)] * len(Y), px,
+                                   'lasso_lars', np.diag(C.dot(C.T)), (Cn.dot(Cn.T), scale)])
+
+
+def _dot_stage(Y, shape, K=10):
+    # a block is read while the previous one is multiplied (see mmapping.dot_place_holder)
+    return [np.array(Y, dtype=np.float32).dot(np.ones((Y.shape[1], K), dtype=np.float32))
+            for _ in range(2)]
+
+
+def default_calibration_stages():
+    """ stages measured by calibrate_memory: noise estimation (preprocessing), spatial
+    regression and blockwise dot products (residuals and background) """
+    return {'preprocess': _noise_stage, 'spatial': _spatial_stage, 'dot_product': _dot_stage}
+
+
+def calibrate_memory(Yr, dims, stages=None, sides=(16, 24), n_frames=300):
+    """ measure the memory footprint of the stages of the pipeline on small slices of a movie
+
+    Each stage is run on two square (cubic in 3D) regions of the field of view, with sides
+    given by sides and the first n_frames frames. The difference of the peaks divided by the
+    difference of the sizes gives the memory per pixel and frame, without the fixed
+    overhead of the stage.
+
+    Parameters:
+    ----------
+    Yr: np.ndarray or memory mapped ndarray
+        movie, pixels x time (order='F' for the pixels)
+
+    dims: tuple
+        dimensions of the field of view
+
+    stages: dict
+        functions f(Y, shape) called with the pixels x frames array of a region and its
+        shape. By default default_calibration_stages()
+
+    sides: tuple of two int
+        sides of the regions
+
+    n_frames: int
+        number of frames of the regions
+
+    Returns:
+    --------
+    bytes_per_pixel_frame: dict
+        footprint of each stage, DEFAULT_BYTES_PER_PIXEL_FRAME if it could not be measured
+    """
+    if stages is None:
+        stages = default_calibration_stages()
+
+    T = min(np.shape(Yr)[-1], n_frames)
+    samples = []
+    for side in sides:
+        shape = tuple(min(side, dd) for dd in dims)
+        idx = np.ravel_multi_index(np.indices(shape).reshape(len(dims), -1), dims, order='F')
+        samples.append((shape, np.array(Yr[np.sort(idx), :T])))
+
+    bytes_per_pixel_frame = dict()
+    for name, stage in stages.items():
+        peaks = []
+        try:
+            for shape, Y in samples:
+                peaks.append(measure_peak_memory(stage, Y, shape)[1])
+        except Exception as e:
+            print('Calibration of ' + name + ' failed: ' + str(e))
+            bytes_per_pixel_frame[name] = DEFAULT_BYTES_PER_PIXEL_FRAME
+            continue
+
+        n_pix = [np.prod(shape) for shape, _ in samples]
+        if n_pix[1] > n_pix[0] and peaks[1] > peaks[0]:
+            coef = float(peaks[1] - peaks[0]) / (n_pix[1] - n_pix[0]) / T
+        elif peaks[-1] > 0:
+            coef = float(peaks[-1]) / n_pix[-1] / T
+        else:
+            coef = DEFAULT_BYTES_PER_PIXEL_FRAME
+        # the stage holds at least a copy of its input
+        bytes_per_pixel_frame[name] = max(coef, samples[0][1].dtype.itemsize)
+
+    return bytes_per_pixel_frame
+
+
+def plan_resources(dims, T, bytes_per_pixel_frame=None, max_memory=None, n_processes=None,
+                   rf=None, stride=None, min_rf=4):
+    """ choose the chunk sizes, patch size and number of workers of the pipeline
+
+    The memory used by the workers at the same time should stay below max_memory. Among the
+    plans that fit, the one using most workers and then the largest chunks is chosen.
+
+    Parameters:
+    ----------
+    dims: tuple
+        dimensions of the field of view
+
+    T: int
+        number of frames
+
+    bytes_per_pixel_frame: dict
+        footprint of the stages 'preprocess', 'spatial', 'dot_product' and optionally
+        'patch' (see calibrate_memory). Missing stages use DEFAULT_BYTES_PER_PIXEL_FRAME
+
+    max_memory: float
+        memory ceiling in GB. By default 80% of the available memory
+
+    n_processes: int
+        maximum number of workers. By default the number of cores
+
+    rf: int or tuple
+        half-size of the patches requested, reduced if a patch does not fit in the memory
+        of a worker. None if patches are not used
+
+    stride: int or tuple
+        overlap between the patches, reduced in proportion to rf
+
+    min_rf: int
+        smallest half-size of the patches
+
+    Returns:
+    --------
+    plan: dict
+        n_processes, n_pixels_per_process, block_size, num_blocks_per_run, rf, stride,
+        memory_fact (fraction of the patch processed at once by its workers), max_memory (GB),
+        memory_per_process (GB) and bytes_per_pixel_frame
+    """
+    coefs = dict((name, DEFAULT_BYTES_PER_PIXEL_FRAME)
+                 for name in ['preprocess', 'spatial', 'dot_product'])
+    if bytes_per_pixel_frame is not None:
+        coefs.update(bytes_per_pixel_frame)
+    if max_memory is None:
+        max_memory = .8 * psutil.virtual_memory().available / 2.**30
+    if n_processes is None:
+        n_processes = np.maximum(np.int(psutil.cpu_count()), 1)
+
+    d = np.int(np.prod(dims))
+    budget = max_memory * 2.**30
+    per_pixel = max(coefs['preprocess'], coefs['spatial']) * T
+    if rf is not None:
+        rfs = [rf] * len(dims) if np.isscalar(rf) else list(rf)
+        min_worker = coefs.get('patch', per_pixel / T) * T * np.prod(
+            [min(2 * min(r, min_rf) + 1, dd) for r, dd in zip(rfs, dims)])
+    else:
+        min_worker = per_pixel * min(d, 1000)
+    n_processes = np.int(max(1, min(n_processes, budget // max(min_worker, 1))))
+    per_process = budget / n_processes
+
+    plan = {'n_processes': n_processes, 'max_memory': max_memory,
+            'memory_per_process': per_process / 2.**30,
+            'bytes_per_pixel_frame': coefs, 'rf': rf, 'stride': stride, 'memory_fact': None}
+
+    plan['n_pixels_per_process'] = np.int(max(1, min(per_process // per_pixel,
+                                                     max(d // n_processes, 1))))
+    # two blocks are held at once by each worker
+    plan['block_size'] = np.int(max(1, min(per_process // (2 * coefs['dot_product'] * T), d)))
+    n_blocks = -(-d // plan['block_size'])
+    plan['num_blocks_per_run'] = np.int(max(1, -(-n_blocks // n_processes)))
+
+    if rf is not None:
+        strides = [stride] * len(dims) if np.isscalar(stride) else list(stride)
+        patch_coef = coefs.get('patch', per_pixel / T) * T
+        shrink = 1.
+        while True:
+            rfs_ = [max(min(min_rf, r), np.int(r * shrink)) for r in rfs]
+            n_pix_patch = np.prod([min(2 * r + 1, dd) for r, dd in zip(rfs_, dims)])
+            if patch_coef * n_pix_patch <= per_process or rfs_ == [min(min_rf, r) for r in rfs]:
+                break
+            shrink *= .9
+        if rfs_ != rfs:
+            plan['rf'] = rfs_[0] if np.isscalar(rf) else tuple(rfs_)
+            if stride is not None:
+                strides_ = [np.int(round(s * float(r_) / r)) for s, r, r_ in zip(strides, rfs, rfs_)]
+                plan['stride'] = strides_[0] if np.isscalar(stride) else tuple(strides_)
+        # the patches run CNMF in a single process with n_pixels_per_process = prod(rf) / memory_fact
+        plan['memory_fact'] = max(1., float(np.prod(rfs_)) / plan['n_pixels_per_process'])
+
+    return plan
+
+
 #%%
 def apply_to_patch(mmap_file, shape, dview, rf , stride , function, *args, **kwargs):
     """
@@ -136,6 +498,10 @@ def apply_to_patch(mmap_file, shape, dview, rf , stride , function, *args, **kwa
     dview: ipyparallel view on client
         if None
 
+    shared_memory: bool
+        if True the patches are staged in shared memory, see iter_shared_patch_groups
+        (keyword only, not passed to function)
+
     Returns:
     -------
     results
@@ -145,6 +511,7 @@ def apply_to_patch(mmap_file, shape, dview, rf , stride , function, *args, **kwa
     Exception('Something went wrong')
 
     """
+    shared_memory = kwargs.pop('shared_memory', False)
     (T,d1,d2)=shape
     d=d1*d2
 
@@ -160,7 +527,8 @@ def apply_to_patch(mmap_file, shape, dview, rf , stride , function, *args, **kwa
         stride1=stride
         stride2=stride
 
-    idx_flat,idx_2d=extract_patch_coordinates(d1, d2, rf=(rf1,rf2), stride = (stride1,stride2))
+    idx_flat,idx_2d=extract_patch_coordinates((d1, d2), rf=(rf1,rf2), stride = (stride1,stride2))
+    idx_flat = list(idx_flat)
 
     shape_grid = tuple(np.ceil((d1*1./(rf1*2-stride1),d2*1./(rf2*2-stride2))).astype(np.int))
     if d1 <= rf1*2:
@@ -170,35 +538,45 @@ def apply_to_patch(mmap_file, shape, dview, rf , stride , function, *args, **kwa
 
     print(shape_grid)
 
-    args_in=[]
-
-    for id_f,id_2d in zip(idx_flat[:],idx_2d[:]):
+    if shared_memory:
+        waves = iter_shared_patch_groups(mmap_file.filename, idx_flat)
+    else:
+        waves = [[(count, mmap_file.filename, 0) for count in range(len(idx_flat))]]
 
-        args_in.append((mmap_file.filename, id_f,id_2d, function, args, kwargs))
     print((len(idx_flat)))
-    if dview is not None:
-        try:
-            file_res = dview.map_sync(function_place_holder, args_in)
-            dview.results.clear()
+    file_res = [None] * len(idx_flat)
+    for wave in waves:
+        args_in = [(fname, idx_flat[count] - offset, idx_2d[count], function, args, kwargs)
+                   for count, fname, offset in wave]
+        if dview is not None:
+            try:
+                res = dview.map_sync(function_place_holder, args_in)
+                dview.results.clear()
 
-        except:
-            raise Exception('Something went wrong')
-        finally:
-            print('You may think that it went well but reality is harsh')
-    else:
+            except:
+                raise Exception('Something went wrong')
+            finally:
+                print('You may think that it went well but reality is harsh')
+        else:
+
+            res = list(map(function_place_holder, args_in))
+
+        for (count, _, _), rr in zip(wave, res):
+            file_res[count] = rr
 
-        file_res = list(map(function_place_holder, args_in))
     return file_res, idx_flat, shape_grid
 #%%
 def function_place_holder(args_in):
-    #todo: todocument
+    """ apply function to the patch with indices idx_ of the movie in file_name
+
+    The patch is a view of the memory mapped file, no copy of the data is made
+    """
 
     file_name, idx_,shapes,function, args, kwargs = args_in
-    Yr, _, _ = load_memmap(file_name)
-    Yr = Yr[idx_,:]
-    Yr.filename=file_name
-    d,T=Yr.shape
-    Y=np.reshape(Yr,(shapes[1],shapes[0],T),order='F').transpose([2,0,1])
+    Yr, dims, T = load_memmap(file_name)
+    indices = np.unravel_index([np.min(idx_), np.max(idx_)], dims, order='F')
+    slices = [slice(T)] + [slice(min_dim, max_dim + 1) for min_dim, max_dim in indices]
+    Y = np.reshape(Yr.T, [T] + list(dims), order='F')[tuple(slices)]
     [T,d1,d2]=Y.shape
 
     res_fun = function(Y,*args,**kwargs)
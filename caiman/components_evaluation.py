@@ -9,13 +9,14 @@ from __future__ import print_function
 from builtins import range
 from past.utils import old_div
 import numpy as np
-from .utils.stats import mode_robust, mode_robust_fast
+from .utils.stats import mode_robust, mode_robust_fast, running_quantile
 from scipy.sparse import csc_matrix
 from scipy.stats import norm
 import scipy
 import cv2
 import itertools
 import json as simplejson
+import os
 
 def estimate_noise_mode(traces, robust_std=False, use_mode_fast=False, return_all = False):
     """ estimate the noise in the traces under assumption that signals are sparse and only positive. The last dimension should be time. 
@@ -183,83 +184,445 @@ def find_activity_intervals(C, Npeaks = 5, tB=-3, tA = 10, thres = 0.3):
 
 
 #%%
-def classify_components_ep(Y, A, C, b, f, Athresh = 0.1, Npeaks = 5, tB=-3, tA = 10, thres = 0.3):
-    # todo todocument
+def significant_frames(A, C, Athresh=0.1, Npeaks=5, tB=-3, tA=10, thres=0.3):
+    """ frames around the largest peaks of each component, without the frames around the peaks
+    of the components that overlap with it (unless no frame is left)
 
-    K,T = np.shape(C)
-    A  = csc_matrix(A)
-    AA = (A.T*A).toarray() 
-    nA = np.sqrt(np.array(A.power(2).sum(0)))
-    AA = old_div(AA,np.outer(nA,nA.T))
-    AA -= np.eye(K)
-    
-    LOC  = find_activity_intervals(C, Npeaks = Npeaks, tB=tB, tA = tA, thres = thres)
-    rval = np.zeros(K)
+    Parameters:
+    ----------
+    A: sparse matrix
+        spatial components (d x K)
+
+    C: ndarray
+        temporal components (K x T)
+
+    Athresh: float
+        threshold on the normalized overlap of the spatial components
 
-    significant_samples=[]
+    Npeaks, tB, tA, thres:
+        see find_activity_intervals
+
+    Returns:
+    -------
+    frames: list
+        array of frames for each component, None for the components without peaks
+    """
+    K, T = np.shape(C)
+    A = csc_matrix(A)
+    LOC = find_activity_intervals(C, Npeaks=Npeaks, tB=tB, tA=tA, thres=thres)
+    nA = np.sqrt(np.ravel(A.power(2).sum(0)))
+    AA = (A.T * A).tocoo()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ovlp = (AA.data / (nA[AA.row] * nA[AA.col]) > Athresh) & (AA.row != AA.col)
+    ovlp = csc_matrix((np.ones(ovlp.sum(), dtype=bool), (AA.row[ovlp], AA.col[ovlp])), shape=(K, K))
+
+    frames = []
     for i in range(K):
-        if i % 200 == 0: # Show status periodically
-            print('components evaluated:' + str(i))
-        if LOC[i] is not None:
-            atemp = A[:,i].toarray().flatten()
-            atemp[np.isnan(atemp)] = np.nanmean(atemp)
-            ovlp_cmp = np.where(AA[:,i]>Athresh)[0]
+        if LOC[i] is None:
+            frames.append(None)
+            continue
+        indexes = set(LOC[i])
+        for j in ovlp.indices[ovlp.indptr[i]:ovlp.indptr[i + 1]]:
+            if LOC[j] is not None:
+                indexes = indexes - set(LOC[j])
+        if len(indexes) == 0:
             indexes = set(LOC[i])
-            for cnt,j in enumerate(ovlp_cmp):
-                if LOC[j] is not None:
-                    indexes = indexes - set(LOC[j])
-            
-            if len(indexes) == 0:
-                indexes = set(LOC[i])
-                print('Neuron:' + str(i) + ' includes overlaping spiking neurons')
-                
-            indexes = np.array(list(indexes)).astype(np.int)
-            px = np.where(atemp>0)[0]
-            ysqr = np.array(Y[px,:])
-            ysqr[np.isnan(ysqr)] = np.nanmean(ysqr) 
-            mY = np.mean(ysqr[:,indexes],axis=-1)
-            significant_samples.append(indexes)
-            rval[i] = scipy.stats.pearsonr(mY,atemp[px])[0]
-
-        else:            
-            rval[i] = 0
-            significant_samples.append(0)
+            print('Neuron:' + str(i) + ' includes overlaping spiking neurons')
+        frames.append(np.array(list(indexes)).astype(np.int))
 
+    return frames
+
+
+def _read_submatrix(Y, rows, cols, max_bytes=2**27):
+    """ Y[rows][:, cols] for a (memory mapped) pixels x time matrix, reading blocks along its
+    contiguous dimension to bound the memory used """
+    out = np.empty((len(rows), len(cols)), dtype=np.float64)
+    if np.isfortran(Y):  # frames are contiguous
+        step = max(1, max_bytes // max(1, len(rows) * Y.dtype.itemsize))
+        for start in range(0, len(cols), step):
+            out[:, start:start + step] = Y[np.ix_(rows, cols[start:start + step])]
+    else:
+        step = max(1, max_bytes // max(1, Y.shape[1] * Y.dtype.itemsize))
+        for start in range(0, len(rows), step):
+            out[start:start + step] = np.array(Y[rows[start:start + step]])[:, cols]
+    return out
+
+
+def compute_r_values(Y, A, frames, num_comps_per_chunk=5):
+    """ correlation between each spatial component and the average of the movie over its frames
+    (see significant_frames), computed on the pixels where the component is positive
+
+    The components are processed in chunks. For each chunk only the pixels of its components
+    and the union of their frames are read, and the averages of all the components are
+    obtained with one sparse-dense product.
+
+    Parameters:
+    ----------
+    Y: ndarray or memory mapped ndarray
+        movie (pixels x time)
+
+    A: sparse matrix
+        spatial components (pixels x K)
+
+    frames: list
+        frames of each component, None if the component has no frames
+
+    num_comps_per_chunk: int
+        number of components processed at once. Small chunks read fewer entries of the movie
+        since the union of the frames of many components quickly covers the whole movie
+
+    Returns:
+    -------
+    rval: ndarray
+        r value of each component, 0 for the components without frames
+    """
+    A = csc_matrix(A)
+    K = A.shape[-1]
+    rval = np.zeros(K)
+    valid = np.array([i for i in range(K) if frames[i] is not None], dtype=np.int)
+    for start in range(0, len(valid), num_comps_per_chunk):
+        idx = valid[start:start + num_comps_per_chunk]
+        Ac = A[:, idx].tocoo()
+        pos = Ac.data > 0
+        px_, comp_, a_ = Ac.row[pos], Ac.col[pos], Ac.data[pos].astype(np.float64)
+        px, px_loc = np.unique(px_, return_inverse=True)
+        fr = np.unique(np.concatenate([frames[i] for i in idx]))
+        Ysub = _read_submatrix(Y, px, fr)
+        if np.any(np.isnan(Ysub)):
+            Ysub[np.isnan(Ysub)] = np.nanmean(Ysub)
+        # average of the movie over the frames of each component
+        n_fr = [len(frames[i]) for i in idx]
+        W = csc_matrix((np.concatenate([np.ones(n) / n for n in n_fr]),
+                        (np.searchsorted(fr, np.concatenate([frames[i] for i in idx])),
+                         np.repeat(np.arange(len(idx)), n_fr))), shape=(len(fr), len(idx)))
+        mY = np.asarray(W.T.dot(Ysub.T)).T[px_loc, comp_]
+        # pearson correlation on the support of each component
+        n = np.bincount(comp_, minlength=len(idx)).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mY -= (np.bincount(comp_, mY, minlength=len(idx)) / n)[comp_]
+            a_ -= (np.bincount(comp_, a_, minlength=len(idx)) / n)[comp_]
+            rval[idx] = np.bincount(comp_, mY * a_, minlength=len(idx)) / np.sqrt(
+                np.bincount(comp_, mY ** 2, minlength=len(idx)) *
+                np.bincount(comp_, a_ ** 2, minlength=len(idx)))
+
+    return rval
+
+
+def classify_components_ep(Y, A, C, b, f, Athresh = 0.1, Npeaks = 5, tB=-3, tA = 10, thres = 0.3):
+    # todo todocument
+    frames = significant_frames(A, C, Athresh=Athresh, Npeaks=Npeaks, tB=tB, tA=tA, thres=thres)
+    rval = compute_r_values(Y, A, frames)
+    significant_samples = [0 if fr is None else fr for fr in frames]
     return rval, significant_samples
 #%%
-def evaluate_components_CNN(A, dims, gSig, model_name = 'use_cases/CaImAnpaper/cnn_model', patch_size = 50, loaded_model = None, isGPU = False):
+class NumpyCNN(object):
+    """ numpy implementation of the inference of the sequential keras models used to classify
+    the spatial components (Conv2D, MaxPooling2D, Dense, Dropout, Flatten and Activation layers,
+    channels last)
+
+    The architecture is read from the json file and the weights from the h5 file saved by keras,
+    so that the classifier can run without importing keras and tensorflow.
+    """
+
+    def __init__(self, model_name):
+        import h5py
+        with open(model_name + '.json', 'r') as json_file:
+            config = simplejson.load(json_file)['config']
+        if isinstance(config, dict):  # keras >= 2.2
+            config = config['layers']
+        self.layers = [(layer['class_name'], layer['config']) for layer in config]
+        self.weights = {}
+        with h5py.File(model_name + '.h5', 'r') as f:
+            group = f['model_weights'] if 'model_weights' in f else f
+            for _, cfg in self.layers:
+                name = cfg['name']
+                if name in group:
+                    self.weights[name] = [np.array(group[name][w if isinstance(w, str) else w.decode('utf8')],
+                                                   dtype=np.float32)
+                                          for w in group[name].attrs['weight_names']]
+
+    @staticmethod
+    def _activation(X, activation):
+        if activation == 'relu':
+            return np.maximum(X, 0, out=X)
+        elif activation == 'softmax':
+            X = np.exp(X - X.max(-1, keepdims=True))
+            return X / X.sum(-1, keepdims=True)
+        elif activation == 'sigmoid':
+            return 1. / (1. + np.exp(-X))
+        elif activation == 'linear':
+            return X
+        raise Exception('Activation ' + activation + ' not supported')
+
+    @staticmethod
+    def _conv2d(X, kernel, bias, padding):
+        kh, kw = kernel.shape[:2]
+        if padding == 'same':
+            X = np.pad(X, ((0, 0), ((kh - 1) // 2, kh // 2), ((kw - 1) // 2, kw // 2), (0, 0)),
+                       mode='constant')
+        n, h, w, c = X.shape
+        s = X.strides
+        windows = np.lib.stride_tricks.as_strided(
+            X, (n, h - kh + 1, w - kw + 1, kh, kw, c), (s[0], s[1], s[2], s[1], s[2], s[3]))
+        return np.tensordot(windows, kernel, axes=3) + bias
+
+    @staticmethod
+    def _max_pool(X, pool_size, strides):
+        if tuple(pool_size) != tuple(strides):
+            raise Exception('Only pooling with strides equal to the pool size is supported')
+        n, h, w, c = X.shape
+        ph, pw = pool_size
+        X = X[:, :h // ph * ph, :w // pw * pw]
+        return X.reshape(n, h // ph, ph, w // pw, pw, c).max(axis=(2, 4))
+
+    def _forward(self, X):
+        for class_name, cfg in self.layers:
+            if class_name == 'Conv2D':
+                if tuple(cfg['strides']) != (1, 1) or tuple(cfg['dilation_rate']) != (1, 1):
+                    raise Exception('Only convolutions with unit strides are supported')
+                X = self._conv2d(X, *self.weights[cfg['name']][:2], padding=cfg['padding'])
+                X = self._activation(X, cfg['activation'])
+            elif class_name == 'MaxPooling2D':
+                X = self._max_pool(X, cfg['pool_size'], cfg['strides'] or cfg['pool_size'])
+            elif class_name == 'Dense':
+                X = self._activation(X.dot(self.weights[cfg['name']][0]) + self.weights[cfg['name']][1],
+                                     cfg['activation'])
+            elif class_name == 'Activation':
+                X = self._activation(X, cfg['activation'])
+            elif class_name == 'Flatten':
+                X = X.reshape(X.shape[0], -1)
+            elif class_name != 'Dropout':  # dropout is not applied at inference
+                raise Exception('Layer ' + class_name + ' not supported')
+        return X
+
+    def predict(self, X, batch_size=32, verbose=0):
+        """ output of the network for the inputs X (samples x rows x columns x channels),
+        computed in batches of batch_size samples """
+        X = np.asarray(X, dtype=np.float32)
+        predictions = None
+        for start in range(0, X.shape[0], batch_size):
+            out = self._forward(X[start:start + batch_size])
+            if predictions is None:
+                predictions = np.empty((X.shape[0],) + out.shape[1:], dtype=np.float32)
+            predictions[start:start + batch_size] = out
+            if verbose:
+                print('predicted ' + str(min(start + batch_size, X.shape[0])) + '/' + str(X.shape[0]))
+        return predictions
+
+
+# models already loaded in this process, by name and backend
+_CNN_models = {}
+
+
+def load_CNN_model(model_name='use_cases/CaImAnpaper/cnn_model', use_keras=None):
+    """ load (once per process) the classifier stored in model_name.json and model_name.h5
+
+    Parameters:
+    ----------
+    model_name: str
+        path of the model without extension
+
+    use_keras: bool or None
+        whether to run the model with keras. If None keras is used when it can be imported,
+        otherwise the numpy implementation (NumpyCNN)
+
+    Returns:
+    -------
+    model: keras model or NumpyCNN
+    """
+    if use_keras is None:
+        try:
+            import keras
+            use_keras = True
+        except ImportError:
+            print('PROBLEM LOADING KERAS: using the numpy implementation of the classifier')
+            use_keras = False
+
+    key = (os.path.abspath(model_name), use_keras)
+    if key not in _CNN_models:
+        if use_keras:
+            from keras.models import model_from_json
+            with open(model_name + '.json', 'r') as json_file:
+                model = model_from_json(json_file.read())
+            model.load_weights(model_name + '.h5')
+        else:
+            model = NumpyCNN(model_name)
+        print("Loaded model from disk")
+        _CNN_models[key] = model
+
+    return _CNN_models[key]
+
+
+def extract_crops(A, dims, half_crop, patch_size=50):
+    """ crops of the spatial components around their center of mass, normalized and resized
+    to patch_size x patch_size
+
+    The centers of mass are obtained with one sparse product and each crop is filled directly
+    from the nonzero entries of the component.
+
+    Parameters:
+    ----------
+    A: sparse matrix
+        spatial components (pixels x K, pixels in order 'F')
+
+    dims: tuple
+        dimensions of the field of view
+
+    half_crop: tuple
+        half size of the crops along each dimension
+
+    patch_size: int
+        size of the resized crops
+
+    Returns:
+    -------
+    final_crops: ndarray
+        K x patch_size x patch_size
+    """
+    A = csc_matrix(A)
+    A.sum_duplicates()
+    dims = np.array(dims[:2])
+    half_crop = np.minimum(np.array(half_crop, dtype=np.int), dims // 2)
+    K = A.shape[-1]
+    rows, cols = np.unravel_index(np.arange(A.shape[0]), dims, order='F')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coms = A.T.dot(np.stack([rows, cols], axis=1).astype(np.float64)) / np.ravel(A.sum(0))[:, None]
+    coms = np.maximum(coms, half_crop)
+    coms = np.minimum(coms, dims - half_crop).astype(np.int)
+    corner = coms - half_crop
+
+    comp = np.repeat(np.arange(K), np.diff(A.indptr))
+    r = rows[A.indices] - corner[comp, 0]
+    c = cols[A.indices] - corner[comp, 1]
+    inside = (r >= 0) & (r < 2 * half_crop[0]) & (c >= 0) & (c < 2 * half_crop[1])
+    comp, r, c, data = comp[inside], r[inside], c[inside], A.data[inside]
+    norms = np.sqrt(np.bincount(comp, data ** 2, minlength=K))
+    crops = np.zeros((2 * half_crop[0], 2 * half_crop[1], K))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crops[r, c, comp] = data / norms[comp]
+        crops[:, :, norms == 0] = np.nan
+
+    # the crops are resized as channels of a single image, cv2 handles at most 512 channels
+    final_crops = np.empty((K, patch_size, patch_size))
+    for start in range(0, K, 512):
+        resized = cv2.resize(np.ascontiguousarray(crops[:, :, start:start + 512]), (patch_size, patch_size))
+        final_crops[start:start + 512] = np.reshape(resized, (patch_size, patch_size, -1)).transpose(2, 0, 1)
+
+    return final_crops
+
+
+def evaluate_components_CNN(A, dims, gSig, model_name = 'use_cases/CaImAnpaper/cnn_model', patch_size = 50,
+                            loaded_model = None, isGPU = False, batch_size = 32, use_keras = None):
     """ evaluate component quality using a CNN network
-    
+
+    Parameters:
+    ----------
+    A: sparse matrix
+        spatial components
+
+    dims: tuple
+        dimensions of the field of view
+
+    gSig: list
+        half size of the neurons
+
+    model_name: str
+        path of the model without extension (see load_CNN_model)
+
+    patch_size: int
+        size of the inputs of the network
+
+    loaded_model: model
+        model to use instead of the one stored in model_name
+
+    isGPU: bool
+        whether keras can use the GPU
+
+    batch_size: int
+        number of components classified at once
+
+    use_keras: bool or None
+        see load_CNN_model
+
+    Returns:
+    -------
+    predictions: ndarray
+        probability of each class for each component
+
+    final_crops: ndarray
+        inputs of the network
     """
     if not isGPU:
-        import os
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-    
-    try:
-    	from keras.models import model_from_json
-    except:
-    	print('PROBLEM LOADING KERAS: cannot use classifier')
 
     if loaded_model is None:
-        json_file = open(model_name +'.json', 'r')
-        loaded_model_json = json_file.read()
-        json_file.close()
-        loaded_model = model_from_json(loaded_model_json)
-        loaded_model.load_weights(model_name +'.h5')
-        print("Loaded model from disk")
+        loaded_model = load_CNN_model(model_name, use_keras=use_keras)
+
     half_crop = np.minimum(gSig[0]*4+1, patch_size), np.minimum(gSig[1]*4+1, patch_size)
-    dims = np.array(dims)
-    coms = [scipy.ndimage.center_of_mass(mm.toarray().reshape(dims, order='F')) for mm in A.tocsc().T]  
-    coms = np.maximum(coms, half_crop)
-    coms = np.array([np.minimum(cms, dims-half_crop) for cms in coms]).astype(np.int)
-    crop_imgs = [mm.toarray().reshape(dims, order='F')[com[0]-half_crop[0]:com[0]+half_crop[0], com[1]-half_crop[1]:com[1]+half_crop[1]] for mm,com in zip(A.tocsc().T,coms) ]
-    final_crops = np.array([cv2.resize(im/np.linalg.norm(im),(patch_size ,patch_size )) for im in crop_imgs])
-    predictions = loaded_model.predict(final_crops[:,:,:,np.newaxis], batch_size=32, verbose=1)
+    final_crops = extract_crops(A, dims, half_crop, patch_size=patch_size)
+    predictions = loaded_model.predict(final_crops[:,:,:,np.newaxis], batch_size=batch_size, verbose=1)
 
     return predictions,final_crops
+#%%
+def activity_window(final_frate):
+    """ frames before (tB) and after (tA) each peak used to evaluate the spatial components """
+    tB = np.minimum(-2, np.floor( -5. / 30 * final_frate))
+    tA = np.maximum(5, np.ceil(25. / 30 * final_frate))
+    print('tB:'+str(tB)+',tA:'+str(tA))
+    return tB, tA
+
+
+def evaluate_fitness(traces, remove_baseline = True, N = 5, robust_std = False, sigma_factor = 3.,
+                     slow_baseline = False, n_threads = None):
+    """ probability of the exceptional events of the traces and of their derivative
+    (see evaluate_components). n_threads is the number of threads of the running quantile
+    of the exact baseline (see utils.stats.running_quantile)
+
+    Returns:
+    -------
+    fitness_raw, fitness_delta, erfc_raw, erfc_delta: ndarray
+        see evaluate_components
+    """
+    T = np.shape(traces)[-1]
+    print('Computing event exceptionality delta')
+    fitness_delta, erfc_delta,std_rr, _ = compute_event_exceptionality(np.diff(traces,axis=1),robust_std=robust_std,N=N,sigma_factor = sigma_factor)
+
+    print('Removing Baseline')
+    if remove_baseline:
+        num_samps_bl=np.minimum(old_div(np.shape(traces)[-1],5),800)
+        if slow_baseline:
+            
+            traces = traces - running_quantile(traces, 8, num_samps_bl, n_threads=n_threads)
+
+        else: # fast baseline removal
+            
+            downsampfact = num_samps_bl
+            elm_missing=int(np.ceil(T*1.0/downsampfact)*downsampfact-T)
+            padbefore=int(np.floor(old_div(elm_missing,2.0)))
+            padafter=int(np.ceil(old_div(elm_missing,2.0)))    
+            tr_tmp = np.pad(traces.T,((padbefore,padafter),(0,0)),mode='reflect')
+            numFramesNew,num_traces = np.shape(tr_tmp)    
+            #% compute baseline quickly
+            print("binning data ..."); 
+            tr_BL=np.reshape(tr_tmp,(downsampfact,int(old_div(numFramesNew,downsampfact)),num_traces),order='F');
+            tr_BL=np.percentile(tr_BL,8,axis=0)            
+            print("interpolating data ..."); 
+            print(tr_BL.shape)    
+            tr_BL=scipy.ndimage.zoom(np.array(tr_BL,dtype=np.float32),[downsampfact ,1],order=3, mode='constant', cval=0.0, prefilter=True)
+            if padafter==0:
+                traces -= tr_BL.T
+            else:
+                traces -= tr_BL[padbefore:-padafter].T
+            
+    print('Computing event exceptionality')    
+    fitness_raw, erfc_raw,std_rr, _ = compute_event_exceptionality(traces,robust_std=robust_std,N=N, sigma_factor = sigma_factor)
+
+    return fitness_raw, fitness_delta, erfc_raw, erfc_delta
+
+
 #%%
 def evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline = True, N = 5, robust_std = False,
-                        Athresh = 0.1, Npeaks = 5, thresh_C = 0.3,  sigma_factor = 3.):
+                        Athresh = 0.1, Npeaks = 5, thresh_C = 0.3,  sigma_factor = 3., slow_baseline = False):
     """ Define a metric and order components according to the probability of some "exceptional events" (like a spike).
     
     Such probability is defined as the likeihood of observing the actual trace value over N samples given an estimated noise distribution. 
@@ -286,6 +649,10 @@ def evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline = Tr
     remove_baseline: bool
         whether to remove the baseline in a rolling fashion *(8 percentile)
 
+    slow_baseline: bool
+        whether the baseline is the exact running 8th percentile (utils.stats.running_quantile)
+        instead of the percentile of bins of frames interpolated with splines
+
     N: int
         N number of consecutive events probability multiplied
 
@@ -326,46 +693,14 @@ def evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline = Tr
         indexes of samples used to obtain the spatial mask by average
 
     """
-    tB = np.minimum(-2, np.floor( -5. / 30 * final_frate))
-    tA = np.maximum(5, np.ceil(25. / 30 * final_frate))
-    print('tB:'+str(tB)+',tA:'+str(tA))
+    tB, tA = activity_window(final_frate)
     dims,T=np.shape(Y)[:-1],np.shape(Y)[-1]
     
     Yr=np.reshape(Y,(np.prod(dims),T),order='F')    
 
-    print('Computing event exceptionality delta')
-    fitness_delta, erfc_delta,std_rr, _ = compute_event_exceptionality(np.diff(traces,axis=1),robust_std=robust_std,N=N,sigma_factor = sigma_factor)
-
-    print('Removing Baseline')
-    if remove_baseline:
-        num_samps_bl=np.minimum(old_div(np.shape(traces)[-1],5),800)
-        slow_baseline = False
-        if slow_baseline:
-            
-            traces = traces - scipy.ndimage.percentile_filter(traces,8,size=[1,num_samps_bl])
-
-        else: # fast baseline removal
-            
-            downsampfact = num_samps_bl
-            elm_missing=int(np.ceil(T*1.0/downsampfact)*downsampfact-T)
-            padbefore=int(np.floor(old_div(elm_missing,2.0)))
-            padafter=int(np.ceil(old_div(elm_missing,2.0)))    
-            tr_tmp = np.pad(traces.T,((padbefore,padafter),(0,0)),mode='reflect')
-            numFramesNew,num_traces = np.shape(tr_tmp)    
-            #% compute baseline quickly
-            print("binning data ..."); 
-            tr_BL=np.reshape(tr_tmp,(downsampfact,int(old_div(numFramesNew,downsampfact)),num_traces),order='F');
-            tr_BL=np.percentile(tr_BL,8,axis=0)            
-            print("interpolating data ..."); 
-            print(tr_BL.shape)    
-            tr_BL=scipy.ndimage.zoom(np.array(tr_BL,dtype=np.float32),[downsampfact ,1],order=3, mode='constant', cval=0.0, prefilter=True)
-            if padafter==0:
-                traces -= tr_BL.T
-            else:
-                traces -= tr_BL[padbefore:-padafter].T
-            
-    print('Computing event exceptionality')    
-    fitness_raw, erfc_raw,std_rr, _ = compute_event_exceptionality(traces,robust_std=robust_std,N=N, sigma_factor = sigma_factor)
+    fitness_raw, fitness_delta, erfc_raw, erfc_delta = evaluate_fitness(
+        traces, remove_baseline=remove_baseline, N=N, robust_std=robust_std, sigma_factor=sigma_factor,
+        slow_baseline=slow_baseline)
 
     print('Evaluating spatial footprint')
     # compute the overlap between spatial and movie average across samples with significant events
@@ -390,20 +725,32 @@ def grouper(n, iterable, fillvalue=None):
         return itertools.izip_longest(*args, fillvalue=fillvalue)
 
 #%%
-def evaluate_components_placeholder(params):
+def evaluate_components_chunk(params):
+    """ quality of a chunk of components (function run in parallel by estimate_components_quality)
+
+    Parameters:
+    ----------
+    params: list
+        fname: str, name of the memory mapped file of the movie
+        idx: ndarray, indices of the components of the chunk
+        traces: ndarray, fluorescence traces of the chunk
+        A: sparse matrix, spatial components of the chunk
+        frames: list, significant frames of each component of the chunk
+        remove_baseline, N, robust_std, slow_baseline: see evaluate_components
+
+    Returns:
+    -------
+    idx, fitness_raw, fitness_delta, r_values
+    """
     import caiman as cm
-    import numpy as np
-    fname, traces, A, C, b, f, final_frate, remove_baseline, N, robust_std, Athresh, Npeaks, thresh_C = params
+    fname, idx, traces, A, frames, remove_baseline, N, robust_std, slow_baseline = params
     Yr, dims, T = cm.load_memmap(fname)
-    #d1, d2 = dims
-    #images = np.reshape(Yr.T, [T] + list(dims), order='F')
-    Y = np.reshape(Yr, dims + (T,), order='F')
-    fitness_raw, fitness_delta, erfc_raw, erfc_delta, r_values, significant_samples = \
-        evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline=remove_baseline,
-                                          N=N, robust_std=robust_std, Athresh=Athresh, Npeaks=Npeaks,  thresh_C=thresh_C)
-        
-    return fitness_raw, fitness_delta, [], [], r_values, significant_samples 
-        
+    fitness_raw, fitness_delta, _, _ = evaluate_fitness(
+        traces, remove_baseline=remove_baseline, N=N, robust_std=robust_std, slow_baseline=slow_baseline,
+        n_threads=1)
+    r_values = compute_r_values(Yr, A, frames)
+    return idx, fitness_raw, fitness_delta, r_values
+
 #%%
 def estimate_components_quality_auto(Y, A, C, b, f, YrA, frate, decay_time, gSig, dims, dview = None, min_SNR=2, r_values_min = 0.9, 
                                      r_values_lowest = -1, Npeaks = 10, use_cnn = True, thresh_cnn_min = 0.95, thresh_cnn_lowest = 0.1,
@@ -511,7 +858,8 @@ def estimate_components_quality_auto(Y, A, C, b, f, YrA, frate, decay_time, gSig
     
 def estimate_components_quality(traces, Y, A, C, b, f, final_frate = 30, Npeaks=10, r_values_min = .95,
                                 fitness_min = -100,fitness_delta_min = -100, return_all = False, N =5,
-                                remove_baseline = True, dview = None, robust_std = False,Athresh=0.1,thresh_C=0.3, num_traces_per_group = 20):
+                                remove_baseline = True, dview = None, robust_std = False,Athresh=0.1,thresh_C=0.3, num_traces_per_group = 20,
+                                slow_baseline = False):
     """ Define a metric and order components according to the probability of some "exceptional events" (like a spike).
 
     Such probability is defined as the likeihood of observing the actual trace value over N samples given an estimated noise distribution.
@@ -552,6 +900,9 @@ def estimate_components_quality(traces, Y, A, C, b, f, final_frate = 30, Npeaks=
     thresh_C: float
         fraction of the maximum of C that is used as minimum peak height
 
+    slow_baseline: bool
+        see evaluate_components
+
     Returns:
     -------
     idx_components: ndarray
@@ -577,48 +928,40 @@ def estimate_components_quality(traces, Y, A, C, b, f, final_frate = 30, Npeaks=
         print('NOT MEMORY MAPPED. FALLING BACK ON SINGLE CORE IMPLEMENTATION')
         fitness_raw, fitness_delta, erfc_raw, erfc_delta, r_values, significant_samples = \
             evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline=remove_baseline,
-                                              N=N, robust_std=False, Athresh=0.1, Npeaks=Npeaks,  thresh_C=0.3 )
+                                              N=N, robust_std=False, Athresh=0.1, Npeaks=Npeaks,  thresh_C=0.3,
+                                              slow_baseline=slow_baseline)
         
     else: # memory mapped case    
         
-        Ncomp = A.shape[-1]   
-        groups = grouper(num_traces_per_group, range(Ncomp))
+        # the significant frames depend on the overlaps between all the components, the
+        # workers only receive the filename of the movie and the sparse components of their chunk
+        Ncomp = A.shape[-1]
+        A = csc_matrix(A)
+        tB, tA = activity_window(final_frate)
+        frames = significant_frames(A, C, Athresh=Athresh, Npeaks=Npeaks, tB=tB, tA=tA, thres=thresh_C)
         params = []
-        for g in groups:
-            idx = list(g)
-            # idx = list(filter(None.__ne__, idx))
-            idx = list(filter(lambda a: a is not None, idx))    
-            params.append([Y.filename, traces[idx], A.tocsc()[:,idx], C[idx], b, f, final_frate, remove_baseline, N, robust_std, Athresh, Npeaks, thresh_C])
-        
-        if dview is None:            
-            res = map(evaluate_components_placeholder,params)
+        for start in range(0, Ncomp, num_traces_per_group):
+            idx = np.arange(start, min(start + num_traces_per_group, Ncomp))
+            params.append([Y.filename, idx, np.array(traces[idx]), A[:, idx], [frames[i] for i in idx],
+                           remove_baseline, N, robust_std, slow_baseline])
+
+        if dview is None:
+            res = map(evaluate_components_chunk, params)
         else:
             print('EVALUATING IN PARALLEL... NOT RETURNING ERFCs')
             if 'multiprocessing' in str(type(dview)):
-                res = dview.map_async(evaluate_components_placeholder,params).get(4294967)
-            else:
-                res = dview.map_sync(evaluate_components_placeholder,params)
-        
-        fitness_raw = []
-        fitness_delta = [] 
-        erfc_raw = []
-        erfc_delta = [] 
-        r_values = []
-        significant_samples = []
-        
-        for r_ in res:
-            fitness_raw__, fitness_delta__, erfc_raw__, erfc_delta__, r_values__, significant_samples__ = r_                
-            fitness_raw = np.concatenate([fitness_raw,fitness_raw__])
-            fitness_delta = np.concatenate([fitness_delta, fitness_delta__])
-            r_values = np.concatenate([r_values ,r_values__])
-            # significant_samples = np.concatenate([significant_samples,significant_samples__])
-    
-            if len(erfc_raw) == 0:
-                erfc_raw = erfc_raw__
-                erfc_delta = erfc_delta__
+                res = dview.imap_unordered(evaluate_components_chunk, params)
             else:
-                erfc_raw = np.concatenate([erfc_raw, erfc_raw__],axis = 0)
-                erfc_delta = np.concatenate([erfc_delta, erfc_delta__],axis = 0)
+                res = dview.map_sync(evaluate_components_chunk, params)
+
+        # the results of the chunks are stored as they arrive
+        fitness_raw = np.zeros(Ncomp)
+        fitness_delta = np.zeros(Ncomp)
+        r_values = np.zeros(Ncomp)
+        for idx, fitness_raw__, fitness_delta__, r_values__ in res:
+            fitness_raw[idx] = fitness_raw__
+            fitness_delta[idx] = fitness_delta__
+            r_values[idx] = r_values__
 
     idx_components_r = np.where(r_values >= r_values_min)[0]  # threshold on space consistency
     idx_components_raw = np.where(fitness_raw < fitness_min)[0] # threshold on time variability
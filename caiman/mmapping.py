@@ -13,6 +13,9 @@ from builtins import range
 from past.utils import old_div
 import numpy as np
 import os
+import time
+import json
+import zlib
 
 import caiman as cm
 
@@ -23,10 +26,117 @@ except ImportError:
     from skimage.external import tifffile as tifffile
 
 
+#%%
+def memmap_header_name(filename):
+    """ Name of the sidecar header that describes a memory mapped file
+
+    Parameters:
+    -----------
+        filename: str
+            path of the memory mapped file
+
+    Returns:
+    --------
+        path of the header file
+    """
+    return filename + '.json'
+
+
+#%%
+def _header_checksum(header):
+    """ crc32 of the header fields (checksum excluded), stable across python versions """
+    fields = dict((k, v) for k, v in header.items() if k != 'checksum')
+    return zlib.crc32(json.dumps(fields, sort_keys=True).encode('utf-8')) & 0xffffffff
+
+
+#%%
+def save_memmap_header(filename, dims, T, dtype=np.float32, order='F', fr=None):
+    """ Write the sidecar header describing a memory mapped file of shape (np.prod(dims), T)
+
+    The header stores the frame dimensions, the number of frames, the data type, the
+    order, the frame rate and the expected size in bytes of the file, together with a
+    checksum of these fields. When present it is used by load_memmap instead of parsing
+    the file name.
+
+    Parameters:
+    -----------
+        filename: str
+            path of the memory mapped file
+
+        dims: tuple
+            frame dimensions
+
+        T: int
+            number of frames
+
+        dtype: numpy dtype
+            data type of the entries of the file
+
+        order: str
+            'C' or 'F', order of the (pixels x time) matrix
+
+        fr: float
+            frame rate, if known
+
+    Returns:
+    --------
+        header: dict
+            the content of the header
+    """
+    dtype = np.dtype(dtype)
+    dims = [int(d) for d in dims]
+    header = {'version': 1,
+              'dims': dims,
+              'T': int(T),
+              'dtype': dtype.str,
+              'order': str(order),
+              'fr': None if fr is None else float(fr),
+              'nbytes': int(np.prod(dims)) * int(T) * dtype.itemsize}
+    header['checksum'] = _header_checksum(header)
+    with open(memmap_header_name(filename), 'w') as f:
+        json.dump(header, f, sort_keys=True)
+
+    return header
+
+
+#%%
+def load_memmap_header(filename):
+    """ Read the sidecar header of a memory mapped file
+
+    Parameters:
+    -----------
+        filename: str
+            path of the memory mapped file
+
+    Returns:
+    --------
+        header: dict or None
+            content of the header, None if the file has no header
+
+    Raise:
+    ------
+        Exception('Corrupted header for memory mapped file')
+    """
+    fname_header = memmap_header_name(filename)
+    if not os.path.exists(fname_header):
+        return None
+
+    with open(fname_header, 'r') as f:
+        header = json.load(f)
+
+    if header.get('checksum') != _header_checksum(header):
+        raise Exception('Corrupted header for memory mapped file ' + filename)
+
+    return header
+
+
 #%%
 def load_memmap(filename, mode='r'):
     """ Load a memory mapped file created by the function save_memmap
 
+    If a sidecar header (see save_memmap_header) is present the shape, data type
+    and order are read from it, otherwise they are recovered from the file name.
+
     Parameters:
     -----------
         filename: str
@@ -50,22 +160,83 @@ def load_memmap(filename, mode='r'):
      -----
         exception if not in mmap
 
+        exception if the size of the file does not match its header
+
     """
     if os.path.splitext(filename)[1] == '.mmap':
-        file_to_load = filename
-        filename = os.path.split(filename)[-1]
-        fpart = filename.split('_')[1:-1]
-        d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]
-                                                   ), int(fpart[-5]), int(fpart[-1]), fpart[-3]
-        Yr = np.memmap(file_to_load, mode=mode, shape=(
-            d1 * d2 * d3, T), dtype=np.float32, order=order)
-        return (Yr, (d1, d2), T) if d3 == 1 else (Yr, (d1, d2, d3), T)
+        header = load_memmap_header(filename)
+        if header is not None:
+            dims, T = tuple(header['dims']), header['T']
+            dtype, order = np.dtype(header['dtype']), header['order']
+            if os.path.getsize(filename) != header['nbytes']:
+                raise Exception('Size of ' + filename + ' does not match its header')
+        else:
+            fpart = os.path.split(filename)[-1].split('_')[1:-1]
+            d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]
+                                                       ), int(fpart[-5]), int(fpart[-1]), fpart[-3]
+            dims = (d1, d2) if d3 == 1 else (d1, d2, d3)
+            dtype = np.float32
+
+        Yr = np.memmap(filename, mode=mode, shape=(
+            int(np.prod(dims)), T), dtype=dtype, order=order)
+        return Yr, dims, T
     else:
         raise Exception('Not implemented consistently')
         # Yr = np.load(filename, mmap_mode='r')
         # return Yr, None, None
 
 
+#%%
+def append_to_memmap(filename, frames):
+    """ Append frames at the end of an 'F' order memory mapped file with a header
+
+    Since the header stores the number of frames, the file is extended in place
+    and does not need to be renamed.
+
+    Parameters:
+    -----------
+        filename: str
+            path of the memory mapped file
+
+        frames: ndarray
+            frames to append, time x dims
+
+    Returns:
+    --------
+        T: int
+            new number of frames
+
+    Raise:
+    ------
+        Exception('Appending requires a memory mapped file with header')
+
+        Exception('Appending is only possible for files saved in F order')
+
+        Exception('Frame dimensions do not match')
+    """
+    header = load_memmap_header(filename)
+    if header is None:
+        raise Exception('Appending requires a memory mapped file with header')
+
+    if header['order'] != 'F':
+        raise Exception('Appending is only possible for files saved in F order')
+
+    dims = tuple(header['dims'])
+    if tuple(np.shape(frames)[1:]) != dims:
+        raise Exception('Frame dimensions do not match')
+
+    T = np.shape(frames)[0]
+    Yr = np.transpose(frames, list(range(1, len(dims) + 1)) + [0])
+    Yr = np.reshape(Yr, (np.prod(dims), T), order='F')
+    with open(filename, 'ab') as f:
+        np.asarray(Yr, dtype=np.dtype(header['dtype'])).ravel(order='F').tofile(f)
+
+    save_memmap_header(filename, dims, header['T'] + T, dtype=header['dtype'],
+                       order='F', fr=header['fr'])
+
+    return header['T'] + T
+
+
 #%%
 def save_memmap_each(fnames, dview=None, base_name=None, resize_fact=(1, 1, 1), remove_init=0,
                      idx_xy=None, xy_shifts=None, add_to_movie=0, border_to_0=0):
@@ -154,40 +325,105 @@ def save_memmap_join(mmap_fnames, base_name=None, n_chunks=20, dview=None, async
 
     Returns:
     --------
+    fname_tot: str
+        name of the joined memory mapped file, saved in C order
+
+    """
+
+    if base_name is None:
+
+        base_name = mmap_fnames[0]
+        base_name = base_name[:base_name.find('_d1_')] + '-#-' + str(len(mmap_fnames))
+
+    fname_tot = transpose_memmap(mmap_fnames, order='C', base_name=base_name,
+                                 n_chunks=n_chunks, dview=dview)
+
+    np.savez(base_name + '.npz', mmap_fnames=mmap_fnames, fname_tot=fname_tot)
+
+    return fname_tot
+
+
+#%%
+def transpose_memmap(mmap_fnames, order='C', base_name=None, n_chunks=20, dview=None, tile_bytes=2**26):
+    """
+    Out of core conversion of memory mapped files to a single file with the requested order
+
+    Motion correction writes files in 'F' order (each frame is contiguous), while CNMF
+    (and run_CNMF_patches in particular) reads pixels across time and is faster on
+    files in 'C' order. The input files, in any order, are concatenated along time.
+    The pixels are split in n_chunks groups processed in parallel and each group is
+    copied in tiles of about tile_bytes bytes, shaped so that both the reads and the
+    writes access contiguous runs of memory.
+
+    Parameters:
+    -----------
+    mmap_fnames: str or list of str
+        memory mapped files to convert, all with the same frame dimensions
+
+    order: 'C' or 'F'
+        order of the output file
+
+    base_name: str
+        first portion of the name of the output file. By default the one of the first file
+
+    n_chunks: int
+        number of groups of pixels processed in parallel
+
+    dview: cluster handle
+        if None the groups are processed sequentially
+
+    tile_bytes: int
+        size in bytes of the tiles copied at once by each worker
+
+    Returns:
+    --------
+    fname_tot: str
+        name of the output memory mapped file
 
+    Raise:
+    ------
+    Exception('All the files must have the same frame dimensions')
+
+    Exception('The output file cannot be one of the input files')
     """
+    if isinstance(mmap_fnames, basestring):
+        mmap_fnames = [mmap_fnames]
 
     tot_frames = 0
-    order = 'C'
     for f in mmap_fnames:
-        Yr, dims, T = load_memmap(f)
-        print((f, T))
+        Yr, dims_, T = load_memmap(f)
+        if tot_frames == 0:
+            dims, dtype = dims_, Yr.dtype
+        elif tuple(dims_) != tuple(dims):
+            raise Exception('All the files must have the same frame dimensions')
         tot_frames += T
         del Yr
 
-    d = np.prod(dims)
+    d = int(np.prod(dims))
 
     if base_name is None:
-
-        base_name = mmap_fnames[0]
-        base_name = base_name[:base_name.find('_d1_')] + '-#-' + str(len(mmap_fnames))
+        base_name = os.path.split(mmap_fnames[0])[-1]
+        base_name = base_name[:base_name.find('_d1_')]
 
     fname_tot = (base_name + '_d1_' + str(dims[0]) + '_d2_' + str(dims[1]) + '_d3_' +
                  str(1 if len(dims) == 2 else dims[2]) + '_order_' + str(order) +
                  '_frames_' + str(tot_frames) + '_.mmap')
     fname_tot = os.path.join(os.path.split(mmap_fnames[0])[0], fname_tot)
+    if any(os.path.abspath(f) == os.path.abspath(fname_tot) for f in mmap_fnames):
+        raise Exception('The output file cannot be one of the input files')
 
     print(fname_tot)
 
-    big_mov = np.memmap(fname_tot, mode='w+', dtype=np.float32, shape=(d, tot_frames), order='C')
+    big_mov = np.memmap(fname_tot, mode='w+', dtype=dtype, shape=(d, tot_frames), order=order)
+    del big_mov
+    save_memmap_header(fname_tot, dims, tot_frames, dtype=dtype, order=order)
 
-    step = np.int(old_div(d, n_chunks))
+    n_chunks = max(1, min(n_chunks, d))
     pars = []
-    for ref in range(0, d - step + 1, step):
-        pars.append([fname_tot, d, tot_frames, mmap_fnames, ref, ref + step])
-    # last batch should include the leftover pixels
-    pars[-1][-1] = d
+    for idx in np.array_split(np.arange(d), n_chunks):
+        pars.append([fname_tot, mmap_fnames, idx[0], idx[-1] + 1, tile_bytes])
 
+    start_time = time.time()
     if dview is not None:
         if 'multiprocessing' in str(type(dview)):
             dview.map_async(save_portion, pars).get(4294967)
@@ -196,33 +432,46 @@ def save_memmap_join(mmap_fnames, base_name=None, n_chunks=20, dview=None, async
     else:
         list(map(save_portion, pars))
 
-    np.savez(base_name + '.npz', mmap_fnames=mmap_fnames, fname_tot=fname_tot)
-
-    print('Deleting big mov')
-    del big_mov
+    gbytes = d * tot_frames * np.dtype(dtype).itemsize / 2.**30
+    print('Saved ' + str(np.round(gbytes, 2)) + ' GB in order ' + str(order) + ' at ' +
+          str(np.round(gbytes / max(time.time() - start_time, 1e-6), 2)) + ' GB/s')
 
     return fname_tot
 
 
 def save_portion(pars):
-    # todo: todocument
+    """ Copy the pixels idx_start:idx_end of a list of memory mapped files into a single file
+
+    The copy proceeds in tiles of roughly tile_bytes bytes, of about the same extent in
+    pixels and in frames, so that reads and writes are contiguous whatever the orders
+    of the input and output files.
+
+    Parameters:
+    -----------
+    pars: list
+        fname_tot, fnames, idx_start, idx_end, tile_bytes
+    """
+
+    fname_tot, fnames, idx_start, idx_end, tile_bytes = pars
+    big_mov, _, tot_frames = load_memmap(fname_tot, mode='r+')
+    itemsize = big_mov.dtype.itemsize
+    side = max(1, int(np.sqrt(tile_bytes // itemsize)))
+    step_pix = min(idx_end - idx_start, side)
+    step_frames = max(1, tile_bytes // (step_pix * itemsize))
 
-    big_mov, d, tot_frames, fnames, idx_start, idx_end = pars
-    big_mov = np.memmap(big_mov, mode='r+', dtype=np.float32, shape=(d, tot_frames), order='C')
     Ttot = 0
-    Yr_tot = np.zeros((idx_end - idx_start, tot_frames))
-    print((Yr_tot.shape))
     for f in fnames:
-        print(f)
         Yr, dims, T = load_memmap(f)
-        print((idx_start, idx_end))
-        Yr_tot[:, Ttot:Ttot + T] = np.array(Yr[idx_start:idx_end])
+        for p0 in range(idx_start, idx_end, step_pix):
+            p1 = min(p0 + step_pix, idx_end)
+            for t0 in range(0, T, step_frames):
+                t1 = min(t0 + step_frames, T)
+                big_mov[p0:p1, Ttot + t0:Ttot + t1] = Yr[p0:p1, t0:t1]
+
         Ttot = Ttot + T
         del Yr
 
-    big_mov[idx_start:idx_end, :] = Yr_tot
-    del Yr_tot
-    print('done')
+    big_mov.flush()
     del big_mov
     return Ttot
 
@@ -240,11 +489,126 @@ def save_place_holder(pars):
                        add_to_movie=add_to_movie, border_to_0=border_to_0)
 
 
+#%%
+def get_file_size(file_name, is_3D=False, var_name_hdf5='mov'):
+    """ Compute the frame dimensions and number of frames of a movie without loading it
+
+    Parameters:
+    -----------
+        file_name: str or ndarray
+            movie file (tif, mmap, hdf5, h5, npy, sbx) or array time x dims. Other
+            formats are loaded in memory to find their size
+
+        is_3D: boolean
+            whether it is 3D data
+
+        var_name_hdf5: str
+            if loading from hdf5 name of the variable to load
+
+    Returns:
+    --------
+        dims: tuple
+            frame dimensions
+
+        T: int
+            number of frames
+    """
+    if not isinstance(file_name, basestring):
+        shape = np.shape(file_name)
+        return tuple(shape[1:]), shape[0]
+
+    extension = os.path.splitext(file_name)[1]
+    if extension in ('.tif', '.tiff'):
+        try:
+            reader = cm.base.movies.TiffPageReader(file_name)
+            if reader.is_stack and not is_3D:
+                return tuple(reader.shape[1:]), reader.shape[0]
+        except Exception as e:
+            print('Could not index ' + file_name + ' (' + str(e) + '), using tifffile')
+        with tifffile.TiffFile(file_name) as tf:
+            shape = tf.series[0].shape
+        if (len(shape) == 2 and not is_3D) or (len(shape) == 3 and is_3D):
+            # single frame
+            shape = (1,) + tuple(shape)
+    elif extension == '.sbx':
+        shape = cm.base.movies.sbxshape(os.path.splitext(file_name)[0])
+        return (shape[1], shape[0]), shape[2]
+    elif extension == '.mmap':
+        _, dims, T = load_memmap(file_name)
+        return tuple(dims), T
+    elif extension in ('.hdf5', '.h5'):
+        import h5py
+        with h5py.File(file_name, 'r') as f:
+            shape = f[var_name_hdf5].shape
+    elif extension == '.npy':
+        shape = np.load(file_name, mmap_mode='r').shape
+    else:
+        shape = cm.load(file_name, fr=1).shape
+
+    return tuple(shape[1:]), shape[0]
+
+
+#%%
+def _iter_movie_chunks(file_name, dims, T, start, frames_per_chunk, is_3D=False, var_name_hdf5='mov'):
+    """ Yield consecutive chunks of frames of a movie (of size dims, T as returned by
+    get_file_size) starting at frame start.
+
+    Multipage tif, mmap, hdf5 and npy files are read chunk by chunk, so that only
+    frames_per_chunk frames are in memory at any time. Other formats, and tif files
+    storing the whole movie in a single page, are loaded once in memory.
+
+    Yields:
+    -------
+        idx_start: int
+            index of the first frame of the chunk in the movie
+
+        chunk: ndarray
+            frames time x dims
+    """
+    ranges = [(t, min(t + frames_per_chunk, T)) for t in range(start, T, frames_per_chunk)]
+    if not isinstance(file_name, basestring):
+        for t0, t1 in ranges:
+            yield t0, np.array(file_name[t0:t1])
+        return
+
+    extension = os.path.splitext(file_name)[1]
+    if extension in ('.tif', '.tiff'):
+        with tifffile.TiffFile(file_name) as tf:
+            if len(tf.pages) == T and not is_3D:
+                for t0, t1 in ranges:
+                    yield t0, np.reshape(tf.asarray(key=slice(t0, t1)), (t1 - t0,) + dims)
+                return
+        Y = np.reshape(tifffile.imread(file_name), (T,) + dims)
+    elif extension == '.mmap':
+        Yr, _, _ = load_memmap(file_name)
+        for t0, t1 in ranges:
+            yield t0, np.reshape(np.array(Yr[:, t0:t1]).T, (t1 - t0,) + dims, order='F')
+        return
+    elif extension in ('.hdf5', '.h5'):
+        import h5py
+        with h5py.File(file_name, 'r') as f:
+            for t0, t1 in ranges:
+                yield t0, np.array(f[var_name_hdf5][t0:t1])
+        return
+    elif extension == '.npy':
+        Y = np.load(file_name, mmap_mode='r')
+    else:
+        Y = cm.load(file_name, fr=1, in_memory=True)
+
+    for t0, t1 in ranges:
+        yield t0, np.array(Y[t0:t1])
+
+
 #%%
 def save_memmap(filenames, base_name='Yr', resize_fact=(1, 1, 1), remove_init=0, idx_xy=None,
-                order='F', xy_shifts=None, is_3D=False, add_to_movie=0, border_to_0=0):
+                order='F', xy_shifts=None, is_3D=False, add_to_movie=0, border_to_0=0, dtype=np.float32,
+                frames_per_chunk=1000):
     """ Efficiently write data from a list of tif files into a memory mappable file
 
+    The files are first inspected to compute the size of the output, which is then
+    filled in a single pass, reading and processing frames_per_chunk frames at a time.
+    Peak memory is therefore bounded by the chunk size rather than by the file size.
+
     Parameters:
     ----------
         filenames: list
@@ -254,7 +618,9 @@ def save_memmap(filenames, base_name='Yr', resize_fact=(1, 1, 1), remove_init=0,
             the base used to build the file name. IT MUST NOT CONTAIN "_"
 
         resize_fact: tuple
-            x,y, and z downsampling factors (0.5 means downsampled by a factor 2)
+            x,y, and z downsampling factors (0.5 means downsampled by a factor 2).
+            Temporal downsampling is performed within each chunk, hence frames_per_chunk
+            should be a multiple of 1/z
 
         remove_init: int
             number of frames to remove at the begining of each tif file
@@ -274,80 +640,108 @@ def save_memmap(filenames, base_name='Yr', resize_fact=(1, 1, 1), remove_init=0,
             whether it is 3D data
         add_to_movie: floating-point
             value to add to each image point, typically to keep negative values out.
+
+        border_to_0: int
+            number of pixels on the border to set to the minimum of each file
+
+        dtype: numpy dtype
+            data type of the saved file (e.g. np.float16 or np.uint16 halve the disk footprint)
+
+        frames_per_chunk: int
+            number of frames read and processed at once
+
     Returns:
     -------
         fname_new: the name of the mapped file, the format is such that
             the name will contain the frame dimensions and the number of f
+            The file is described by a sidecar header, see save_memmap_header
 
-    """
-
-    # TODO: can be done online
-    Ttot = 0
-    for idx, f in enumerate(filenames):
-        if isinstance(f, str):
-            print(f)
-
-        if is_3D:
-            #import tifffile
-            #            print("Using tifffile library instead of skimage because of  3D")
+    Raise:
+    ------
+        Exception('You need to set is_3D=True for 3D data)')
 
-            Yr = f if not(isinstance(f, basestring)) else tifffile.imread(f)
-            if idx_xy is None:
-                Yr = Yr[remove_init:]
-            elif len(idx_xy) == 2:
-                Yr = Yr[remove_init:, idx_xy[0], idx_xy[1]]
-            else:
-                Yr = Yr[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
+        Exception('All the files must have the same frame dimensions')
 
-        else:
-            Yr = cm.load(f, fr=1, in_memory=True) if isinstance(f, basestring) else cm.movie(f)
-            if xy_shifts is not None:
-                Yr = Yr.apply_shifts(xy_shifts, interpolation='cubic', remove_blanks=False)
-
-            if idx_xy is None:
-                if remove_init > 0:
-                    Yr = np.array(Yr)[remove_init:]
-            elif len(idx_xy) == 2:
-                Yr = np.array(Yr)[remove_init:, idx_xy[0], idx_xy[1]]
-            else:
-                raise Exception('You need to set is_3D=True for 3D data)')
-                Yr = np.array(Yr)[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
+    """
+    if idx_xy is not None and len(idx_xy) > 2 and not is_3D:
+        raise Exception('You need to set is_3D=True for 3D data)')
+
+    fx, fy, fz = resize_fact
+
+    def _n_frames_out(n):
+        return n if fz == 1 else max(1, int(fz * n))
+
+    # header pass: compute the size of the output without reading the data
+    sizes_in = [get_file_size(f, is_3D=is_3D) for f in filenames]
+    sizes = []
+    for dims_in, T_in in sizes_in:
+        dims = np.zeros(dims_in, dtype=bool)
+        if idx_xy is not None:
+            dims = dims[tuple(idx_xy)]
+        dims = dims.shape
+        if fx != 1 or fy != 1:
+            dims = (int(dims[0] * fx), int(dims[1] * fy)) + dims[2:]
+        T = sum(_n_frames_out(min(t + frames_per_chunk, T_in) - t)
+                for t in range(remove_init, T_in, frames_per_chunk))
+        sizes.append((dims, T))
+
+    dims = sizes[0][0]
+    if any(dd != dims for dd, _ in sizes):
+        raise Exception('All the files must have the same frame dimensions')
+
+    Ttot = sum(T for _, T in sizes)
+    d = np.prod(dims)
+    fname_tot = base_name + '_d1_' + str(dims[0]) + '_d2_' + str(dims[1]) + '_d3_' + str(
+        1 if len(dims) == 2 else dims[2]) + '_order_' + str(order)
+    if isinstance(filenames[0], basestring):
+        fname_tot = os.path.join(os.path.split(filenames[0])[0], fname_tot)
 
-        if border_to_0 > 0:
+    big_mov = np.memmap(fname_tot, mode='w+', dtype=dtype, shape=(d, Ttot), order=order)
 
-            min_mov = Yr.calc_min()
-            Yr[:, :border_to_0, :] = min_mov
-            Yr[:, :, :border_to_0] = min_mov
-            Yr[:, :, -border_to_0:] = min_mov
-            Yr[:, -border_to_0:, :] = min_mov
+    T_start = 0
+    for idx, f in enumerate(filenames):
+        if isinstance(f, basestring):
+            print(f)
 
-        fx, fy, fz = resize_fact
-        if fx != 1 or fy != 1 or fz != 1:
+        min_mov = np.inf
+        T_chunk = T_start
+        for t0, Yr in _iter_movie_chunks(f, sizes_in[idx][0], sizes_in[idx][1], remove_init,
+                                         frames_per_chunk, is_3D=is_3D):
+            if xy_shifts is not None and not is_3D:
+                Yr = cm.movie(Yr, fr=1).apply_shifts(xy_shifts[t0:t0 + len(Yr)],
+                                                     interpolation='cubic', remove_blanks=False)
+            if idx_xy is not None:
+                Yr = np.asarray(Yr)[(slice(None),) + tuple(idx_xy)]
 
-            if 'movie' not in str(type(Yr)):
-                Yr = cm.movie(Yr, fr=1)
+            if border_to_0 > 0:
+                min_mov = min(min_mov, np.nanmin(Yr))
 
-            Yr = Yr.resize(fx=fx, fy=fy, fz=fz)
+            if fx != 1 or fy != 1 or fz != 1:
+                Yr = cm.movie(np.asarray(Yr), fr=1).resize(fx=fx, fy=fy, fz=fz)
 
-        T, dims = Yr.shape[0], Yr.shape[1:]
-        Yr = np.transpose(Yr, list(range(1, len(dims) + 1)) + [0])
-        Yr = np.reshape(Yr, (np.prod(dims), T), order='F')
+            T = Yr.shape[0]
+            Yr = np.transpose(Yr, list(range(1, len(dims) + 1)) + [0])
+            Yr = np.reshape(Yr, (d, T), order='F')
+            big_mov[:, T_chunk:T_chunk + T] = np.asarray(Yr, dtype=np.float32) + 1e-10 + add_to_movie
+            T_chunk += T
 
-        if idx == 0:
-            fname_tot = base_name + '_d1_' + str(dims[0]) + '_d2_' + str(dims[1]) + '_d3_' + str(
-                1 if len(dims) == 2 else dims[2]) + '_order_' + str(order)
-            if isinstance(f, str):
-                fname_tot = os.path.join(os.path.split(f)[0], fname_tot)
-            big_mov = np.memmap(fname_tot, mode='w+', dtype=np.float32,
-                                shape=(np.prod(dims), T), order=order)
-        else:
-            big_mov = np.memmap(fname_tot, dtype=np.float32, mode='r+',
-                                shape=(np.prod(dims), Ttot + T), order=order)
+        if border_to_0 > 0:
+            # the minimum of the file is only known once it has been read, so the
+            # border is set afterwards (min + 1, as in movie.calc_min)
+            border = np.zeros(dims, dtype=bool)
+            border[:border_to_0] = True
+            border[-border_to_0:] = True
+            border[:, :border_to_0] = True
+            border[:, -border_to_0:] = True
+            border = np.where(border.flatten(order='F'))[0]
+            for t0 in range(T_start, T_chunk, frames_per_chunk):
+                t1 = min(t0 + frames_per_chunk, T_chunk)
+                big_mov[border, t0:t1] = min_mov + 1 + 1e-10 + add_to_movie
+
+        T_start = T_chunk
 
-        big_mov[:, Ttot:Ttot + T] = np.asarray(Yr, dtype=np.float32) + 1e-10 + add_to_movie
-        big_mov.flush()
-        del big_mov
-        Ttot = Ttot + T
+    big_mov.flush()
+    del big_mov
 
     fname_new = fname_tot + '_frames_' + str(Ttot) + '_.mmap'
     try:
@@ -356,127 +750,210 @@ def save_memmap(filenames, base_name='Yr', resize_fact=(1, 1, 1), remove_init=0,
     except OSError:
         pass
     os.rename(fname_tot, fname_new)
+    save_memmap_header(fname_new, dims, Ttot, dtype=dtype, order=order)
 
     return fname_new
 
+#%%
+def _block_bounds(b, d1, block_size, transpose):
+    """ Split the rows of the memory mapped matrix in blocks of block_size rows
+
+    When computing the transposed product with a sparse b, blocks of rows where b has
+    no nonzero are dropped and the others are trimmed to their first and last nonzero
+    rows, since they do not contribute to the product.
+
+    Returns:
+    --------
+        bounds: list of (start, stop) tuples
+    """
+    bounds = [(idx, min(idx + block_size, d1)) for idx in range(0, d1, block_size)]
+    if transpose and 'sparse' in str(type(b)):
+        nnz_rows = np.flatnonzero(np.diff(b.tocsr().indptr))
+        trimmed = []
+        for start, stop in bounds:
+            rows = nnz_rows[np.searchsorted(nnz_rows, start):np.searchsorted(nnz_rows, stop)]
+            if len(rows):
+                trimmed.append((rows[0], rows[-1] + 1))
+        bounds = trimmed
+
+    return bounds
+
+
+#%%
+def _tree_sum(parts):
+    """ Sum a list of arrays pairwise, in log2(len(parts)) rounds """
+    parts = list(parts)
+    while len(parts) > 1:
+        for idx in range(0, len(parts) - 1, 2):
+            parts[idx] += parts[idx + 1]
+        parts = parts[::2]
+
+    return parts[0]
+
+
+#%%
+def _n_workers(dview):
+    """ Number of workers of a multiprocessing pool or ipyparallel view (1 if None) """
+    if dview is None:
+        return 1
+    if 'multiprocessing' in str(type(dview)):
+        return dview._processes
+    try:
+        return len(dview)
+    except TypeError:
+        return len(dview.client.ids)
+
+
 #%%
 def parallel_dot_product(A, b, block_size=5000, dview=None, transpose=False, num_blocks_per_run=20):
-    # todo: todocument
     """ Chunk matrix product between matrix and column vectors
 
+    The rows of A are split in blocks of block_size rows, and the blocks are grouped in
+    tasks of at most num_blocks_per_run consecutive blocks (at least one task per
+    worker). Each task only receives the rows of b it needs, and reads the next block
+    of A from disk while computing the product with the current one. With
+    transpose=True the partial products of the tasks are summed pairwise.
+
+    Parameters:
+    -----------
     A: memory mapped ndarray
         pixels x time
 
-    b: time x comps
-    """
+    b: ndarray or sparse matrix
+        time x comps if transpose is False, pixels x comps otherwise
 
-    import pickle
-    pars = []
-    d1, d2 = np.shape(A)
-    b = pickle.dumps(b)
-    print('parallel dot product block size: ' + str(block_size))
+    block_size: int
+        number of rows of A read at once
 
-    if block_size < d1:
+    dview: multiprocessing pool or ipyparallel view
+        to parallelize over tasks
 
-        for idx in range(0, d1 - block_size, block_size):
-            idx_to_pass = list(range(idx, idx + block_size))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+    transpose: bool
+        compute A.T.dot(b) (time x comps) instead of A.dot(b) (pixels x comps)
 
-        if (idx + block_size) < d1:
-            idx_to_pass = list(range(idx + block_size, d1))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+    num_blocks_per_run: int
+        maximum number of blocks processed by each task
 
+    Returns:
+    --------
+    output: ndarray
+        float32 product, time x comps if transpose is True, pixels x comps otherwise
+    """
+    d1, d2 = np.shape(A)
+    print('parallel dot product block size: ' + str(block_size))
+    if 'sparse' in str(type(b)):
+        b = b.tocsr().astype(np.float32)
     else:
-        idx_to_pass = list(range(d1))
-        pars.append([A.filename, idx_to_pass, b, transpose])
-
-    print('Start product')
-    b = pickle.loads(b)
+        b = np.asarray(b, dtype=np.float32)
 
-    if transpose:
-        output = np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
-    else:
-        output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
+    bounds = _block_bounds(b, d1, block_size, transpose)
+    if len(bounds) == 0:
+        return np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
 
-    if dview is None:
+    n_tasks = min(len(bounds), max(_n_workers(dview), -(-len(bounds) // num_blocks_per_run)))
+    pars = []
+    for task_bounds in np.array_split(np.array(bounds, dtype=np.int64), n_tasks):
         if transpose:
-            #            b = pickle.loads(b)
-            print('Transposing')
-#            output = np.zeros((d2,np.shape(b)[-1]), dtype = np.float32)
-            for counts, pr in enumerate(pars):
-
-                iddx, rs = dot_place_holder(pr)
-                output = output + rs
-
+            b_ = [b[start:stop] for start, stop in task_bounds]
         else:
-            #            b = pickle.loads(b)
-            #            output = np.zeros((d1,np.shape(b)[-1]), dtype = np.float32)
-            for counts, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output[iddx] = rs
+            b_ = b
+        pars.append([A.filename, [tuple(bnd) for bnd in task_bounds], b_, transpose])
 
+    print('Start product')
+    if dview is None:
+        results = map(dot_place_holder, pars)
+    elif 'multiprocessing' in str(type(dview)):
+        results = dview.imap_unordered(dot_place_holder, pars)
     else:
-        #        b = pickle.loads(b)
+        results = dview.map_sync(dot_place_holder, pars)
 
-        for itera in range(0, len(pars), num_blocks_per_run):
-            
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(dot_place_holder, pars[itera:itera + num_blocks_per_run]).get(4294967)
-            else:
-                results = dview.map_sync(dot_place_holder, pars[itera:itera + num_blocks_per_run])
-                
-            print('Processed:' + str([itera, itera + len(results)]))
+    if transpose:
+        output = _tree_sum([res for _, res in results])
+    else:
+        output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
+        for task_bounds, res in results:
+            for (start, stop), outp in zip(task_bounds, res):
+                output[start:stop] = outp
 
-            if transpose:
-                print('Transposing')
+    if dview is not None and not('multiprocessing' in str(type(dview))):
+        dview.clear()
 
-                for num_, res in enumerate(results):
-                    #                    print(num_)
-                    output += res[1]
+    return output
 
-            else:
-                print('Filling')
 
-                for res in results:
-                    output[res[0]] = res[1]
+#%%
+_memmap_cache = {}
 
-            if not('multiprocessing' in str(type(dview))):
-                dview.clear()
 
-    return output
+def _cached_memmap(filename):
+    """ load_memmap, reusing the memory mapped file across the tasks run by a process """
+    key = (filename, os.path.getmtime(filename))
+    if key not in _memmap_cache:
+        _memmap_cache.clear()
+        _memmap_cache[key] = load_memmap(filename)[0]
+
+    return _memmap_cache[key]
 
 
 #%%
 def dot_place_holder(par):
-    # todo: todocument
+    """ Product of consecutive blocks of rows of a memory mapped file with a matrix
 
-    import pickle
-    A_name, idx_to_pass, b_, transpose = par
-    A_, _, _ = load_memmap(A_name)
-    b_ = pickle.loads(b_).astype(np.float32)
+    The next block is read in a background thread while the current one is multiplied.
 
-    print((idx_to_pass[-1]))
-    if 'sparse' in str(type(b_)):
-        if transpose:
-            outp = (b_.T.tocsc()[:, idx_to_pass].dot(A_[idx_to_pass])).T.astype(np.float32)
-#            del b_
-#            return idx_to_pass, outp
+    Parameters:
+    -----------
+    par: list
+        A_name: str, name of the memory mapped file (pixels x time)
+        bounds: list of (start, stop) rows of the blocks
+        b_: matrix (time x comps) or list of the rows of the matrix (pixels x comps)
+            corresponding to each block if transpose is True
+        transpose: bool, see parallel_dot_product
 
-        else:
-            outp = (b_.T.dot(A_[idx_to_pass].T)).T.astype(np.float32)
-#            del b_
-#            return idx_to_pass,outp
-    else:
+    Returns:
+    --------
+    bounds: list
+        as in input
+
+    outp: list of ndarray or ndarray
+        product of each block if transpose is False, otherwise the sum of the products
+        of all the blocks (time x comps)
+    """
+    import threading
+
+    A_name, bounds, b_, transpose = par
+    A_ = _cached_memmap(A_name)
+    blocks = [None] * len(bounds)
+
+    def read_block(idx):
+        blocks[idx] = np.array(A_[bounds[idx][0]:bounds[idx][1]], dtype=np.float32)
+
+    reader = threading.Thread(target=read_block, args=(0,))
+    reader.start()
+    outp = []
+    for idx in range(len(bounds)):
+        reader.join()
+        A_block, blocks[idx] = blocks[idx], None
+        if idx + 1 < len(bounds):
+            reader = threading.Thread(target=read_block, args=(idx + 1,))
+            reader.start()
         if transpose:
-            outp = A_[idx_to_pass].dot(b_[idx_to_pass]).astype(np.float32)
-#            del b_
-#            return idx_to_pass, outp
+            b_block = b_[idx]
+            if 'sparse' in str(type(b_block)):
+                res = b_block.T.dot(A_block).T
+            else:
+                res = A_block.T.dot(b_block)
+            if idx == 0:
+                outp = np.asarray(res, dtype=np.float32)
+            else:
+                outp += res
         else:
+            if 'sparse' in str(type(b_)):
+                outp.append(np.asarray(b_.T.dot(A_block.T).T, dtype=np.float32))
+            else:
+                outp.append(A_block.dot(b_))
 
-            outp = A_[idx_to_pass].dot(b_).astype(np.float32)
-
-    del b_, A_
-    return idx_to_pass, outp
+    return bounds, outp
 
 
 #%%
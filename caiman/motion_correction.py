@@ -62,12 +62,21 @@ except:
     
 import gc
 import os
+import json
+import pickle
+import shutil
 import time
+import zlib
+from timeit import default_timer
 from cv2 import dft as fftn
 from cv2 import idft as ifftn
 opencv = True
 from numpy.fft import ifftshift
 import itertools
+try:
+    import scipy.fft as fft_module  # scipy >= 1.4 keeps single precision transforms in single precision
+except ImportError:
+    fft_module = np.fft
 try:
     profile
 except:
@@ -128,6 +137,23 @@ class MotionCorrect(object):
         
         nonneg_movie: boolean
             make the SAVED movie and template mostly nonnegative by removing min_mov from movie
+
+        precision: str
+            'float64' or 'float32', floating point precision of the frames, of the FFTs and of the
+            blending during registration. 'float32' halves the memory traffic at the cost of
+            a small loss of accuracy
+
+        n_threads: int
+            number of threads used by each process to correct the patches of a frame concurrently.
+            The movie is split across the processes of dview, so the number of cores used is
+            the number of processes times n_threads: with few long files, use fewer processes
+            (larger splits, better templates) and more threads
+
+        resume: bool
+            resume an interrupted run from the results of the completed splits, see motion_correction_piecewise
+
+        progress_callback: function
+            called as progress_callback(n_splits_done, n_splits) each time a split is completed
             
         Returns:
         -------
@@ -138,7 +164,8 @@ class MotionCorrect(object):
         """
      def __init__(self, fname, min_mov, dview=None, max_shifts=(6,6), niter_rig=1, splits_rig=14, num_splits_to_process_rig=None, 
                 strides= (96,96), overlaps= (32,32), splits_els=14,num_splits_to_process_els=[7,None], 
-                upsample_factor_grid=4, max_deviation_rigid=3, shifts_opencv = True, nonneg_movie = False, gSig_filt=None): 
+                upsample_factor_grid=4, max_deviation_rigid=3, shifts_opencv = True, nonneg_movie = False, gSig_filt=None,
+                precision='float64', n_threads=1, resume=False, progress_callback=None): 
         """
         Constructor class for motion correction operations
         
@@ -159,6 +186,10 @@ class MotionCorrect(object):
         self.min_mov = min_mov
         self.nonneg_movie  = nonneg_movie
         self.gSig_filt = gSig_filt
+        self.precision = precision
+        self.n_threads = n_threads
+        self.resume = resume
+        self.progress_callback = progress_callback
 
         
         
@@ -194,7 +225,8 @@ class MotionCorrect(object):
             self.fname,self.max_shifts, dview = self.dview, splits = self.splits_rig ,
             num_splits_to_process = self.num_splits_to_process_rig,num_iter = self.niter_rig, template = template,
             shifts_opencv = self.shifts_opencv , save_movie_rigid = save_movie, add_to_movie= -self.min_mov,
-            nonneg_movie = self.nonneg_movie, gSig_filt=self.gSig_filt)
+            nonneg_movie = self.nonneg_movie, gSig_filt=self.gSig_filt, precision=self.precision,
+            n_threads=self.n_threads, resume=self.resume, progress_callback=self.progress_callback)
         
         return self
 
@@ -249,7 +281,9 @@ class MotionCorrect(object):
                 dview = self.dview, upsample_factor_grid = self.upsample_factor_grid,
                 max_deviation_rigid = self.max_deviation_rigid, splits = self.splits_els ,
                 num_splits_to_process = num_splits_to_process, num_iter = num_iter, template =  self.total_template_els,
-                shifts_opencv = self.shifts_opencv, save_movie = save_movie, nonneg_movie = self.nonneg_movie, gSig_filt=self.gSig_filt)
+                shifts_opencv = self.shifts_opencv, save_movie = save_movie, nonneg_movie = self.nonneg_movie, gSig_filt=self.gSig_filt,
+                precision=self.precision, n_threads=self.n_threads, resume=self.resume,
+                progress_callback=self.progress_callback)
             if show_template:
                 pl.imshow(new_template_els)
                 pl.pause(.5)
@@ -1348,8 +1382,6 @@ def register_translation(src_image, target_image, upsample_factor=1,
 
     if upsample_factor == 1:
 
-        src_amp = old_div(np.sum(np.abs(src_freq) ** 2), src_freq.size)
-        target_amp = old_div(np.sum(np.abs(target_freq) ** 2), target_freq.size)
         CCmax = cross_correlation.max()
     # If upsampling > 1, then refine estimate with matrix multiply DFT
     else:
@@ -1376,12 +1408,7 @@ def register_translation(src_image, target_image, upsample_factor=1,
         maxima -= dftshift
         shifts = shifts + old_div(maxima, upsample_factor)
         CCmax = cross_correlation.max()
-        src_amp = _upsampled_dft(src_freq * src_freq.conj(),
-                                 1, upsample_factor)[0, 0]
-        src_amp /= normalization
-        target_amp = _upsampled_dft(target_freq * target_freq.conj(),
-                                    1, upsample_factor)[0, 0]
-        target_amp /= normalization
+        # the amplitudes needed by _compute_error are not computed since the error is not returned
 
     # If its only one row or column the shift along that dimension has no
     # effect. We set to zero.
@@ -1450,8 +1477,8 @@ def apply_shifts_dft(src_freq, shifts, diffphase, is_freq = True, border_nan = F
     Nc = ifftshift(np.arange(-np.fix(old_div(nc,2.)),np.ceil(old_div(nc,2.))))
     Nr,Nc = np.meshgrid(Nr,Nc)
 
-    Greg = src_freq*np.exp(1j*2*np.pi*(-shifts[0]*1.*Nr/nr-shifts[1]*1.*Nc/nc))
-    Greg = Greg.dot(np.exp(1j*diffphase))
+    Greg = src_freq*np.exp(1j*2*np.pi*(-shifts[0]*1.*Nr/nr-shifts[1]*1.*Nc/nc)).astype(src_freq.dtype)
+    Greg = Greg.dot(np.exp(1j*diffphase).astype(Greg.dtype))
     Greg = np.dstack([np.real(Greg),np.imag(Greg)])
     new_img = ifftn(Greg)[:,:,0]
     if border_nan:  
@@ -1468,6 +1495,260 @@ def apply_shifts_dft(src_freq, shifts, diffphase, is_freq = True, border_nan = F
     return new_img
 
 
+#%%
+def _fft2(a):
+    """ FFT over the last two axes, single precision inputs give single precision outputs"""
+    return fft_module.fft2(a).astype(np.result_type(a.dtype, np.complex64), copy=False)
+
+
+def _ifft2(a):
+    """ inverse FFT over the last two axes, keeps the precision of the input"""
+    return fft_module.ifft2(a).astype(a.dtype, copy=False)
+
+
+_thread_pools = {}
+
+
+def get_thread_pool(n_threads):
+    """ pool of n_threads threads of the current process, created at the first call and then reused"""
+    key = (os.getpid(), n_threads)
+    if key not in _thread_pools:
+        from multiprocessing.pool import ThreadPool
+        _thread_pools[key] = ThreadPool(n_threads)
+    return _thread_pools[key]
+
+
+def map_chunks(function, n_items, n_threads=1):
+    """
+    apply function to n_threads contiguous slices of range(n_items), concurrently if n_threads > 1
+
+    The heavy work of the functions applied this way (FFTs, OpenCV calls, large NumPy
+    operations) releases the GIL, so the slices are processed in parallel by the threads.
+
+    Returns:
+    --------
+    list of the results of function, one per slice, in order
+    """
+    bounds = np.linspace(0, n_items, min(n_threads, n_items) + 1).astype(np.int)
+    slices = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+    if len(slices) <= 1:
+        return [function(sl) for sl in slices]
+    return get_thread_pool(n_threads).map(function, slices)
+
+
+def _upsampled_dft_batch(data, upsampled_region_size, upsample_factor, axis_offsets):
+    """
+    Upsampled DFT by matrix multiplication of a stack of images, see _upsampled_dft
+
+    Parameters:
+    ----------
+    data : 3D ndarray
+        stack (n x d1 x d2) of DFTs to upsample
+
+    upsampled_region_size : int
+        The size of the region to be sampled
+
+    upsample_factor : int
+        The upsampling factor
+
+    axis_offsets : ndarray
+        n x 2 offsets of the region to be sampled for each image
+
+    Returns:
+    -------
+    output : 3D ndarray
+            The upsampled DFT of the specified region for each image
+    """
+    n, d1, d2 = data.shape
+    region = np.arange(upsampled_region_size)
+    col_kernel = np.exp(
+        (-1j * 2 * np.pi / (d2 * upsample_factor)) *
+        (ifftshift(np.arange(d2)) - np.floor(old_div(d2, 2)))[None, :, None] *
+        (region[None, None, :] - axis_offsets[:, 1, None, None])
+    )
+    row_kernel = np.exp(
+        (-1j * 2 * np.pi / (d1 * upsample_factor)) *
+        (region[None, :, None] - axis_offsets[:, 0, None, None]) *
+        (ifftshift(np.arange(d1)) - np.floor(old_div(d1, 2)))[None, None, :]
+    )
+
+    return np.matmul(np.matmul(row_kernel, data), col_kernel)
+
+
+def _mask_cross_correlation(new_cross_corr, shifts_lb, shifts_ub, max_shifts):
+    """
+    zero (in place) the entries of a stack of cross correlations outside the allowed shifts,
+    see register_translation
+    """
+    if (shifts_lb is not None) or (shifts_ub is not None):
+
+        if (shifts_lb[0] < 0) and (shifts_ub[0] >= 0):
+            new_cross_corr[:, shifts_ub[0]:shifts_lb[0], :] = 0
+        else:
+            new_cross_corr[:, :shifts_lb[0], :] = 0
+            new_cross_corr[:, shifts_ub[0]:, :] = 0
+
+        if (shifts_lb[1] < 0) and (shifts_ub[1] >= 0):
+            new_cross_corr[:, :, shifts_ub[1]:shifts_lb[1]] = 0
+        else:
+            new_cross_corr[:, :, :shifts_lb[1]] = 0
+            new_cross_corr[:, :, shifts_ub[1]:] = 0
+    else:
+
+        new_cross_corr[:, max_shifts[0]:-max_shifts[0], :] = 0
+
+        new_cross_corr[:, :, max_shifts[1]:-max_shifts[1]] = 0
+
+    return new_cross_corr
+
+
+def register_translation_batch(src_images, target_images, upsample_factor=1,
+                               space="real", shifts_lb=None, shifts_ub=None, max_shifts=(10, 10)):
+    """
+    register a stack of images against a stack of references at once
+
+    Same algorithm as register_translation, but all the images (for instance all the
+    patches of a frame) are transformed with a single batched FFT and the subpixel
+    refinement is computed for all the images with batched matrix products.
+
+    Parameters:
+    ----------
+    src_images : ndarray
+        n x d1 x d2 stack of images to register
+
+    target_images : ndarray
+        n x d1 x d2 stack of references (DFTs if space is "fourier")
+
+    upsample_factor : int, optional
+        Upsampling factor. Images will be registered to within
+        ``1 / upsample_factor`` of a pixel.
+
+    space : string, one of "real" or "fourier"
+        Defines how the algorithm interprets input data.
+
+    shifts_lb, shifts_ub: tuples
+        lower and upper bounds of the shifts (common to all the images)
+
+    max_shifts: tuple
+        max shifts in x and y, used when the bounds are not given
+
+    Returns:
+    -------
+    shifts : ndarray
+        n x 2 shifts (in pixels) required to register each image
+
+    src_freq : ndarray
+        n x d1 x d2 DFTs of the images (scaled as in register_translation)
+
+    phasediff : ndarray
+        Global phase difference between each image and its reference
+
+    Raise:
+    ------
+     ValueError("Error: images must really be same size for "
+                         "register_translation_batch")
+    """
+    if src_images.shape != target_images.shape:
+        raise ValueError("Error: images must really be same size for "
+                         "register_translation_batch")
+
+    n, d1, d2 = src_images.shape
+    if space.lower() == 'fourier':
+        src_freq = src_images
+        target_freq = target_images
+    elif space.lower() == 'real':
+        src_freq = old_div(_fft2(src_images), d1 * d2)
+        target_freq = old_div(_fft2(target_images), d1 * d2)
+    else:
+        raise ValueError("Error: register_translation_batch only knows the \"real\" "
+                         "and \"fourier\" values for the ``space`` argument.")
+
+    # Whole-pixel shift - Compute cross-correlation by an IFFT
+    image_product = src_freq * target_freq.conj()
+    cross_correlation = _ifft2(image_product)
+
+    # Locate maximum
+    new_cross_corr = _mask_cross_correlation(np.abs(cross_correlation), shifts_lb, shifts_ub, max_shifts)
+    maxima = np.unravel_index(np.argmax(new_cross_corr.reshape(n, -1), axis=1), (d1, d2))
+    shape = np.array([d1, d2])
+    midpoints = np.fix(old_div(shape, 2))
+    shifts = np.stack(maxima, axis=1).astype(np.float64)
+    shifts = np.where(shifts > midpoints, shifts - shape, shifts)
+
+    if upsample_factor == 1:
+        CCmax = cross_correlation.reshape(n, -1).max(axis=1)
+    else:
+        # Initial shift estimate in upsampled grid
+        shifts = old_div(np.round(shifts * upsample_factor), upsample_factor)
+        upsampled_region_size = np.int(np.ceil(upsample_factor * 1.5))
+        # Center of output array at dftshift + 1
+        dftshift = np.fix(old_div(upsampled_region_size, 2.0))
+        normalization = (d1 * d2 * upsample_factor ** 2)
+        # Matrix multiply DFT around the current shift estimate
+        sample_region_offset = dftshift - shifts * upsample_factor
+        # the refinement is always computed in double precision: the differences between
+        # neighboring subpixel shifts are below single precision resolution
+        cross_correlation = _upsampled_dft_batch(image_product.conj().astype(np.complex128), upsampled_region_size,
+                                                 upsample_factor, sample_region_offset).conj()
+        cross_correlation /= normalization
+        # Locate maximum and map back to original pixel grid
+        maxima = np.unravel_index(np.argmax(np.abs(cross_correlation).reshape(n, -1), axis=1),
+                                  cross_correlation.shape[1:])
+        maxima = np.stack(maxima, axis=1) - dftshift
+        shifts = shifts + old_div(maxima, upsample_factor)
+        CCmax = cross_correlation.reshape(n, -1).max(axis=1)
+
+    # If its only one row or column the shift along that dimension has no
+    # effect. We set to zero.
+    shifts[:, shape == 1] = 0
+
+    return shifts, src_freq, _compute_phasediff(CCmax)
+
+
+def apply_shifts_dft_batch(src_freq, shifts, diffphase, is_freq=True, border_nan=False):
+    """
+    apply shifts to a stack of images using inverse dft, see apply_shifts_dft
+
+    Parameters:
+    ----------
+    src_freq: ndarray
+        n x d1 x d2, if is_freq fourier transform of the images else original images
+
+    shifts: ndarray
+        n x 2 shifts to apply
+
+    diffphase: ndarray
+        n phase differences, from the register_translation_batch output
+
+    Returns:
+    -------
+    new_img: ndarray
+        n x d1 x d2 shifted images
+    """
+    n, nc, nr = np.shape(src_freq)
+    if not is_freq:
+        src_freq = old_div(_fft2(src_freq), nc * nr)
+
+    shifts = np.asarray(shifts, dtype=np.float64)[:, ::-1]
+    Nr = ifftshift(np.arange(-np.fix(old_div(nr, 2.)), np.ceil(old_div(nr, 2.))))
+    Nc = ifftshift(np.arange(-np.fix(old_div(nc, 2.)), np.ceil(old_div(nc, 2.))))
+
+    Greg = src_freq * np.exp(1j * 2 * np.pi * (-shifts[:, 0, None, None] * Nr[None, None, :] / nr -
+                                               shifts[:, 1, None, None] * Nc[None, :, None] / nc)).astype(src_freq.dtype)
+    Greg *= np.exp(1j * np.asarray(diffphase))[:, None, None].astype(src_freq.dtype)
+    new_img = _ifft2(Greg).real * (nc * nr)
+    if border_nan:
+        max_h, max_w = np.ceil(np.maximum(0, shifts)).T.astype(np.int)
+        min_h, min_w = np.floor(np.minimum(0, shifts)).T.astype(np.int)
+        rows = np.arange(nc)[None, :]
+        cols = np.arange(nr)[None, :]
+        nan_rows = (rows < max_h[:, None]) | ((min_h[:, None] < 0) & (rows >= nc + min_h[:, None]))
+        nan_cols = (cols < max_w[:, None]) | ((min_w[:, None] < 0) & (cols >= nr + min_w[:, None]))
+        new_img[nan_rows[:, :, None] | nan_cols[:, None, :]] = np.nan
+
+    return new_img
+
+
 #%%
 def sliding_window(image, overlaps, strides):
     """ efficiently and lazily slides a window across the image
@@ -1544,6 +1825,193 @@ def create_weight_matrix_for_blending(img, overlaps, strides):
         yield weight_mat
 
 
+#%%
+def extract_tiles(img, overlaps, strides):
+    """ stack all the patches of the image defined by sliding_window
+
+    Parameters:
+    -----------
+    img: ndarray 2D
+        image to tile
+
+    overlaps, strides: tuples
+        overlaps and strides of the patches
+
+    Returns:
+    --------
+    tiles: ndarray
+        num_tiles x shape[0] x shape[1] stack of patches
+
+    start_step: list
+        top left corner of each patch in the image
+
+    xy_grid: list
+        coordinates of each patch in the patch grid
+    """
+    windows = list(sliding_window(img, overlaps=overlaps, strides=strides))
+    tiles = np.array([it[-1] for it in windows])
+    start_step = [(it[2], it[3]) for it in windows]
+    xy_grid = [(it[0], it[1]) for it in windows]
+    return tiles, start_step, xy_grid
+
+
+def blending_indices(shape, start_step, tile_shape):
+    """ flat indices in an image of the given shape of every pixel of the stacked patches
+
+    Parameters:
+    -----------
+    shape: tuple
+        dimensions of the image
+
+    start_step: list
+        top left corner of each patch, as returned by extract_tiles
+
+    tile_shape: tuple
+        dimensions of the patches
+
+    Returns:
+    --------
+    idx: ndarray
+        num_tiles x tile_shape[0] x tile_shape[1] array of indices
+    """
+    start_step = np.array(start_step)
+    rows = start_step[:, 0, None] + np.arange(tile_shape[0])[None, :]
+    cols = start_step[:, 1, None] + np.arange(tile_shape[1])[None, :]
+    return rows[:, :, None] * shape[1] + cols[:, None, :]
+
+
+def blend_tiles(tiles, weights, idx, shape):
+    """ stitch back together overlapping patches as a weighted average
+
+    NaN entries of the patches (borders left empty by the shifts) do not contribute.
+    All the patches are accumulated at once with np.bincount.
+
+    Parameters:
+    -----------
+    tiles: ndarray
+        num_tiles x d1 x d2 stack of patches
+
+    weights: ndarray
+        num_tiles x d1 x d2 blending weights, see create_weight_matrix_for_blending
+
+    idx: ndarray
+        flat indices of the pixels of the patches, see blending_indices
+
+    shape: tuple
+        dimensions of the image
+
+    Returns:
+    --------
+    new_img: ndarray
+        blended image (NaN where no patch has valid pixels)
+    """
+    valid = ~np.isnan(tiles)
+    weights = weights * valid
+    size = np.prod(shape)
+    normalizer = np.bincount(idx.ravel(), weights=weights.ravel(), minlength=size)
+    new_img = np.bincount(idx.ravel(), weights=(np.where(valid, tiles, 0) * weights).ravel(),
+                          minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_img = old_div(new_img, normalizer)
+    return new_img.reshape(shape).astype(tiles.dtype, copy=False)
+
+
+#%%
+class RegistrationPlan(object):
+    """
+    Quantities of tile_and_correct that depend only on the template and on the patch geometry
+
+    They are computed once and reused for all the frames registered against the same
+    template (for instance all the frames of a tile_and_correct_wrapper chunk): the
+    spectrum of the template and of each template patch, the flat indices of the patches
+    in the frame and the blending weights.
+
+    Parameters:
+    -----------
+    template: ndarray 2D
+        reference image
+
+    strides, overlaps: tuples
+        strides and overlaps of the patches. If strides is None only the rigid
+        quantities are computed
+
+    newoverlaps, newstrides: tuples
+        strides and overlaps of the patches when upsampling the vector fields
+
+    upsample_factor_grid: int
+        used to infer newstrides when not passed
+
+    add_to_movie: float
+        value added to the frames and to the template before registration
+
+    precision: str
+        'float64' or 'float32', precision of the template, of its spectra and of the weights
+
+    Example:
+    --------
+    plan = RegistrationPlan(template, strides, overlaps, add_to_movie=add_to_movie)
+    for img in imgs:
+        new_img, shifts, _, _ = tile_and_correct(img, template, strides, overlaps, max_shifts,
+                                                 add_to_movie=add_to_movie, plan=plan)
+    """
+
+    def __init__(self, template, strides, overlaps, newoverlaps=None, newstrides=None,
+                 upsample_factor_grid=4, add_to_movie=0, precision='float64'):
+
+        self.dtype = np.dtype(precision)
+        self.shape = template.shape
+        self.add_to_movie = add_to_movie
+        self.strides = strides
+        self.overlaps = overlaps
+
+        if strides is not None:
+            if newoverlaps is None:
+                newoverlaps = overlaps
+            if newstrides is None:
+                newstrides = tuple(np.round(np.divide(strides, upsample_factor_grid)).astype(np.int))
+
+            self.newoverlaps = newoverlaps
+            self.newstrides = newstrides
+            self.shapes = tuple(np.add(strides, overlaps))
+            self.newshapes = tuple(np.add(newstrides, newoverlaps))
+
+            _, start_step, xy_grid = extract_tiles(template, overlaps=overlaps, strides=strides)
+            self.dim_grid = tuple(np.add(xy_grid[-1], 1))
+            self.tile_idx = blending_indices(self.shape, start_step, self.shapes)
+
+            _, self.start_step, self.xy_grid = extract_tiles(template, overlaps=newoverlaps, strides=newstrides)
+            self.dim_new_grid = tuple(np.add(self.xy_grid[-1], 1))
+            self.new_tile_idx = blending_indices(self.shape, self.start_step, self.newshapes)
+            self.weights = np.array(list(create_weight_matrix_for_blending(
+                template, newoverlaps, newstrides)), dtype=self.dtype)
+
+        self.set_template(template)
+
+    def set_template(self, template):
+        """ recompute the quantities that depend on the template, keeping the patch geometry"""
+        if template.shape != self.shape:
+            raise Exception('The registration plan was computed for templates of shape ' + str(self.shape))
+        self.template = template.astype(self.dtype) + self.add_to_movie
+        src_freq = fftn(self.template, flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_SCALE)
+        self.template_freq = src_freq[:, :, 0] + 1j * src_freq[:, :, 1]
+        if self.strides is not None:
+            self.templates_freq = old_div(_fft2(self.template.ravel()[self.tile_idx]), np.prod(self.shapes))
+
+    def check(self, img, strides, overlaps, add_to_movie, max_deviation_rigid, precision):
+        """ raise an exception if the plan cannot be used to register img with the given parameters"""
+        if img.shape != self.shape:
+            raise Exception('The registration plan was computed for frames of shape ' + str(self.shape))
+        if np.dtype(precision) != self.dtype:
+            raise Exception('The registration plan was computed with precision ' + str(self.dtype))
+        if add_to_movie != self.add_to_movie:
+            raise Exception('The registration plan was computed with a different add_to_movie')
+        if self.strides is not None and (tuple(strides) != tuple(self.strides) or
+                                         tuple(overlaps) != tuple(self.overlaps)):
+            raise Exception('The registration plan was computed with different strides or overlaps')
+        if self.strides is None and max_deviation_rigid != 0:
+            raise Exception('The registration plan was computed for rigid registration only')
+
+
 #%%
 def low_pass_filter_space(img_orig,gSig_filt):
     ksize = tuple([(3 * i) // 2 * 2 + 1 for i in gSig_filt])
@@ -1560,7 +2028,8 @@ def low_pass_filter_space(img_orig,gSig_filt):
     return cv2.filter2D(np.array(img_orig,dtype=np.float32),-1,ker2D, borderType=cv2.BORDER_REFLECT)
 #%% 
 def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = None, newstrides = None, upsample_factor_grid=4,
-                upsample_factor_fft=10,show_movie=False,max_deviation_rigid=2,add_to_movie=0, shifts_opencv = False, gSig_filt = None):
+                upsample_factor_fft=10,show_movie=False,max_deviation_rigid=2,add_to_movie=0, shifts_opencv = False, gSig_filt = None,
+                plan = None, precision = 'float64', n_threads = 1):
 
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
@@ -1607,6 +2076,18 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
     filt_sig_size: tuple
         standard deviation and size of gaussian filter to center filter data in case of one photon imaging data
 
+    plan: RegistrationPlan
+        quantities precomputed from the template and the patch geometry. Pass the same plan when
+        correcting many frames against the same template to avoid recomputing them for every frame.
+        If None it is computed from template. When passed, newoverlaps, newstrides and
+        upsample_factor_grid are taken from the plan
+
+    precision: str
+        'float64' or 'float32', precision of the frames, of the FFTs and of the blending
+
+    n_threads: int
+        number of threads registering and shifting the patches of the frame concurrently
+
 
     """
     
@@ -1615,8 +2096,16 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
 #        raise Exception('When gSig_filt or gSiz_filt are used add_to_movie must be zero!')
     
         
-    img = img.astype(np.float64).copy()
-    template = template.astype(np.float64).copy()
+    if plan is None:
+        plan = RegistrationPlan(template, strides if max_deviation_rigid != 0 else None, overlaps,
+                                newoverlaps=newoverlaps, newstrides=newstrides,
+                                upsample_factor_grid=upsample_factor_grid, add_to_movie=add_to_movie,
+                                precision=precision)
+    else:
+        plan.check(img, strides, overlaps, add_to_movie, max_deviation_rigid, precision)
+
+    img = img.astype(plan.dtype)
+    template = plan.template
     
     if gSig_filt is not None:   
         
@@ -1630,11 +2119,13 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
                             
     
     img = img + add_to_movie
-    template = template + add_to_movie
     
     
     # compute rigid shifts
-    rigid_shts,sfr_freq,diffphase = register_translation(img,template,upsample_factor=upsample_factor_fft,max_shifts=max_shifts)
+    sfr_freq = fftn(img,flags=cv2.DFT_COMPLEX_OUTPUT+cv2.DFT_SCALE)
+    sfr_freq = sfr_freq[:,:,0]+1j*sfr_freq[:,:,1]
+    rigid_shts,sfr_freq,diffphase = register_translation(sfr_freq,plan.template_freq,upsample_factor=upsample_factor_fft,
+                                                         space='fourier',max_shifts=max_shifts)
     
     if max_deviation_rigid == 0:
         
@@ -1656,11 +2147,8 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
         return new_img-add_to_movie, (-rigid_shts[0],-rigid_shts[1]), None, None
     else:
         # extract patches
-        templates = [it[-1] for it in sliding_window(template,overlaps=overlaps,strides = strides)]
-        xy_grid = [(it[0],it[1]) for it in sliding_window(template,overlaps=overlaps,strides = strides)]
-        num_tiles = np.prod(np.add(xy_grid[-1],1))
-        imgs = [it[-1] for it in sliding_window(img,overlaps=overlaps,strides = strides)]
-        dim_grid = tuple(np.add(xy_grid[-1],1))
+        imgs = img.ravel()[plan.tile_idx]
+        dim_grid = plan.dim_grid
 
         if max_deviation_rigid is not None:
 
@@ -1672,33 +2160,32 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
             lb_shifts = None
             ub_shifts = None
 
-        #extract shifts for each patch
-        shfts_et_all = [register_translation(
-            a,b,c, shifts_lb = lb_shifts, shifts_ub = ub_shifts, max_shifts = max_shifts) for a, b, c in zip (
-            imgs,templates,[upsample_factor_fft]*num_tiles)]
-        shfts = [sshh[0] for sshh in shfts_et_all]
-        diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        #extract shifts for all patches at once, or for n_threads groups of patches concurrently
+        def register_patches(sl):
+            return register_translation_batch(
+                old_div(_fft2(imgs[sl]), np.prod(plan.shapes)), plan.templates_freq[sl], upsample_factor_fft,
+                space = 'fourier', shifts_lb = lb_shifts, shifts_ub = ub_shifts, max_shifts = max_shifts)
 
-        # create a vector field
-        shift_img_x = np.reshape(np.array(shfts)[:,0],dim_grid)
-        shift_img_y = np.reshape(np.array(shfts)[:,1],dim_grid)
-        diffs_phase_grid = np.reshape(np.array(diffs_phase),dim_grid)
+        res = map_chunks(register_patches, len(imgs), n_threads)
+        shfts = np.concatenate([rr[0] for rr in res])
+        diffs_phase = np.concatenate([rr[2] for rr in res])
 
-        # create automatically upsample parameters if not passed
-        if newoverlaps is None:
-            newoverlaps = overlaps
-        if newstrides is None:
-            newstrides = tuple(np.round(np.divide(strides,upsample_factor_grid)).astype(np.int))
-
-        newshapes = np.add(newstrides ,newoverlaps)
+        # create a vector field
+        shift_img_x = np.reshape(shfts[:,0],dim_grid)
+        shift_img_y = np.reshape(shfts[:,1],dim_grid)
+        diffs_phase_grid = np.reshape(diffs_phase,dim_grid)
 
-        imgs = [it[-1] for it in sliding_window(img,overlaps=newoverlaps,strides = newstrides)  ]
+        newoverlaps = plan.newoverlaps
+        newshapes = plan.newshapes
+        start_step = plan.start_step
+        xy_grid = plan.xy_grid
 
-        xy_grid = [(it[0],it[1]) for it in sliding_window(img,overlaps=newoverlaps,strides = newstrides)]
+        if shifts_opencv and gSig_filt is not None:
+            img = img_orig
 
-        start_step = [(it[2],it[3]) for it in sliding_window(img,overlaps=newoverlaps,strides = newstrides)]
+        imgs = img.ravel()[plan.new_tile_idx]
 
-        dim_new_grid = tuple(np.add(xy_grid[-1],1))
+        dim_new_grid = plan.dim_new_grid
 
         shift_img_x = cv2.resize(shift_img_x,dim_new_grid[::-1],interpolation = cv2.INTER_CUBIC)
         shift_img_y = cv2.resize(shift_img_y,dim_new_grid[::-1],interpolation = cv2.INTER_CUBIC)
@@ -1711,43 +2198,32 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
                 [shift_img_x,shift_img_y],[0,1])],75)
 
         total_shifts = [(-x,-y) for x,y in zip(shift_img_x.reshape(num_tiles),shift_img_y.reshape(num_tiles))]
-        total_diffs_phase = [dfs for dfs in diffs_phase_grid_us.reshape(num_tiles)]
         if shifts_opencv:
-            if gSig_filt is not None:
-                img = img_orig
-                imgs = [it[-1] for it in sliding_window(img,overlaps=newoverlaps,strides = newstrides)  ]
-                
-            imgs = [apply_shift_iteration(im,sh,border_nan=True) for im,sh in zip(imgs, total_shifts)]
+            def shift_patches(sl):
+                return [apply_shift_iteration(im,sh,border_nan=True) for im,sh in zip(imgs[sl], total_shifts[sl])]
+
+            imgs = np.array(list(itertools.chain.from_iterable(map_chunks(shift_patches, num_tiles, n_threads))))
 
         else:
             if gSig_filt is not None:
                 raise Exception('The use of FFT and filtering options have not been tested. Set opencv=True')
-                
-            imgs = [apply_shifts_dft(im,(
-                sh[0],sh[1]),dffphs, is_freq = False, border_nan=True)  for im,sh,dffphs in zip(
-                imgs, total_shifts,total_diffs_phase) ]
 
-        normalizer = np.zeros_like(img)*np.nan
-        new_img = np.zeros_like(img)*np.nan
+            total_diffs_phase = diffs_phase_grid_us.reshape(num_tiles)
 
-        weight_matrix = create_weight_matrix_for_blending(img, newoverlaps, newstrides)
-
-        if max_shear < 0.5:
-            for (x,y),(_,_),im,(_,_),weight_mat in zip(start_step,xy_grid,imgs,total_shifts,weight_matrix):
+            def shift_patches(sl):
+                return apply_shifts_dft_batch(imgs[sl], total_shifts[sl], total_diffs_phase[sl],
+                                              is_freq = False, border_nan=True)
 
-                prev_val_1 = normalizer[x:x + newshapes[0],y:y + newshapes[1]]
+            imgs = np.concatenate(map_chunks(shift_patches, num_tiles, n_threads))
 
-                normalizer[x:x + newshapes[0],y:y + newshapes[1]] = np.nansum(np.dstack([~np.isnan(im)*1*weight_mat,prev_val_1]),-1)
-                prev_val = new_img[x:x + newshapes[0],y:y + newshapes[1]]
-                new_img[x:x + newshapes[0],y:y + newshapes[1]] = np.nansum(np.dstack([im*weight_mat,prev_val]),-1)
-
-
-            new_img = old_div(new_img,normalizer)
+        if max_shear < 0.5:
+            new_img = blend_tiles(imgs, plan.weights, plan.new_tile_idx, img.shape)
 
         else: # in case the difference in shift between neighboring patches is larger than 0.5 pixels we do not interpolate in the overlaping area
+            new_img = np.zeros_like(img)*np.nan
             half_overlap_x = np.int(newoverlaps[0]/2)
             half_overlap_y = np.int(newoverlaps[1]/2)
-            for (x,y),(idx_0,idx_1),im,(_,_),weight_mat in zip(start_step,xy_grid,imgs,total_shifts,weight_matrix):
+            for (x,y),(idx_0,idx_1),im in zip(start_step,xy_grid,imgs):
 
                 if idx_0 == 0:
                     x_start = x
@@ -1779,6 +2255,173 @@ def tile_and_correct(img,template, strides, overlaps,max_shifts, newoverlaps = N
             except:
                 pass
         return new_img-add_to_movie, total_shifts,start_step,xy_grid
+#%%
+class OnlineMotionCorrector(object):
+    """
+    Frame by frame motion correction with a rolling template, for real time (closed loop) experiments
+
+    Every frame is registered with tile_and_correct against a RegistrationPlan built from the
+    current template, so the cost per frame is that of transforming the frame only. Corrected
+    frames are averaged into the template during the first init_frames_template frames; afterwards
+    the template is the median of the means of the last buffer_size_template groups of
+    update_template_every frames, as in motion_correct_online. The latency of each call of
+    fit_next is recorded in a ring buffer.
+
+    Parameters:
+    -----------
+    template: ndarray 2D
+        initial template. If None the first frame is used
+
+    max_shifts: tuple
+        maximum allowed rigid shifts
+
+    strides, overlaps: tuples
+        patches for piecewise rigid correction. If strides is None the correction is rigid
+
+    max_deviation_rigid: int
+        maximum deviation allowed for patch with respect to rigid shift
+
+    upsample_factor_grid: int
+        upsample factor of shifts per patches to avoid smearing when merging patches
+
+    upsample_factor_fft: int
+        resolution of fractional shifts
+
+    add_to_movie: float
+        value added to the frames so that they are mostly positive
+
+    shifts_opencv: bool
+        apply shifts with opencv (faster) instead of the FFT
+
+    precision: str
+        'float32' or 'float64', see MotionCorrect
+
+    init_frames_template: int
+        number of frames averaged into the template before switching to the rolling update
+
+    update_template_every: int
+        number of frames between template updates
+
+    buffer_size_template: int
+        number of means of update_template_every frames the template is the median of
+
+    latency_buffer_size: int
+        number of latencies kept to compute the statistics
+
+    n_threads: int
+        number of threads correcting the patches of a frame concurrently
+
+    Example:
+    --------
+    omc = OnlineMotionCorrector(max_shifts=(10, 10), strides=(96, 96), overlaps=(32, 32))
+    for frame in frames:
+        corrected, shifts = omc.fit_next(frame)
+    print(omc.latency_stats())
+    """
+
+    def __init__(self, template=None, max_shifts=(6, 6), strides=None, overlaps=None, max_deviation_rigid=3,
+                 upsample_factor_grid=4, upsample_factor_fft=10, add_to_movie=0, shifts_opencv=True,
+                 precision='float32', init_frames_template=100, update_template_every=100,
+                 buffer_size_template=10, latency_buffer_size=1000, n_threads=1):
+
+        self.max_shifts = max_shifts
+        self.strides = strides
+        self.overlaps = overlaps
+        self.max_deviation_rigid = max_deviation_rigid if strides is not None else 0
+        self.upsample_factor_grid = upsample_factor_grid
+        self.upsample_factor_fft = upsample_factor_fft
+        self.add_to_movie = add_to_movie
+        self.shifts_opencv = shifts_opencv
+        self.precision = precision
+        self.n_threads = n_threads
+        self.init_frames_template = init_frames_template
+        self.update_template_every = update_template_every
+        self.buffer_templates = collections.deque(maxlen=buffer_size_template)
+        self.latencies = collections.deque(maxlen=latency_buffer_size)
+        self.frames_processed = 0
+        self.template = None
+        self.plan = None
+        self.frames_sum = None
+        self.frames_count = 0
+        if template is not None:
+            self.set_template(template)
+
+    def set_template(self, template):
+        """ replace the template, the patch geometry of the registration plan is computed only once"""
+        self.template = np.array(template, dtype=np.dtype(self.precision))
+        if self.plan is None:
+            self.plan = RegistrationPlan(self.template, self.strides, self.overlaps,
+                                         upsample_factor_grid=self.upsample_factor_grid,
+                                         add_to_movie=self.add_to_movie, precision=self.precision)
+        else:
+            self.plan.set_template(self.template)
+
+    def fit_next(self, frame):
+        """
+        motion correct one frame and update the template
+
+        Parameters:
+        -----------
+        frame: ndarray 2D
+            frame to correct
+
+        Returns:
+        --------
+        corrected: ndarray 2D
+            motion corrected frame (NaN at the borders left empty by the shifts in pw-rigid mode)
+
+        shifts: tuple or list
+            rigid shifts, or list of shifts of each patch in pw-rigid mode
+        """
+        t_start = default_timer()
+        if self.template is None:
+            self.set_template(frame)
+
+        corrected, shifts, _, _ = tile_and_correct(
+            frame, self.template, self.strides, self.overlaps, self.max_shifts,
+            upsample_factor_grid=self.upsample_factor_grid, upsample_factor_fft=self.upsample_factor_fft,
+            max_deviation_rigid=self.max_deviation_rigid, add_to_movie=self.add_to_movie,
+            shifts_opencv=self.shifts_opencv, plan=self.plan, precision=self.precision, n_threads=self.n_threads)
+
+        self._update_template(corrected)
+        self.frames_processed += 1
+        self.latencies.append(default_timer() - t_start)
+        return corrected, shifts
+
+    def _update_template(self, corrected):
+        # borders left empty by the shifts keep the values of the template
+        corrected = np.where(np.isnan(corrected), self.template, corrected)
+        if self.frames_processed < self.init_frames_template:
+            self.template = self.template + old_div(corrected - self.template, self.frames_processed + 1)
+            self.set_template(self.template)
+            return
+
+        if self.frames_sum is None:
+            self.frames_sum = np.zeros_like(corrected)
+        self.frames_sum += corrected
+        self.frames_count += 1
+        if self.frames_count == self.update_template_every:
+            self.buffer_templates.append(old_div(self.frames_sum, self.frames_count))
+            self.frames_sum[:] = 0
+            self.frames_count = 0
+            self.set_template(np.median(self.buffer_templates, 0))
+
+    def latency_stats(self):
+        """
+        statistics of the latency of the last calls of fit_next
+
+        Returns:
+        --------
+        stats: dict
+            number of frames, mean, median, 95th and 99th percentiles and maximum latency in ms
+        """
+        if len(self.latencies) == 0:
+            return {'n_frames': 0}
+        lat = np.array(self.latencies) * 1000
+        return {'n_frames': len(lat), 'mean_ms': np.mean(lat), 'median_ms': np.median(lat),
+                'p95_ms': np.percentile(lat, 95), 'p99_ms': np.percentile(lat, 99), 'max_ms': np.max(lat)}
+
+
 #%%
 def compute_flow_single_frame(frame,templ,pyr_scale = .5,levels = 3, winsize = 100, iterations = 15, poly_n = 5,
                               poly_sigma = 1.2/5, flags = 0):
@@ -1874,7 +2517,8 @@ def compute_metrics_motion_correction(fname,final_size_x,final_size_y, swap_dim,
 #%%
 def motion_correct_batch_rigid(fname, max_shifts, dview = None, splits = 56 ,num_splits_to_process = None, num_iter = 1,
                                 template = None, shifts_opencv = False, save_movie_rigid = False, add_to_movie = None,
-                               nonneg_movie = False, gSig_filt = None, subidx=slice(None, None, 1)):
+                               nonneg_movie = False, gSig_filt = None, subidx=slice(None, None, 1), precision = 'float64',
+                               n_threads = 1, resume = False, progress_callback = None):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -1910,6 +2554,15 @@ def motion_correct_batch_rigid(fname, max_shifts, dview = None, splits = 56 ,num
     subidx: slice
         Indices to slice
 
+    precision: str
+        'float64' or 'float32', precision of the registration, see MotionCorrect
+
+    n_threads: int
+        threads per process, see MotionCorrect
+
+    resume, progress_callback:
+        see motion_correction_piecewise
+
     Returns:
     --------    
     fname_tot_rig: str
@@ -1928,16 +2581,16 @@ def motion_correct_batch_rigid(fname, max_shifts, dview = None, splits = 56 ,num
     
     """
     corrected_slicer = slice(subidx.start, subidx.stop, subidx.step*10)
-    m = cm.load(fname,subindices=corrected_slicer)
-    
-    if m.shape[0]<300:
-        m = cm.load(fname,subindices=corrected_slicer)
-    elif m.shape[0]<500:
+    # count the frames before loading, so that only the frames of the template are read
+    n_frames = len(range(*corrected_slicer.indices(cm.mmapping.get_file_size(fname)[1])))
+
+    if n_frames<300:
+        pass
+    elif n_frames<500:
         corrected_slicer = slice(subidx.start, subidx.stop, subidx.step*5)
-        m = cm.load(fname,subindices=corrected_slicer)
     else:
         corrected_slicer = slice(subidx.start, subidx.stop, subidx.step*30)
-        m = cm.load(fname,subindices=corrected_slicer)
+    m = cm.load(fname,subindices=corrected_slicer)
     
     if template is None:   
         if gSig_filt is not None:
@@ -1968,7 +2621,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview = None, splits = 56 ,num
         fname_tot_rig, res_rig = motion_correction_piecewise (fname, splits, strides = None, overlaps = None,
                                 add_to_movie=add_to_movie, template = old_templ, max_shifts = max_shifts, max_deviation_rigid = 0,
                                 dview = dview, save_movie = save_movie ,base_name  = os.path.split(fname)[-1][:-4]+ '_rig_',
-                                num_splits=num_splits_to_process,shifts_opencv=shifts_opencv, nonneg_movie = nonneg_movie, gSig_filt = gSig_filt)
+                                num_splits=num_splits_to_process,shifts_opencv=shifts_opencv, nonneg_movie = nonneg_movie, gSig_filt = gSig_filt,
+                                precision = precision, n_threads = n_threads, resume = resume,
+                                progress_callback = progress_callback)
     
     
     
@@ -1992,7 +2647,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview = None, splits = 56 ,num
 def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_movie, newoverlaps = None,  newstrides = None,
                                              dview = None, upsample_factor_grid = 4, max_deviation_rigid = 3,
                                              splits = 56 ,num_splits_to_process = None, num_iter = 1,
-                                             template = None, shifts_opencv = False, save_movie = False, nonneg_movie = False, gSig_filt = None):
+                                             template = None, shifts_opencv = False, save_movie = False, nonneg_movie = False, gSig_filt = None,
+                                             precision = 'float64', n_threads = 1, resume = False,
+                                             progress_callback = None):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2036,6 +2693,15 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
 
     save_movie_rigid: boolean
          toggle save movie
+
+    precision: str
+        'float64' or 'float32', precision of the registration, see MotionCorrect
+
+    n_threads: int
+        threads per process, see MotionCorrect
+
+    resume, progress_callback:
+        see motion_correction_piecewise
     
     Returns:
     --------    
@@ -2080,7 +2746,9 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                 newoverlaps = newoverlaps, newstrides = newstrides,\
                                 upsample_factor_grid = upsample_factor_grid, order = 'F',dview = dview,save_movie = save_movie,
                                 base_name = os.path.split(fname)[-1][:-4] + '_els_',num_splits=num_splits_to_process,
-                                                            shifts_opencv = shifts_opencv, nonneg_movie = nonneg_movie, gSig_filt = gSig_filt)
+                                                            shifts_opencv = shifts_opencv, nonneg_movie = nonneg_movie, gSig_filt = gSig_filt,
+                                                            precision = precision, n_threads = n_threads, resume = resume,
+                                                            progress_callback = progress_callback)
 
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el ]),-1)    
         if gSig_filt is not None:
@@ -2107,7 +2775,6 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
 def tile_and_correct_wrapper(params):
     #todo todocument
 
-    from skimage.external.tifffile import imread
     import numpy as np
     import cv2
     try:
@@ -2117,17 +2784,14 @@ def tile_and_correct_wrapper(params):
 
     img_name,  out_fname,idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie,max_deviation_rigid,upsample_factor_grid, newoverlaps, newstrides, \
-        shifts_opencv,nonneg_movie, gSig_filt, is_fiji = params
+        shifts_opencv,nonneg_movie, gSig_filt, is_fiji, precision, n_threads = params
 
     import os
 
     name, extension = os.path.splitext(img_name)[:2]
     
     if extension == '.tif' or extension == '.tiff':  # check if tiff file
-        if is_fiji:
-            imgs = imread(img_name)[idxs]
-        else:
-            imgs = imread(img_name, key=idxs)
+        imgs = cm.base.movies.TiffPageReader(img_name)[idxs]
         mc = np.zeros(imgs.shape,dtype = np.float32)
         shift_info = []
     elif extension == '.sbx':  # check if sbx file
@@ -2142,6 +2806,12 @@ def tile_and_correct_wrapper(params):
         imgs = cm.load(img_name,subindices=list(idxs))
         mc = np.zeros(imgs.shape,dtype = np.float32)
         shift_info = []    
+
+    # the template is the same for the whole chunk
+    plan = RegistrationPlan(template, strides if max_deviation_rigid != 0 else None, overlaps,
+                            newoverlaps=newoverlaps, newstrides=newstrides,
+                            upsample_factor_grid=upsample_factor_grid, add_to_movie=add_to_movie,
+                            precision=precision)
     for count, img in enumerate(imgs): 
         if count % 10 == 0:
             print(count)
@@ -2151,7 +2821,8 @@ def tile_and_correct_wrapper(params):
                                                                     upsample_factor_grid= upsample_factor_grid,
                                                                     upsample_factor_fft=10,show_movie=False,
                                                                     max_deviation_rigid=max_deviation_rigid,
-                                                                    shifts_opencv = shifts_opencv, gSig_filt=gSig_filt)
+                                                                    shifts_opencv = shifts_opencv, gSig_filt=gSig_filt,
+                                                                    plan=plan, precision=precision, n_threads=n_threads)
         shift_info.append([total_shift,start_step,xy_grid])
         
     if out_fname is not None:           
@@ -2161,6 +2832,8 @@ def tile_and_correct_wrapper(params):
         else:
             bias = 0
         outv[:,idxs] = np.reshape(mc.astype(np.float32),(len(imgs),-1),order = 'F').T + bias
+        outv.flush()
+        del outv
 
     return shift_info, idxs, np.nanmean(mc,0)
 
@@ -2169,9 +2842,33 @@ def tile_and_correct_wrapper(params):
 def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0, template = None,
                                 max_shifts = (12,12),max_deviation_rigid = 3,newoverlaps = None, newstrides = None,
                                 upsample_factor_grid = 4, order = 'F',dview = None,save_movie= True,
-                                base_name = None, num_splits = None,shifts_opencv= False, nonneg_movie = False, gSig_filt = None):
+                                base_name = None, num_splits = None,shifts_opencv= False, nonneg_movie = False, gSig_filt = None,
+                                precision = 'float64', n_threads = 1, resume = False, progress_callback = None):
     """
+    motion correct the movie in fname split in chunks of frames processed in parallel
+
+    When the movie is saved, the result of each split is stored in split_store_name(fname_tot)
+    as soon as the split is completed, so that an interrupted run can be resumed. The store
+    is deleted once all the splits are completed.
+
+    Parameters:
+    -----------
+    resume: bool
+        if True and the output file and the results of some splits of a run with the same
+        template and parameters exist, only the missing splits are processed
+
+    progress_callback: function
+        called as progress_callback(n_splits_done, n_splits) each time a split is completed
+
+    see tile_and_correct and motion_correct_batch_pwrigid for the other parameters
 
+    Returns:
+    --------
+    fname_tot: str
+        name of the saved memory mapped file (None if the movie is not saved)
+
+    res: list
+        (shift_info, idxs, template) for each split
     """
     #todo todocument
     import os
@@ -2180,13 +2877,10 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
     is_fiji = False
 
     if extension == '.tif' or extension == '.tiff':  # check if tiff file
-        with tifffile.TiffFile(fname) as tf:
-           if len(tf) == 1:  # Fiji-generated TIF
-               is_fiji = True
-               T,d1,d2 = tf[0].shape
-           else:    
-               d1,d2 = tf[0].shape
-               T = len(tf)    
+        # index the pages once here, the workers then read the cached index
+        reader = cm.base.movies.TiffPageReader(fname)
+        is_fiji = reader.n_pages == 1  # Fiji-generated TIF
+        T, d1, d2 = reader.shape
                
     elif extension == '.sbx':  # check if sbx file
          
@@ -2228,30 +2922,123 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
         save_movie = False
         print('**** MOVIE NOT SAVED BECAUSE num_splits is not None ****')
         
+    done = {}
     if save_movie:
        if base_name is None:
            base_name = os.path.split(fname)[1][:-4]
        fname_tot = base_name + '_d1_' + str(dims[0]) + '_d2_' + str(dims[1]) + '_d3_' + str(
            1 if len(dims) == 2 else dims[2]) + '_order_' + str(order) + '_frames_' + str(T) + '_.mmap'
        fname_tot = os.path.join(os.path.split(fname)[0],fname_tot) 
-       np.memmap(fname_tot, mode='w+', dtype=np.float32, shape=shape_mov, order=order)
+       store = split_store_name(fname_tot)
+       key = _split_store_key(idxs, template, [strides, overlaps, max_shifts, add_to_movie, max_deviation_rigid,
+                                               upsample_factor_grid, newoverlaps, newstrides, shifts_opencv,
+                                               nonneg_movie, gSig_filt, precision, order])
+       if resume and os.path.exists(fname_tot):
+           done = load_split_results(store, key)
+           if done:
+               print('** Resuming: ' + str(len(done)) + ' of ' + str(len(idxs)) + ' splits already completed **')
+       if not done:
+           np.memmap(fname_tot, mode='w+', dtype=np.float32, shape=shape_mov, order=order)
+           cm.mmapping.save_memmap_header(fname_tot, dims, T, dtype=np.float32, order=order)
+           init_split_store(store, key)
     else:
         fname_tot = None
     pars = []
-    for idx in idxs:
-      pars.append([fname,fname_tot,idx,shape_mov, template, strides, overlaps, max_shifts, np.array(
+    for num, idx in enumerate(idxs):
+      if num in done:
+          continue
+      pars.append([num, [fname,fname_tot,idx,shape_mov, template, strides, overlaps, max_shifts, np.array(
           add_to_movie,dtype = np.float32),max_deviation_rigid,upsample_factor_grid,
-                   newoverlaps, newstrides, shifts_opencv,nonneg_movie, gSig_filt, is_fiji])
-    
+                   newoverlaps, newstrides, shifts_opencv,nonneg_movie, gSig_filt, is_fiji, precision, n_threads]])
+
+    # results are collected (and stored) split by split as they are completed
     if dview is not None:
         print('** Startting parallel motion correction **')
         if 'multiprocessing' in str(type(dview)):
-            res = dview.map_async(tile_and_correct_wrapper,pars).get(4294967)
+            res_iter = dview.imap_unordered(_numbered_tile_and_correct_wrapper, pars)
         else:
-            res = dview.map_sync(tile_and_correct_wrapper,pars)
-        print('** Finished parallel motion correction **')
+            res_iter = dview.map_async(_numbered_tile_and_correct_wrapper, pars)
     else:
-        res = list(map(tile_and_correct_wrapper,pars))
+        res_iter = map(_numbered_tile_and_correct_wrapper, pars)
+
+    res = [done.get(num) for num in range(len(idxs))]
+    if progress_callback is not None:
+        progress_callback(len(done), len(idxs))
+    for num, rr in res_iter:
+        if fname_tot is not None:
+            save_split_result(store, num, rr)
+        res[num] = rr
+        done[num] = True
+        if progress_callback is not None:
+            progress_callback(len(done), len(idxs))
+
+    if fname_tot is not None and len(done) == len(idxs):
+        shutil.rmtree(store, ignore_errors=True)
+
+    if dview is not None:
+        print('** Finished parallel motion correction **')
 
+    return fname_tot, res
 
-    return fname_tot, res   
+
+#%%
+def _numbered_tile_and_correct_wrapper(args):
+    num, params = args
+    return num, tile_and_correct_wrapper(params)
+
+
+def split_store_name(fname_tot):
+    """ directory where motion_correction_piecewise stores the result of each split of fname_tot"""
+    return fname_tot + '.splits'
+
+
+def _split_store_key(idxs, template, params):
+    """ crc32 identifying the splits, the template and the parameters of a run"""
+    key = zlib.crc32(np.ascontiguousarray(template, dtype=np.float64).tobytes())
+    key = zlib.crc32(str(params).encode('utf-8'), key)
+    bounds = np.array([[idx[0], idx[-1], len(idx)] for idx in idxs], dtype=np.int64)
+    return zlib.crc32(bounds.tobytes(), key) & 0xffffffff
+
+
+def init_split_store(store, key):
+    """ create (or empty) the store of the results of the splits of a run identified by key"""
+    if not os.path.exists(store):
+        os.makedirs(store)
+    for fn in os.listdir(store):
+        if fn.startswith('split_'):
+            os.remove(os.path.join(store, fn))
+    with open(os.path.join(store, 'key.json'), 'w') as f:
+        json.dump({'key': key}, f)
+
+
+def save_split_result(store, num, result):
+    """ store the result of split num. The file is renamed once complete, so it is never partially written"""
+    fname = os.path.join(store, 'split_' + str(num) + '.pkl')
+    with open(fname + '.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=2)
+    if os.path.exists(fname):
+        os.remove(fname)
+    os.rename(fname + '.tmp', fname)
+
+
+def load_split_results(store, key):
+    """
+    results of the completed splits of the run identified by key
+
+    Returns:
+    --------
+    results: dict
+        split number -> (shift_info, idxs, template), empty if the store belongs to another run
+    """
+    results = {}
+    fname_key = os.path.join(store, 'key.json')
+    if not os.path.exists(fname_key):
+        return results
+    with open(fname_key, 'r') as f:
+        if json.load(f)['key'] != key:
+            return results
+    for fn in os.listdir(store):
+        if fn.startswith('split_') and fn.endswith('.pkl'):
+            with open(os.path.join(store, fn), 'rb') as f:
+                results[int(fn[len('split_'):-len('.pkl')])] = pickle.load(f)
+    return results
@@ -27,19 +27,21 @@ from __future__ import print_function
 from builtins import str
 from builtins import object
 import numpy as np
+import copy
 from .utilities import CNMFSetParms, update_order, normalize_AC, compute_residuals
 from .pre_processing import preprocess_data
 from .initialization import initialize_components, imblur
 from .merging import merge_components
 from .spatial import update_spatial_components
 from .temporal import update_temporal_components
-from .map_reduce import run_CNMF_patches
-from .oasis import OASIS
+from .map_reduce import run_CNMF_patches, fit_patch
+from .oasis import OASIS, OASISBank
 import caiman
-from caiman import components_evaluation, mmapping
+from caiman import components_evaluation, mmapping, cluster
 import cv2
 from .online_cnmf import RingBuffer, HALS4activity, demix_and_deconvolve
 from .online_cnmf import init_shapes_and_sufficient_stats, update_shapes, update_num_components
+from .online_cnmf import suff_stats_support, update_suff_stats, update_AtA, StageTimer
 import scipy
 import psutil
 import pylab as pl
@@ -86,7 +88,8 @@ class CNMF(object):
                  min_corr=.85, min_pnr=20, deconvolve_options_init=None, ring_size_factor=1.5,
 				 center_psf=False,  use_dense=True, deconv_flag = True,
                  simultaneously=False, n_refit=0, del_duplicates=False, N_samples_exceptionality = 5,
-                 max_num_added = 1, min_num_trial = 2):
+                 max_num_added = 1, min_num_trial = 2, shared_memory = False, stage_timing = 0,
+                 max_memory = None):
 
         """
         Constructor of the CNMF method
@@ -147,7 +150,8 @@ class CNMF(object):
 
         memory_fact: float
             unitless number accounting how much memory should be used. You will
-             need to try different values to see which one would work the default is OK for a 16 GB system
+             need to try different values to see which one would work the default is OK for a 16 GB system.
+             If None it is chosen by the resource planner (see max_memory)
 
         N_samples_fitness: int 
             number of samples over which exceptional events are computed (See utilities.evaluate_components)
@@ -161,13 +165,16 @@ class CNMF(object):
             PLoS Comput Biol. 2017; 13(3):e1005423.
         
         n_pixels_per_process: int. 
-            Number of pixels to be processed in parallel per core (no patch mode). Decrease if memory problems
+            Number of pixels to be processed in parallel per core (no patch mode). Decrease if memory problems.
+            If None it is chosen by the resource planner (see max_memory)
         
         block_size: int. 
-            Number of pixels to be used to perform residual computation in blocks. Decrease if memory problems
+            Number of pixels to be used to perform residual computation in blocks. Decrease if memory problems.
+            If None it is chosen by the resource planner (see max_memory)
             
         num_blocks_per_run: int
-            In case of memory problems you can reduce this numbers, controlling the number of blocks processed in parallel during residual computing
+            In case of memory problems you can reduce this numbers, controlling the number of blocks processed in parallel during residual computing.
+            If None it is chosen by the resource planner (see max_memory)
         
         check_nan: Boolean. 
             Check if file contains NaNs (costly for very large files so could be turned off)
@@ -240,6 +247,21 @@ class CNMF(object):
         
         min_num_trial : int, optional
             minimum numbers of attempts to include a new components in OnACID
+
+        shared_memory : bool, optional
+            If True the patches are staged in shared memory before being dispatched
+            to the workers, so that overlapping pixels are read only once (see map_reduce.run_CNMF_patches)
+
+        stage_timing : int, optional
+            If positive, fit_next records the duration of each of its stages for the last
+            stage_timing frames in self.stage_timer (see online_cnmf.StageTimer)
+
+        max_memory : float, optional
+            memory ceiling in GB used by fit to choose the parameters left to None among
+            n_pixels_per_process, block_size, num_blocks_per_run and memory_fact (the patch
+            size rf and stride are reduced if a patch does not fit). The footprint of the
+            stages is measured on a small slice of the movie, the plan is stored in
+            self.resource_plan (see cluster.plan_resources). By default 80% of the available memory
 			
         Returns:
         --------
@@ -320,6 +342,10 @@ class CNMF(object):
         self.center_psf = center_psf
         self.nb_patch = nb_patch
         self.del_duplicates = del_duplicates
+        self.shared_memory = shared_memory
+        self.stage_timing = stage_timing
+        self.max_memory = max_memory
+        self.resource_plan = None
 
         self.options = CNMFSetParms((1,1,1), n_processes, p=p, gSig=gSig, gSiz=gSiz, 
 									K=k, ssub=ssub, tsub=tsub, 
@@ -385,12 +411,9 @@ class CNMF(object):
         self.options['spatial_params']['ss'] = np.ones((3,) * len(dims), dtype=np.uint8)
 
         print(('using ' + str(self.n_processes) + ' processes'))
-        if self.n_pixels_per_process is None:
-            avail_memory_per_process = psutil.virtual_memory()[1] / 2.**30 / self.n_processes
-            mem_per_pix = 3.6977678498329843e-09
-            self.n_pixels_per_process = np.int(avail_memory_per_process / 8. / mem_per_pix / T)
-            self.n_pixels_per_process = np.int(np.minimum(
-                self.n_pixels_per_process, np.prod(dims) // self.n_processes))
+        if self.n_pixels_per_process is None or self.block_size is None or \
+                self.num_blocks_per_run is None or (self.rf is not None and self.memory_fact is None):
+            self.plan_resources(Yr, dims)
         self.options['preprocess_params']['n_pixels_per_process'] = self.n_pixels_per_process
         self.options['spatial_params']['n_pixels_per_process'] = self.n_pixels_per_process
 
@@ -422,7 +445,7 @@ class CNMF(object):
                     options['init_params']['alpha_snmf'] = self.alpha_snmf
 
                 self.Ain, self.Cin, self.b_in, self.f_in, center = initialize_components(
-                    Y, sn = sn, options_total = options, **options['init_params'])
+                    Y, sn = sn, options_total = options, dview = self.dview, **options['init_params'])
 
             if self.only_init:  # only return values after initialization
                 
@@ -527,7 +550,7 @@ class CNMF(object):
                 dview=self.dview, memory_fact=self.memory_fact, 
 				gnb=self.gnb, border_pix=self.border_pix,
                 low_rank_background=self.low_rank_background,
-                del_duplicates=self.del_duplicates)
+                del_duplicates=self.del_duplicates, shared_memory=self.shared_memory)
 
             # options = CNMFSetParms(Y, self.n_processes, p=self.p, gSig=self.gSig, K=A.shape[
             #                        -1], thr=self.merge_thresh, n_pixels_per_process=self.n_pixels_per_process,
@@ -694,7 +717,7 @@ class CNMF(object):
             else:
                 use_L1 = False
                 
-            self.OASISinstances = [OASIS(            
+            self.OASISinstances = OASISBank([OASIS(
                 g = np.ravel(0.01) if self.p == 0 else (np.ravel(g)[0] if g is not None else gam[0]),
                 lam=0 if not use_L1 else (l if lam is None else lam),
                 # if no explicit value for s_min,  use thresh_s_min * noise estimate * sqrt(1-gamma)
@@ -703,7 +726,7 @@ class CNMF(object):
                                          (self.thresh_s_min * sn * np.sqrt(1 - np.sum(gam))))),
                 b=b if bl is None else bl,
                 g2=0 if self.p < 2 else (np.ravel(g)[1] if g is not None else gam[1]))
-                for gam, l, b, sn in zip(self.g2, self.lam2, self.bl2, self.neurons_sn2)]
+                for gam, l, b, sn in zip(self.g2, self.lam2, self.bl2, self.neurons_sn2)])
 
             for i, o in enumerate(self.OASISinstances):
                 o.fit(self.noisyC[i + self.gnb, :self.initbatch])
@@ -744,6 +767,7 @@ class CNMF(object):
         self.rho_buf = np.reshape(self.rho_buf, (self.dims2[0] * self.dims2[1], -1)).T
         self.rho_buf = RingBuffer(self.rho_buf, self.minibatch_shape)
         self.AtA = (self.Ab.T.dot(self.Ab)).toarray()
+        self.suff_stat_support = None
         self.AtY_buf = self.Ab.T.dot(self.Yr_buf.T)
         self.sv = np.sum(self.rho_buf.get_last_frames(min(self.initbatch, self.minibatch_shape) - 1), 0)
         self.groups = list(map(list, update_order(self.Ab)[0]))
@@ -753,8 +777,68 @@ class CNMF(object):
         for nneeuu in range(self.N):
             self.time_neuron_added.append((nneeuu, self.initbatch))
         self.time_spend = 0
+        self.stage_timer = StageTimer(buffer_size=self.stage_timing) \
+            if getattr(self, 'stage_timing', 0) else None
         return self
 
+    def _get_suff_stat_support(self):
+        # block-sparse index of CY, rebuilt whenever components are added or removed
+        if self.suff_stat_support is None or len(self.suff_stat_support[2]) != self.N + 1:
+            self.suff_stat_support = suff_stats_support(self.ind_A, self.gnb, self.CY.shape[1])
+        return self.suff_stat_support
+
+    def plan_resources(self, Yr, dims):
+        """
+        Choose the parameters of fit left to None from the memory footprint of the pipeline,
+        measured on a small slice of the movie, and the memory ceiling max_memory
+
+        Parameters:
+        ----------
+        Yr: np.ndarray or memory mapped ndarray
+            movie, pixels x time
+
+        dims: tuple
+            dimensions of the field of view
+
+        Returns:
+        --------
+        plan: dict
+            see cluster.plan_resources, also stored in self.resource_plan
+        """
+        stages = cluster.default_calibration_stages()
+        if self.rf is not None and self.memory_fact is None:
+            # footprint of CNMF run on a whole patch, as done by each worker in run_CNMF_patches
+            options = copy.deepcopy(self.options)
+            options['patch_params']['only_init'] = self.only_init
+
+            def patch_stage(Y, shape):
+                options['preprocess_params']['n_pixels_per_process'] = len(Y)
+                options['temporal_params']['block_size'] = len(Y)
+                return fit_patch(np.reshape(Y.T, (-1,) + shape, order='F'), options)
+            stages['patch'] = patch_stage
+
+        print('measuring the memory footprint ...')
+        coefs = cluster.calibrate_memory(Yr, dims, stages)
+        plan = cluster.plan_resources(
+            dims, Yr.shape[-1], coefs, max_memory=self.max_memory, n_processes=self.n_processes,
+            rf=self.rf if self.memory_fact is None else None, stride=self.stride)
+
+        if self.n_pixels_per_process is None:
+            self.n_pixels_per_process = plan['n_pixels_per_process']
+        if self.block_size is None:
+            self.block_size = plan['block_size']
+        if self.num_blocks_per_run is None:
+            self.num_blocks_per_run = plan['num_blocks_per_run']
+        if self.rf is not None and self.memory_fact is None:
+            self.rf, self.stride, self.memory_fact = plan['rf'], plan['stride'], plan['memory_fact']
+        if plan['n_processes'] < self.n_processes:
+            print(('WARNING: only ' + str(plan['n_processes']) + ' processes fit in ' +
+                   str(plan['max_memory']) + ' GB'))
+
+        self.resource_plan = plan
+        print(('resource plan: ' + str(plan)))
+        return plan
+
     @profile
     def fit_next(self, t, frame_in, num_iters_hals=3):
         """
@@ -775,6 +859,9 @@ class CNMF(object):
         """
 
         t_start = time()
+        timer = getattr(self, 'stage_timer', None)
+        if timer is not None:
+            timer.start(t, self.N)
 
         # locally scoped variables for brevity of code and faster look up
         nb_ = self.gnb
@@ -789,12 +876,14 @@ class CNMF(object):
             C_in = self.noisyC[:self.M, t - 1].copy()
             self.C_on[:self.M, t], self.noisyC[:self.M, t] = HALS4activity(
                 frame, self.Ab, C_in, self.AtA, iters=num_iters_hals, groups=self.groups)
+            if timer is not None:
+                timer.lap('hals')
             if self.p:
-            # denoise & deconvolve
-                for i, o in enumerate(self.OASISinstances):
-                    o.fit_next(self.noisyC[nb_ + i, t])
-                    self.C_on[nb_ + i, t - o.get_l_of_last_pool() + 1: t + 1] = o.get_c_of_last_pool()
-                
+                # denoise & deconvolve all neurons at once, writes the changed part of C_on
+                self.OASISinstances.fit_next(self.noisyC[nb_:self.M, t], self.C_on[nb_:self.M], t)
+                if timer is not None:
+                    timer.lap('oasis')
+
         else:
             # update buffer, initialize C with previous value
             self.C_on[:, t] = self.C_on[:, t - 1]
@@ -808,8 +897,11 @@ class CNMF(object):
                 self.noisyC[:self.M, t + 1 - mbs:t + 1],
                 self.AtY_buf, self.AtA, self.OASISinstances, iters=num_iters_hals,
                 n_refit=self.n_refit)
-            for i, o in enumerate(self.OASISinstances):
-                self.C_on[nb_ + i, t - o.get_l_of_last_pool() + 1: t + 1] = o.get_c_of_last_pool()
+            if timer is not None:  # OASIS runs within the demixing iterations
+                timer.lap('hals')
+            self.OASISinstances.write_last_pools(self.C_on[nb_:self.M], t)
+            if timer is not None:
+                timer.lap('oasis')
 
 
 #        cv2.imshow('untitled', 3*cv2.resize(self.Ab.sum(1).reshape(self.dims,order = 'F'),(512,512)))
@@ -828,6 +920,8 @@ class CNMF(object):
             rho = imblur(res_frame, sig=self.gSig, siz=self.gSiz, nDimBlur=2)**2
             rho = np.reshape(rho, np.prod(self.dims2))
             self.rho_buf.append(rho)
+            if timer is not None:
+                timer.lap('residual')
 
             self.Ab, Cf_temp, self.Yres_buf, self.rhos_buf, self.CC, self.CY, self.ind_A, self.sv, self.groups = update_num_components(
                 t, self.sv, self.Ab, self.C_on[:self.M, (t - mbs + 1):(t + 1)],
@@ -863,7 +957,8 @@ class CNMF(object):
                     print('Increasing number of expected components to:' +
                           str(self.expected_comps))
                 self.update_counter.resize(self.N)
-                self.AtA = (Ab_.T.dot(Ab_)).toarray()
+                self.AtA = update_AtA(self.AtA, Ab_, [])
+                self.suff_stat_support = None
 
                 self.noisyC[self.M - num_added:self.M, t - mbs +
                             1:t + 1] = Cf_temp[self.M - num_added:self.M]
@@ -894,6 +989,8 @@ class CNMF(object):
                     idx_overlap = Ab_.T.dot(
                         Ab_[:, -num_added:])[nb_:-num_added].nonzero()[0]
                 self.update_counter[idx_overlap] = 0
+            if timer is not None:
+                timer.lap('update_num_components')
 
         if (t - self.initbatch) % mbs == mbs - 1 and\
                 self.batch_update_suff_stat:
@@ -907,23 +1004,17 @@ class CNMF(object):
             t0 = 0 * self.initbatch
             w1 = (t - n0 + t0) * 1. / (t + t0)  # (1 - 1./t)#mbs*1. / t
             w2 = 1. / (t + t0)  # 1.*mbs /t
-            for m in range(self.N):
-                self.CY[m + nb_, self.ind_A[m]] *= w1
-                self.CY[m + nb_, self.ind_A[m]] += w2 * ccf[m + nb_].dot(y[:, self.ind_A[m]])
-
-            self.CY[:nb_] = self.CY[:nb_] * w1 + w2 * ccf[:nb_].dot(y)   # background
-            self.CC = self.CC * w1 + w2 * ccf.dot(ccf.T)
+            update_suff_stats(self.CY, self.CC, ccf, y, w1, w2, self._get_suff_stat_support(), nb_)
 
         if not self.batch_update_suff_stat:
 
             ccf = self.C_on[:self.M, t - self.minibatch_suff_stat:t - self.minibatch_suff_stat + 1]
             y = self.Yr_buf.get_last_frames(self.minibatch_suff_stat)[:1]
             # much faster: exploit that we only access CY[m, ind_pixels], hence update only these
-            for m in range(self.N):
-                self.CY[m + nb_, self.ind_A[m]] *= (1 - 1. / t)
-                self.CY[m + nb_, self.ind_A[m]] += ccf[m + nb_].dot(y[:, self.ind_A[m]]) / t
-            self.CY[:nb_] = self.CY[:nb_] * (1 - 1. / t) + ccf[:nb_].dot(y / t)
-            self.CC = self.CC * (1 - 1. / t) + ccf.dot(ccf.T / t)
+            update_suff_stats(self.CY, self.CC, ccf, y, 1 - 1. / t, 1. / t,
+                              self._get_suff_stat_support(), nb_)
+        if timer is not None:
+            timer.lap('suff_stats')
 
         # update shapes
         if True:  # False:  # bulk shape update
@@ -948,8 +1039,10 @@ class CNMF(object):
                     Ab_, self.ind_A, _ = update_shapes(self.CY, self.CC, Ab_, self.ind_A,
                                                        indicator_components=indicator_components)
 
-                self.AtA = (Ab_.T.dot(Ab_)).toarray()
-                
+                # only the background and the updated neurons changed their shapes
+                self.AtA = update_AtA(self.AtA, Ab_, None if indicator_components is None else
+                                      np.r_[np.arange(nb_), np.where(indicator_components)[0] + nb_])
+
                 ind_zero = list(np.where(self.AtA.diagonal()<1e-10)[0])
                 if len(ind_zero) > 0:
                     ind_zero.sort()
@@ -983,10 +1076,13 @@ class CNMF(object):
                     self.Ab_copy = Ab_
                     self.Ab = Ab_
                     self.ind_A = list([(self.Ab.indices[self.Ab.indptr[ii]:self.Ab.indptr[ii+1]]) for ii in range(self.gnb,self.M)])
+                    self.suff_stat_support = None
                     self.groups = list(map(list, update_order(Ab_)[0]))
                 
                 if self.n_refit:
                     self.AtY_buf = Ab_.T.dot(self.Yr_buf.T)
+                if timer is not None:
+                    timer.lap('shapes')
 
         else:  # distributed shape update
             self.update_counter *= .5**(1. / mbs)
@@ -1014,6 +1110,9 @@ class CNMF(object):
 
                 self.Ab = Ab_
             self.time_spend += time() - t_start
+
+        if timer is not None:
+            timer.stop()
             
     
     def compute_residuals(self, Yr):
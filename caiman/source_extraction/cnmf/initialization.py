@@ -16,6 +16,7 @@ from __future__ import division
 from __future__ import print_function
 from builtins import range
 from past.utils import old_div
+from past.builtins import basestring
 import numpy as np
 from sklearn.decomposition import NMF, FastICA
 from skimage.morphology import disk
@@ -27,11 +28,17 @@ from skimage.transform import resize as resize_sk
 import scipy.sparse as spr
 import scipy
 import caiman
+from caiman.mmapping import _n_workers
 from caiman.source_extraction.cnmf.deconvolution import deconvolve_ca
 from caiman.source_extraction.cnmf.pre_processing import get_noise_fft
-from caiman.source_extraction.cnmf.spatial import circular_constraint
+from caiman.source_extraction.cnmf.spatial import circular_constraint, save_temp_array
 import cv2
 import sys
+import os
+import shutil
+import tempfile
+import itertools
+import psutil
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 #%%
@@ -162,7 +169,7 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
                           perc_baseline_snmf=20, options_local_NMF=None, rolling_sum=False,
                           rolling_length=100, sn=None, options_total=None,
                           min_corr=0.8, min_pnr=10, deconvolve_options_init=None,
-                          ring_size_factor=1.5, center_psf=True):
+                          ring_size_factor=1.5, center_psf=True, dview=None):
     """
     Initalize components
 
@@ -243,6 +250,9 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
     nb: integer
         number of background components for approximating the background using NMF model
 
+    dview: ipyparallel view or multiprocessing pool
+        to compute the background of the ring model (method 'corr_pnr') in parallel
+
     sn: ndarray
         per pixel noise
 
@@ -329,7 +339,7 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
         Ain, Cin, _, b_in, f_in = greedyROI_corr(
             Y, Y_ds, max_number=K, gSiz=gSiz[0], gSig=gSig[0], min_corr=min_corr, min_pnr=min_pnr,
             deconvolve_options=deconvolve_options_init, ring_size_factor=ring_size_factor,
-            center_psf=center_psf, options=options_total, sn=sn, nb=nb, ssub=ssub)
+            center_psf=center_psf, options=options_total, sn=sn, nb=nb, ssub=ssub, dview=dview)
 
     elif method == 'sparse_nmf':
         Ain, Cin, _, b_in, f_in = sparseNMF(
@@ -899,7 +909,7 @@ def hals(Y, A, C, b, f, bSiz=3, maxIter=5):
 def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=True,
                    min_corr=None, min_pnr=None, seed_method='auto', deconvolve_options=None,
                    min_pixel=3, bd=0, thresh_init=2, ring_size_factor=None, nb=1, options=None,
-                   sn=None, save_video=False, video_name='initialization.mp4', ssub=1):
+                   sn=None, save_video=False, video_name='initialization.mp4', ssub=1, dview=None):
     """
     initialize neurons based on pixels' local correlations and peak-to-noise ratios.
 
@@ -930,6 +940,8 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
             components.
         nb: integer
             number of background components for approximating the background using NMF model
+        dview: ipyparallel view or multiprocessing pool
+            to compute the background of the ring model in parallel (see compute_W)
 
     Returns:
 
@@ -962,7 +974,8 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
         # background according to ringmodel
         print('Compute Background')
         W, b0 = compute_W(Y_ds.reshape((-1, total_frames), order='F'),
-                          A, C, (d1, d2), int(np.round(ring_size_factor * gSiz)))
+                          A, C, (d1, d2), int(np.round(ring_size_factor * gSiz)),
+                          data_fits_in_memory=None, dview=dview)
 
         B = -b0[:, None] - W.dot(B - b0[:, None])  # "-B"
         B += Y_ds.reshape((-1, total_frames), order='F')  # "Y-B"
@@ -1002,7 +1015,8 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
         print('Compute Background Again')
         # background according to ringmodel
         W, b0 = compute_W(Y_ds.reshape((-1, total_frames), order='F'),
-                          A.toarray(), C, (d1, d2), int(np.round(ring_size_factor * gSiz)))
+                          A.toarray(), C, (d1, d2), int(np.round(ring_size_factor * gSiz)),
+                          data_fits_in_memory=None, dview=dview)
 
         # 2nd iteration on non-decimated data
         K = C.shape[0]
@@ -1048,7 +1062,8 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
         # background according to ringmodel
         W, b0 = compute_W(Y_ds.reshape((-1, total_frames), order='F'),
                           A_ds, downscale(C, (1, tsub)), (d1, d2),
-                          int(np.round(ring_size_factor * gSiz)))
+                          int(np.round(ring_size_factor * gSiz)),
+                          data_fits_in_memory=None, dview=dview)
         B = (Ys if T > total_frames else Y_ds.reshape((-1, total_frames), order='F')) - A_ds.dot(C)
         B = b0[:, None] + W.dot(B - b0[:, None])
 
@@ -1492,8 +1507,96 @@ def extract_ac(data_filtered, data_raw, ind_ctr, patch_dims):
     return ai, ci.reshape(len(ci)), True
 
 
+def _cho_solve_batch(M, r):
+    """ solve the symmetric positive definite systems M[i] x[i] = r[i] with a batched
+    Cholesky factorization and forward / backward substitution over the batch
+
+    Parameters:
+    ----------
+    M: np.ndarray (n x k x k)
+        symmetric positive definite matrices
+
+    r: np.ndarray (n x k)
+        right hand sides
+
+    Returns:
+    --------
+    x: np.ndarray (n x k)
+        solutions, computed with the pseudo-inverse if a matrix is not positive definite
+    """
+    try:
+        L = np.linalg.cholesky(M)
+    except np.linalg.LinAlgError:
+        return np.matmul(np.linalg.pinv(M), r[..., None])[..., 0]
+    k = M.shape[-1]
+    y = np.zeros_like(r)
+    for i in range(k):
+        y[:, i] = (r[:, i] - np.einsum('nj,nj->n', L[:, i, :i], y[:, :i])) / L[:, i, i]
+    x = np.zeros_like(r)
+    for i in range(k - 1, -1, -1):
+        x[:, i] = (y[:, i] - np.einsum('nj,nj->n', L[:, i + 1:, i], x[:, i + 1:])) / L[:, i, i]
+    return x
+
+
+def _compute_W_block(pars):
+    """ ring model weights of a block of pixels, see compute_W
+
+    Parameters:
+    ----------
+    pars: tuple
+        pixels: np.ndarray, indices of the pixels of the block
+        union: np.ndarray, sorted indices of the pixels of the block and of their rings
+        X: np.ndarray, X = Y - A*C - b0*1' restricted to union (len(union) x time), or
+            the tuple (Y[union], A[union], C, b0[union]) to compute it in the worker, C
+            being possibly the name of a .npy file
+        ringidx: list of np.ndarray, offsets of the ring
+        dims: tuple, x, y movie dimensions
+
+    Returns:
+    --------
+    indices: list of np.ndarray
+        indices of the pixels on the ring of each pixel
+
+    data: list of np.ndarray
+        weights of the pixels on the ring of each pixel
+    """
+    pixels, union, X, ringidx, dims = pars
+    if isinstance(X, tuple):
+        Y_, A_, C, b0_ = X
+        if isinstance(C, basestring):
+            C = np.load(C, mmap_mode='r')
+        X = Y_ - A_.dot(C) - b0_[:, None]
+    # an extra trace of zeros for the ring pixels outside of the field of view
+    X = np.vstack([X, np.zeros((1, X.shape[1]), dtype=X.dtype)])
+
+    x, y = np.unravel_index(pixels, dims, order='F')
+    x = x[:, None] + ringidx[0]
+    y = y[:, None] + ringidx[1]
+    inside = (x >= 0) * (x < dims[0]) * (y >= 0) * (y < dims[1])
+    ring = np.ravel_multi_index((np.clip(x, 0, dims[0] - 1), np.clip(y, 0, dims[1] - 1)),
+                                dims, order='F')
+    ring_local = np.where(inside, np.searchsorted(union, ring), len(union))
+    pixels_local = np.searchsorted(union, pixels)
+
+    # all the pixels share the geometry of the full ring: the ring pixels outside of the
+    # field of view have a zero trace and a unit diagonal, hence a zero weight, and the
+    # other weights are those of the normal equations restricted to the pixels inside
+    k = len(ringidx[0])
+    step = max(1, 2**27 // (X.itemsize * X.shape[1] * k))  # pixels gathered at once
+    data = []
+    for start in range(0, len(pixels), step):
+        B = X[ring_local[start:start + step]]  # pixels x ring x time
+        M = np.matmul(B, B.transpose(0, 2, 1)).astype(np.float64)
+        M[:, np.arange(k), np.arange(k)] += 1e-9 + ~inside[start:start + step]
+        r = np.matmul(B, X[pixels_local[start:start + step]][..., None])[..., 0]
+        data.append(_cho_solve_batch(M, r.astype(np.float64)))
+    data = np.concatenate(data)
+
+    return [ring[p, inside[p]] for p in range(len(pixels))], [data[p, inside[p]] for p in range(len(pixels))]
+
+
 @profile
-def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True):
+def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, dview=None, block_size=1000):
     """compute background according to ring model
     solves the problem
         min_{W,b0} ||X-W*X|| with X = Y - A*C - b0*1'
@@ -1501,6 +1604,10 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True):
         W(i,j) = 0 for each pixel j that is not in ring around pixel i
     Problem parallelizes over pixels i
     Fluctuating background activity is W*X, constant baselines b0.
+    Pixels are processed in blocks of block_size pixels; within a block the pixels
+    solve their regularized normal equations together with a batched Cholesky.
+    The data of the blocks are prepared as they are dispatched to the workers, so that
+    only a few blocks are in memory at once.
     Parameters:
     ----------
     Y: np.ndarray (2D or 3D)
@@ -1513,8 +1620,15 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True):
         x, y[, z] movie dimensions
     radius: int
         radius of ring
-    data_fits_in_memory: [optional] bool
-        If true, use faster but more memory consuming computation
+    data_fits_in_memory: [optional] bool or None
+        If true, use faster but more memory consuming computation, otherwise
+        X is only computed for the pixels of one block (and their rings) at a time.
+        If None, X is computed at once when three copies of Y in double precision
+        take less than half of the available memory
+    dview: [optional] view on ipyparallel client or multiprocessing pool
+        to process blocks of pixels in parallel
+    block_size: [optional] int
+        number of pixels per block
 
     Returns:
     --------
@@ -1525,30 +1639,52 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True):
     """
 
     ring = disk(radius + 1, dtype=bool)
-    ring[1:-1, 1:-1] -= disk(radius, dtype=bool)
+    ring[1:-1, 1:-1] ^= disk(radius, dtype=bool)
     ringidx = [i - radius - 1 for i in np.nonzero(ring)]
 
-    def get_indices_of_pixels_on_ring(pixel):
-        pixel = np.unravel_index(pixel, dims, order='F')
-        x = pixel[0] + ringidx[0]
-        y = pixel[1] + ringidx[1]
-        inside = (x >= 0) * (x < dims[0]) * (y >= 0) * (y < dims[1])
-        return np.ravel_multi_index((x[inside], y[inside]), dims, order='F')
-
+    if data_fits_in_memory is None:
+        data_fits_in_memory = 3 * 8 * np.prod(Y.shape) < psutil.virtual_memory().available / 2.
     b0 = np.array(Y.mean(1)) - A.dot(C.mean(1))
     X = Y - A.dot(C) - b0[:, None] if data_fits_in_memory else None
+    folder = None
+    if X is None and dview is not None:
+        # C is sent once to the workers through a file instead of with every block
+        if 'multiprocessing' in str(type(dview)) and os.path.isdir('/dev/shm'):
+            folder = tempfile.mkdtemp(dir='/dev/shm')
+        else:
+            folder = tempfile.mkdtemp()
+        C = save_temp_array(C, folder, 'C_temp.npy', dview)
 
+    def get_block_pars(pixels):
+        x, y = np.unravel_index(pixels, dims, order='F')
+        x = np.add.outer(x, ringidx[0]).ravel()
+        y = np.add.outer(y, ringidx[1]).ravel()
+        inside = (x >= 0) * (x < dims[0]) * (y >= 0) * (y < dims[1])
+        union = np.union1d(pixels, np.ravel_multi_index((x[inside], y[inside]), dims, order='F'))
+        X_ = X[union] if X is not None else (Y[union], A[union], C, b0[union])
+        return pixels, union, X_, ringidx, dims
+
+    N = np.prod(dims)
+    pars = (get_block_pars(np.arange(start, min(start + block_size, N))) for start in range(0, N, block_size))
     indices = []
     data = []
-    indptr = [0]
-    for p in xrange(np.prod(dims)):
-        index = get_indices_of_pixels_on_ring(p)
-        indices += list(index)
-        B = Y[index] - A[index].dot(C) - b0[index, None] if X is None else X[index]
-        data += list(np.linalg.inv(np.array(B.dot(B.T)) +
-                                   1e-9 * np.eye(len(index), dtype='float32')).
-                     dot(B.dot(Y[p] - A[p].dot(C).ravel() - b0[p] if X is None else X[p])))
-        # np.linalg.lstsq seems less robust but scipy version would be (robust but for the problem size slower) alternative
-        # data += list(scipy.linalg.lstsq(B.T, Y[p] - A[p].dot(C) - b0[p], check_finite=False)[0])
-        indptr.append(len(indices))
-    return spr.csr_matrix((data, indices, indptr), dtype='float32'), b0.astype(np.float32)
+    try:
+        if dview is None:
+            results = map(_compute_W_block, pars)
+        elif 'multiprocessing' in str(type(dview)):
+            results = dview.imap(_compute_W_block, pars)
+        else:
+            # blocks are sent in batches of a few blocks per engine
+            batch_size = 2 * _n_workers(dview)
+            results = (res for batch in iter(lambda: list(itertools.islice(pars, batch_size)), [])
+                       for res in dview.map_sync(_compute_W_block, batch))
+
+        for ind, dat in results:
+            indices += ind
+            data += dat
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+    indptr = np.concatenate([[0], np.cumsum([len(ind) for ind in indices])])
+    return (spr.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr),
+                           shape=(N, N), dtype='float32'), b0.astype(np.float32))
@@ -24,7 +24,51 @@ import time
 import scipy
 import os
 from ...mmapping import load_memmap
-from ...cluster import extract_patch_coordinates
+from ...cluster import extract_patch_coordinates, iter_shared_patch_groups
+
+
+#%%
+def fit_patch(images, options):
+    """Run CNMF on a single patch in the current process
+
+    Parameters:
+    ----------
+    images: ndarray
+        movie of the patch (time x dimensions)
+
+    options:
+        dictionary containing all the parameters for the various algorithms
+
+    Returns:
+    -------
+    cnm: CNMF object fitted on the patch
+    """
+    from . import cnmf
+    p = options['temporal_params']['p']
+    cnm = cnmf.CNMF(n_processes=1, k=options['init_params']['K'], gSig=options['init_params']['gSig'], gSiz=options['init_params']['gSiz'],
+                    merge_thresh=options['merging']['thr'], p=p, dview=None, Ain=None, Cin=None,
+                    f_in=None, do_merge=True,
+                    ssub=options['init_params']['ssub'], tsub=options['init_params']['tsub'],
+                    p_ssub=options['patch_params']['ssub'], p_tsub=options['patch_params']['tsub'],
+                    method_init=options['init_params']['method'], alpha_snmf=options['init_params']['alpha_snmf'],
+                    rf=None, stride=None, memory_fact=1, gnb=options['patch_params']['nb'],
+                    only_init_patch=options['patch_params']['only_init'],
+                    method_deconvolution=options['temporal_params']['method'],
+                    n_pixels_per_process=options['preprocess_params']['n_pixels_per_process'],
+                    block_size=options['temporal_params']['block_size'],
+                    check_nan=options['preprocess_params']['check_nan'],
+                    skip_refinement=options['patch_params']['skip_refinement'],
+                    options_local_NMF=options['init_params']['options_local_NMF'],
+                    normalize_init=options['init_params']['normalize_init'],
+                    remove_very_bad_comps=options['patch_params']['remove_very_bad_comps'],
+                    rolling_sum=options['init_params']['rolling_sum'],
+                    rolling_length=options['init_params']['rolling_length'],
+                    min_corr=options['init_params']['min_corr'], min_pnr=options['init_params']['min_pnr'],
+                    deconvolve_options_init=options['init_params']['deconvolve_options_init'],
+                    ring_size_factor=options['init_params']['ring_size_factor'],
+                    center_psf=options['init_params']['center_psf'])
+
+    return cnm.fit(images)
 
 
 #%%
@@ -38,12 +82,19 @@ def cnmf_patches(args_in):
         file_name: string
             full path to an npy file (2D, pixels x time) containing the movie
 
-        shape: tuple of thre elements
-            dimensions of the original movie across y, x, and time
+        idx_: ndarray
+            flattened (order='F') indices of the pixels of the patch in the movie
+
+        shapes: tuple
+            dimensions of the patch
 
         options:
             dictionary containing all the parameters for the various algorithms
 
+        offset: int
+            index of the first pixel of file_name in the movie (non zero when the
+            patch is read from a group staged in shared memory)
+
         rf: int
             half-size of the square patch in pixel
 
@@ -84,8 +135,7 @@ def cnmf_patches(args_in):
         """
 
     import logging
-    from . import cnmf
-    file_name, idx_, shapes, options = args_in
+    file_name, idx_, shapes, options, offset = args_in
 
     name_log = os.path.basename(file_name[:-5]) + '_LOG_ ' + str(idx_[0]) + '_' + str(idx_[-1])
     logger = logging.getLogger(name_log)
@@ -95,8 +145,6 @@ def cnmf_patches(args_in):
     logger.addHandler(hdlr)
     logger.setLevel(logging.INFO)
 
-    p = options['temporal_params']['p']
-
     logger.info('START')
 
     logger.info('Read file')
@@ -106,7 +154,7 @@ def cnmf_patches(args_in):
     # for 2d a rectangle/square, for 3d a rectangular cuboid/cube, etc.
     upper_left_corner = min(idx_)
     lower_right_corner = max(idx_)
-    indices = np.unravel_index([upper_left_corner, lower_right_corner],
+    indices = np.unravel_index([upper_left_corner - offset, lower_right_corner - offset],
                                dims, order='F')  # indices as tuples
     slices = [slice(min_dim, max_dim + 1) for min_dim, max_dim in indices]
     slices.insert(0, slice(timesteps))  # insert slice for timesteps, equivalent to :
@@ -115,31 +163,7 @@ def cnmf_patches(args_in):
     images = images[slices]
 
     if (np.sum(np.abs(np.diff(images.reshape(timesteps, -1).T)))) > 0.1:
-
-        cnm = cnmf.CNMF(n_processes=1, k=options['init_params']['K'], gSig=options['init_params']['gSig'], gSiz=options['init_params']['gSiz'],
-                        merge_thresh=options['merging']['thr'], p=p, dview=None, Ain=None, Cin=None,
-                        f_in=None, do_merge=True,
-                        ssub=options['init_params']['ssub'], tsub=options['init_params']['tsub'],
-                        p_ssub=options['patch_params']['ssub'], p_tsub=options['patch_params']['tsub'],
-                        method_init=options['init_params']['method'], alpha_snmf=options['init_params']['alpha_snmf'],
-                        rf=None, stride=None, memory_fact=1, gnb=options['patch_params']['nb'],
-                        only_init_patch=options['patch_params']['only_init'],
-                        method_deconvolution=options['temporal_params']['method'],
-                        n_pixels_per_process=options['preprocess_params']['n_pixels_per_process'],
-                        block_size=options['temporal_params']['block_size'],
-                        check_nan=options['preprocess_params']['check_nan'],
-                        skip_refinement=options['patch_params']['skip_refinement'],
-                        options_local_NMF=options['init_params']['options_local_NMF'],
-                        normalize_init=options['init_params']['normalize_init'],
-                        remove_very_bad_comps=options['patch_params']['remove_very_bad_comps'],
-                        rolling_sum=options['init_params']['rolling_sum'],
-                        rolling_length=options['init_params']['rolling_length'],
-                        min_corr=options['init_params']['min_corr'], min_pnr=options['init_params']['min_pnr'],
-                        deconvolve_options_init=options['init_params']['deconvolve_options_init'],
-                        ring_size_factor=options['init_params']['ring_size_factor'],
-                        center_psf=options['init_params']['center_psf'])
-
-        cnm = cnm.fit(images)
+        cnm = fit_patch(images, options)
         return [idx_, shapes, scipy.sparse.coo_matrix(cnm.A),
                 cnm.b, cnm.C, cnm.f, cnm.S, cnm.bl, cnm.c1,
                 cnm.neurons_sn, cnm.g, cnm.sn, cnm.options, cnm.YrA]
@@ -149,7 +173,7 @@ def cnmf_patches(args_in):
 
 #%%
 def run_CNMF_patches(file_name, shape, options, rf=16, stride=4, gnb=1, dview=None, memory_fact=1,
-                     border_pix=0, low_rank_background=True, del_duplicates=False):
+                     border_pix=0, low_rank_background=True, del_duplicates=False, shared_memory=False):
     """Function that runs CNMF in patches
 
      Either in parallel or sequentially, and return the result for each.
@@ -198,6 +222,12 @@ def run_CNMF_patches(file_name, shape, options, rf=16, stride=4, gnb=1, dview=No
         I.e. neurons that are closer to the center of another patch are removed to
         avoid duplicates, cause the other patch should already account for them.
 
+    shared_memory: bool
+        if True the patches are read from groups of contiguous rows staged in shared
+        memory, so that each pixel is read from disk only once even if it belongs to
+        several patches (see cluster.iter_shared_patch_groups). The workers must run
+        on the same machine
+
     Returns:
     -------
     A_tot: matrix containing all the components from all the patches
@@ -236,32 +266,44 @@ def run_CNMF_patches(file_name, shape, options, rf=16, stride=4, gnb=1, dview=No
 
 
     idx_flat, idx_2d = extract_patch_coordinates(dims, rfs, strides, border_pix=border_pix)
-    args_in = []
+    idx_flat = list(idx_flat)
     patch_centers = []
     for id_f, id_2d in zip(idx_flat, idx_2d):
         #        print(id_2d)
-        args_in.append((file_name, id_f, id_2d, options))
         if del_duplicates:
             foo = np.zeros(d, dtype=bool)
             foo[id_f] = 1
             patch_centers.append(scipy.ndimage.center_of_mass(foo.reshape(dims, order='F')))
     print(id_2d)
+
+    if shared_memory:
+        waves = iter_shared_patch_groups(file_name, idx_flat)
+    else:
+        waves = [[(count, file_name, 0) for count in range(len(idx_flat))]]
+
     st = time.time()
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            file_res = dview.map_async(cnmf_patches, args_in).get(4294967)
+    file_res = [None] * len(idx_flat)
+    for wave in waves:
+        args_in = [(fname, idx_flat[count], idx_2d[count], options, offset)
+                   for count, fname, offset in wave]
+        if dview is not None:
+            if 'multiprocessing' in str(type(dview)):
+                res = dview.map_async(cnmf_patches, args_in).get(4294967)
+            else:
+                try:
+                    res = dview.map_sync(cnmf_patches, args_in)
+                    dview.results.clear()
+                except:
+                    print('Something went wrong')
+                    raise
+                finally:
+                    print('You may think that it went well but reality is harsh')
+
         else:
-            try:
-                file_res = dview.map_sync(cnmf_patches, args_in)
-                dview.results.clear()
-            except:
-                print('Something went wrong')
-                raise
-            finally:
-                print('You may think that it went well but reality is harsh')
+            res = list(map(cnmf_patches, args_in))
 
-    else:
-        file_res = list(map(cnmf_patches, args_in))
+        for (count, _, _), rr in zip(wave, res):
+            file_res[count] = rr
 
     print((time.time() - st))
     # count components
@@ -131,35 +131,23 @@ sn: float
     # % find graph of overlapping spatial components
     A_corr = scipy.sparse.triu(A.T * A)
     A_corr.setdiag(0)
-    A_corr = A_corr.tocsc()
-    FF2 = A_corr > 0
-    C_corr = scipy.sparse.csc_matrix(A_corr.shape)
-    for ii in range(nr):
-        overlap_indeces = A_corr[ii,:].nonzero()[1]
-        if len(overlap_indeces)>0:
-            #we chesk the correlation of the calcium traces for eahc overlapping components
-            corr_values = [scipy.stats.pearsonr(C[ii,:],C[jj,:])[0] for jj in overlap_indeces]
-            C_corr[ii,overlap_indeces] = corr_values
-    
-    FF1 = (C_corr+C_corr.T) > thr
-    FF3 = FF1.multiply(FF2)
+    A_corr.eliminate_zeros()
+    A_corr = A_corr.tocoo()
+    # correlation of the calcium traces of each pair of overlapping components
+    corr_values = overlap_correlations(C, A_corr.row, A_corr.col)
+    C_corr = csc_matrix((corr_values, (A_corr.row, A_corr.col)), shape=A_corr.shape)
 
+    FF3 = (C_corr + C_corr.T) > thr
     nb, connected_comp = csgraph.connected_components(FF3)  # % extract connected components
 
     p = temporal_params['p']
-    list_conxcomp = []
-    for i in range(nb): # we list them
-        if np.sum(connected_comp == i) > 1:
-            list_conxcomp.append((connected_comp == i).T)
-    list_conxcomp = np.asarray(list_conxcomp).T
-
-    if list_conxcomp.ndim > 1:
-        cor = np.zeros((np.shape(list_conxcomp)[1], 1))
-        for i in range(np.size(cor)):
-            fm = np.where(list_conxcomp[:, i])[0]
-            for j1 in range(np.size(fm)):
-                for j2 in range(j1 + 1, np.size(fm)):
-                    cor[i] = cor[i] + C_corr[fm[j1], fm[j2]]
+    # score of each group: sum of the correlations of its overlapping pairs
+    same = connected_comp[A_corr.row] == connected_comp[A_corr.col]
+    cor = np.bincount(connected_comp[A_corr.row[same]], weights=corr_values[same], minlength=nb)
+    list_conxcomp = np.where(np.bincount(connected_comp, minlength=nb) > 1)[0]
+
+    if len(list_conxcomp) > 0:
+        cor = cor[list_conxcomp]
 
 #        if not fast_merge:
 #            Y_res = Y - A.dot(C) #residuals=background=noise
@@ -170,73 +158,41 @@ sn: float
 
         nbmrg = min((np.size(ind), mx))   # number of merging operations
 
-        #we initialize the values
-        A_merged = lil_matrix((d, nbmrg))
-        C_merged = np.zeros((nbmrg, t))
-        S_merged = np.zeros((nbmrg, t))
-        bl_merged = np.zeros((nbmrg, 1))
-        c1_merged = np.zeros((nbmrg, 1))
-        sn_merged = np.zeros((nbmrg, 1))
-        g_merged = np.zeros((nbmrg, p))
+        # we refit each group of components (rank 1 NMF and deconvolution) in parallel
+        Acsc = A.tocsc()
+        C = np.array(C)
         merged_ROIs = []
-
+        pars = []
         for i in range(nbmrg):
-            merged_ROI = np.where(list_conxcomp[:, ind[i]])[0]
+            merged_ROI = np.where(connected_comp == list_conxcomp[ind[i]])[0]
             merged_ROIs.append(merged_ROI)
-
-            #we l2 the traces to have normalization values
-            C_to_norm = np.sqrt([computedC.dot(computedC) for computedC in C[merged_ROI]])
-#            fast_merge = False
-            
-            # from here we are computing initial values for C and A
-            Acsc = A.tocsc()[:, merged_ROI]
-            Ctmp = np.array(C)[merged_ROI, :]
             print((merged_ROI.T))
-       
-            #this is a  big normalization value that for every one of the merged neuron
-            C_to_norm = np.sqrt(np.ravel(Acsc.power(2).sum(axis=0)) * np.sum(Ctmp ** 2, axis=1))
-            indx = np.argmax(C_to_norm)
-            
-            if fast_merge:
-                #we normalize the values of different A's to be able to compare them efficiently. we then sum them
-                computedA = Acsc.dot(scipy.sparse.diags(C_to_norm, 0, (len(C_to_norm), len(C_to_norm)))).sum(axis=1)
-        
-                for _ in range(10): # we operate a rank one NMF, refining it multiple times (see cnmf demos )
-                    computedC = np.maximum(Acsc.T.dot(computedA).T.dot(Ctmp) / (computedA.T * computedA),0)
-                    computedA = np.maximum(Acsc.dot(Ctmp.dot(computedC.T)) / (computedC * computedC.T), 0)
-            else:
-                print('Simple Merging Take Best Neuron')
-                computedC = Ctmp[indx]
-                computedA = Acsc[:,indx]
-                
-            # then we de-normalize them using A_to_norm
-            A_to_norm = np.sqrt(computedA.T.dot(computedA)[0, 0] / Acsc.power(2).sum(0).max())
-            computedA /= A_to_norm
-            computedC *= A_to_norm
-    
-            
-            # we then compute the traces ( deconvolution ) to have a clean c and noise in the background
-            if g is not None:
-                computedC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
-                    np.array(computedC).squeeze(), g=g[merged_ROI[indx]], **temporal_params)
-            else:
-                computedC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
-                    np.array(computedC).squeeze(), g=None, **temporal_params)
-                 
-                
-            A_merged[:, i] = computedA
-            C_merged[i, :] = computedC
-            S_merged[i, :] = ss[:t]
-            bl_merged[i] = bm
-            c1_merged[i] = cm
-            sn_merged[i] = sm
-            g_merged[i, :] = gm 
-            
-            
+            pars.append([Acsc[:, merged_ROI], C[merged_ROI],
+                         None if g is None else [g[k] for k in merged_ROI], fast_merge,
+                         temporal_params])
+
+        if dview is None:
+            res = list(map(merge_iteration, pars))
+        elif 'multiprocessing' in str(type(dview)):
+            res = dview.map_async(merge_iteration, pars).get(4294967)
+        else:
+            res = dview.map_sync(merge_iteration, pars)
+            dview.results.clear()
+
+        A_merged = scipy.sparse.hstack([csc_matrix(rr[0]) for rr in res]).tocsc()
+        C_merged = np.array([rr[1] for rr in res])
+        S_merged = np.array([rr[6][:t] for rr in res])
+        bl_merged = np.array([rr[2] for rr in res])
+        c1_merged = np.array([rr[3] for rr in res])
+        sn_merged = np.array([rr[5] for rr in res])
+        g_merged = np.zeros((nbmrg, p))
+        for i, rr in enumerate(res):
+            g_merged[i, :] = rr[4]
+
         #we want to remove merged neuron from the initial part and replace them with merged ones
         neur_id = np.unique(np.hstack(merged_ROIs))
         good_neurons = np.setdiff1d(list(range(nr)), neur_id)
-        A = scipy.sparse.hstack((A.tocsc()[:, good_neurons], A_merged.tocsc()))
+        A = scipy.sparse.hstack((Acsc[:, good_neurons], A_merged))
         C = np.vstack((C[good_neurons, :], C_merged))
         #we continue for the variables
         if S is not None:
@@ -256,3 +212,89 @@ sn: float
         merged_ROIs = []
 
     return A, C, nr, merged_ROIs, S, bl, c1, sn, g
+
+
+#%%
+def overlap_correlations(C, rows, cols, max_pairs_per_chunk=None):
+    """ Pearson correlation of the traces of the pairs of components (rows[k], cols[k])
+
+    The traces are z-scored once and the correlations of the pairs are computed in chunks
+    of pairs. Constant traces have zero correlation with all the other traces
+
+    Parameters:
+    -----------
+    C: np.ndarray
+        matrix of temporal components (K x T)
+
+    rows, cols: np.ndarray
+        indices of the components of each pair
+
+    max_pairs_per_chunk: int
+        number of pairs processed at once (by default about 2**24 entries of C per chunk)
+
+    Returns:
+    --------
+    corr: np.ndarray
+        correlation of each pair
+    """
+    C = np.asarray(C, dtype=np.float64)
+    T = C.shape[1]
+    Cz = C - C.mean(1)[:, None]
+    nrm = np.sqrt(np.sum(Cz ** 2, 1))
+    nrm[nrm == 0] = np.inf
+    Cz /= nrm[:, None]
+    if max_pairs_per_chunk is None:
+        max_pairs_per_chunk = max(1, 2**24 // max(T, 1))
+    corr = np.zeros(len(rows))
+    for start in range(0, len(rows), max_pairs_per_chunk):
+        sl = slice(start, start + max_pairs_per_chunk)
+        corr[sl] = np.einsum('ij,ij->i', Cz[rows[sl]], Cz[cols[sl]])
+    return corr
+
+
+def merge_iteration(pars):
+    """ Merge a group of components into one (function run in parallel by merge_components)
+
+    Parameters:
+    -----------
+    pars: list
+        Acsc: sparse matrix, spatial components of the group (d x n)
+        Ctmp: np.ndarray, temporal components of the group (n x T)
+        g: discrete time constants of the components of the group or None
+        fast_merge: bool, if true perform rank 1 merging, otherwise takes best neuron
+        temporal_params: dictionary, parameters of the deconvolution
+
+    Returns:
+    --------
+    computedA: spatial component of the merged neuron (d x 1)
+
+    computedC, bm, cm, gm, sm, ss: deconvolved trace, baseline, initial concentration,
+        time constants, noise and spikes of the merged neuron (see constrained_foopsi)
+    """
+    Acsc, Ctmp, g, fast_merge, temporal_params = pars
+    #this is a  big normalization value that for every one of the merged neuron
+    C_to_norm = np.sqrt(np.ravel(Acsc.power(2).sum(axis=0)) * np.sum(Ctmp ** 2, axis=1))
+    indx = np.argmax(C_to_norm)
+
+    if fast_merge:
+        #we normalize the values of different A's to be able to compare them efficiently. we then sum them
+        computedA = Acsc.dot(scipy.sparse.diags(C_to_norm, 0, (len(C_to_norm), len(C_to_norm)))).sum(axis=1)
+
+        for _ in range(10): # we operate a rank one NMF, refining it multiple times (see cnmf demos )
+            computedC = np.maximum(Acsc.T.dot(computedA).T.dot(Ctmp) / (computedA.T * computedA),0)
+            computedA = np.maximum(Acsc.dot(Ctmp.dot(computedC.T)) / (computedC * computedC.T), 0)
+    else:
+        print('Simple Merging Take Best Neuron')
+        computedC = Ctmp[indx]
+        computedA = Acsc[:,indx]
+
+    # then we de-normalize them using A_to_norm
+    A_to_norm = np.sqrt(computedA.T.dot(computedA)[0, 0] / Acsc.power(2).sum(0).max())
+    computedA /= A_to_norm
+    computedC *= A_to_norm
+
+    # we then compute the traces ( deconvolution ) to have a clean c and noise in the background
+    computedC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
+        np.array(computedC).squeeze(), g=None if g is None else g[indx], **temporal_params)
+
+    return computedA, computedC, bm, cm, gm, sm, ss
@@ -7,7 +7,9 @@ Created on Mon Apr 4 18:21:13 2016
 import numpy as np
 cimport numpy as np
 cimport cython
-from libc.math cimport sqrt, log, exp, fmax, fabs
+from cython.parallel cimport prange
+from libc.math cimport sqrt, log, exp, fmax, fabs, INFINITY
+from libc.stdlib cimport malloc, free
 from scipy.optimize import fminbound, minimize
 from cpython cimport bool
 from libcpp.vector cimport vector
@@ -141,9 +143,11 @@ cdef class OASIS:
         """
         fit next time step t
         """
+        self._fit_next(yt)
+
+    cdef void _fit_next(self, SINGLE yt):
         cdef Pool newpool
         cdef Py_ssize_t j, k
-        cdef np.ndarray[SINGLE, ndim = 1] h, g12, g11g11, g11g12
         cdef SINGLE tmp
         if self.g2 == 0:  # AR(1)
             newpool.v = yt - self.b - self.lam * (1 - self.g)
@@ -494,6 +498,33 @@ cdef class OASIS:
                 #     c[k] = c[k - 1] * self.d
         return c
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef Py_ssize_t _write_last_pool(self, SINGLE * c, Py_ssize_t t):
+        """
+        write denoised calcium of last pool into c[t - l + 1: t + 1], see get_c_of_last_pool
+        """
+        cdef Py_ssize_t k, l, start
+        cdef SINGLE tmp
+        l = self.P[self.i].l
+        start = t + 1 - l
+        if self.g2 == 0:  # AR(1)
+            tmp = self.P[self.i].v / self.P[self.i].w
+            for k in range(0 if start >= 0 else -start, l):
+                c[start + k] = tmp * self.h[k] if k < 1000 else 0
+        else:  # AR(2)
+            if self.i == 0:  # first pool
+                tmp = self.P[0].v
+                for k in range(l):
+                    if start + k >= 0:
+                        c[start + k] = tmp
+                    tmp *= self.d
+            else:
+                for k in range(0 if start >= 0 else -start, l):
+                    c[start + k] = (self.h[k] * self.P[self.i].v + self.g12[k] * self.P[self.i - 1].w
+                                    if k < 1000 else 0)
+        return l
+
     def remove_last_pool(self):
         cdef Py_ssize_t k
         self.t -= self.P[self.i].l
@@ -591,6 +622,70 @@ cdef class OASIS:
             return self.get_s(self.P[self.i].t + self.P[self.i].l)
 
 
+cdef class OASISBank(list):
+    """
+    List of OASIS instances, one per neuron, that are updated together
+
+    The online deconvolution of all neurons for a new frame is carried out by a single
+    call that loops over the pool stacks at the C level and writes the part of the
+    denoised calcium traces that changed directly into the rows of a K x T array.
+    Otherwise it behaves like the list of OASIS instances it is constructed from
+    (indexing, append, del, ...).
+
+    Parameters
+    ----------
+    oases : iterable of OASIS
+        The deconvolution objects of the neurons.
+    """
+
+    def __reduce__(self):
+        # pickling (and deepcopy) of the contained OASIS instances
+        return OASISBank, (list(self),)
+
+    def _check(self, Py_ssize_t K, C, Py_ssize_t t):
+        if K != len(self):
+            raise ValueError('Expected values for %d neurons, got %d' % (len(self), K))
+        if C is not None and (C.shape[0] != K or t < 0 or t >= C.shape[1]):
+            raise ValueError('C must have one row per neuron and more than t columns')
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def fit_next(self, SINGLE[:] y, SINGLE[:, ::1] C=None, Py_ssize_t t=-1):
+        """
+        fit next time step of all neurons
+
+        Parameters
+        ----------
+        y : array of float, shape (K,)
+            Fluorescence of each neuron at the new time step.
+        C : array of float, shape (K, T), optional
+            Denoised calcium traces, updated in place in the columns of the last pools.
+        t : int
+            Column of C corresponding to the new time step.
+        """
+        cdef Py_ssize_t k, K = y.shape[0]
+        cdef OASIS o
+        self._check(K, C, t)
+        for k in range(K):
+            o = self[k]
+            o._fit_next(y[k])
+            if C is not None:
+                o._write_last_pool(&C[k, 0], t)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def write_last_pools(self, SINGLE[:, ::1] C, Py_ssize_t t):
+        """
+        write the denoised calcium of the last pool of each neuron into C[:, :t + 1]
+        """
+        cdef Py_ssize_t k, K = C.shape[0]
+        cdef OASIS o
+        self._check(K, C, t)
+        for k in range(K):
+            o = self[k]
+            o._write_last_pool(&C[k, 0], t)
+
+
 @cython.cdivision(True)
 def oasisAR1(np.ndarray[SINGLE, ndim=1] y, SINGLE g, SINGLE lam=0, SINGLE s_min=0):
     """ Infer the most likely discretized spike train underlying an AR(1) fluorescence trace
@@ -1055,3 +1150,301 @@ def constrained_oasisAR1(np.ndarray[SINGLE, ndim=1] y, SINGLE g, SINGLE sn,
     s[0] = 0
     s[1:] -= g * c[:-1]
     return c, s, b, g, lam
+
+
+#%% batched AR(1) deconvolution, the rows are processed in parallel without the GIL
+
+@cython.cdivision(True)
+cdef void _init_pools(SINGLE * y, Py_ssize_t T, SINGLE g, SINGLE lam,
+                      vector[Pool] & P) nogil:
+    """one pool per time point, shifted by the sparsity penalty lam"""
+    cdef:
+        Py_ssize_t t
+        Pool newpool
+
+    P.clear()
+    P.reserve(T)
+    newpool.w, newpool.l = 1, 1
+    for t in range(T):
+        newpool.v = y[t] - lam * (1 if t == T - 1 else (1 - g))
+        newpool.t = t
+        P.push_back(newpool)
+
+
+@cython.cdivision(True)
+cdef void _merge_pools(vector[Pool] & P, SINGLE g, SINGLE s_min) nogil:
+    """backtrack and merge pools in place until no constraint is violated"""
+    cdef Py_ssize_t i = 0, j
+
+    for j in range(1, P.size()):
+        i += 1
+        P[i] = P[j]
+        while (i > 0 and  # backtrack until violations fixed
+               (P[i - 1].v / P[i - 1].w * g**P[i - 1].l + s_min > P[i].v / P[i].w)):
+            i -= 1
+            # merge two pools
+            P[i].v += P[i + 1].v * g**P[i].l
+            P[i].w += P[i + 1].w * g**(2 * P[i].l)
+            P[i].l += P[i + 1].l
+    P.resize(i + 1)
+
+
+@cython.cdivision(True)
+cdef void _fill_pool(Pool & pool, SINGLE g, SINGLE * c) nogil:
+    cdef:
+        Py_ssize_t k
+        SINGLE tmp = fmax(pool.v, 0) / pool.w
+
+    for k in range(pool.l):
+        c[k + pool.t] = tmp
+        tmp *= g
+
+
+@cython.cdivision(True)
+cdef SINGLE _rss(SINGLE * y, SINGLE * c, SINGLE b, Py_ssize_t T, SINGLE * res) nogil:
+    cdef:
+        Py_ssize_t t
+        SINGLE RSS = 0
+
+    for t in range(T):
+        res[t] = y[t] - b - c[t]
+        RSS += res[t] * res[t]
+    return RSS
+
+
+@cython.cdivision(True)
+cdef void _dual_direction(vector[Pool] & P, SINGLE g, SINGLE * tmp) nogil:
+    """derivative of c w.r.t. a shift of the sparsity penalty (|s|_1 instead of |c|_1)"""
+    cdef:
+        Py_ssize_t i, j
+        SINGLE aa
+
+    for i in range(P.size()):
+        if i == P.size() - 1:
+            aa = 1 / P[i].w
+        else:
+            aa = (1 - g**P[i].l) / P[i].w
+        for j in range(P[i].l):
+            tmp[P[i].t + j] = aa
+            aa *= g
+
+
+@cython.cdivision(True)
+cdef SINGLE _oasisAR1_row(SINGLE * y, Py_ssize_t T, SINGLE g, SINGLE sn, SINGLE * b,
+                          SINGLE lam, SINGLE s_min, bint optimize_b, bint b_nonneg,
+                          int max_iter, SINGLE * c, SINGLE * s) nogil:
+    """deconvolves a single trace, returns lam and stores c, s (and the baseline in b)
+
+    Without noise level (sn <= 0) the penalized problem is solved for the given lam,
+    otherwise lam (and b if optimize_b) is chosen such that |y-b-c|^2 = sn^2 T
+    following the iterations of constrained_oasisAR1 (without optimizing g).
+    """
+    cdef:
+        Py_ssize_t i, t
+        int count = 0
+        SINGLE thresh, RSS, aa, bb, cc, dlam, db, dphi, csum, corr
+        SINGLE * res
+        SINGLE * tmp
+        vector[Pool] P
+
+    if sn <= 0:  # penalized problem, see oasisAR1
+        for t in range(T):
+            c[t] = y[t] - b[0]
+        _init_pools(c, T, g, lam, P)
+        _merge_pools(P, g, s_min)
+    else:
+        res = <SINGLE * > malloc(2 * T * sizeof(SINGLE))
+        tmp = res + T
+        thresh = sn * sn * T
+        lam = 0
+        for t in range(T):
+            tmp[t] = y[t] - b[0]
+        _init_pools(tmp, T, g, 0, P)
+        _merge_pools(P, g, 0)
+        for i in range(P.size()):
+            _fill_pool(P[i], g, c)
+        if not optimize_b:
+            RSS = _rss(y, c, b[0], T, res)
+            csum = 0
+            for t in range(T):
+                csum += c[t]
+            # until noise constraint is tight or spike train is empty
+            while RSS < thresh * (1 - 1e-4) and csum > 1e-9 and count < 100 * max_iter:
+                count += 1
+                # update lam
+                _dual_direction(P, g, tmp)
+                aa, bb = 0, 0
+                for t in range(T):
+                    aa += tmp[t] * tmp[t]
+                    bb += res[t] * tmp[t]
+                cc = RSS - thresh
+                dlam = (-bb + sqrt(bb * bb - aa * cc)) / aa
+                lam += dlam
+                for i in range(P.size() - 1):  # perform shift
+                    P[i].v -= dlam * (1 - g**P[i].l)
+                P[P.size() - 1].v -= dlam  # correct last pool; |s|_1 instead |c|_1
+                _merge_pools(P, g, 0)
+                for i in range(P.size()):
+                    _fill_pool(P[i], g, c)
+                RSS = _rss(y, c, b[0], T, res)
+                csum = 0
+                for t in range(T):
+                    csum += c[t]
+        else:
+            # update b and lam
+            db = 0
+            for t in range(T):
+                db += y[t] - c[t]
+            db = fmax(db / T, 0 if b_nonneg else -INFINITY) - b[0]
+            b[0] += db
+            lam -= db / (1 - g)
+            # correct last pool
+            i = P.size() - 1
+            P[i].v -= lam * g**P[i].l  # |s|_1 instead |c|_1
+            _fill_pool(P[i], g, c)
+            RSS = _rss(y, c, b[0], T, res)
+            csum = 0
+            for t in range(T):
+                csum += c[t]
+            # until noise constraint is tight or spike train is empty or max_iter reached
+            while fabs(RSS - thresh) > thresh * 1e-4 and csum > 1e-9 and count < max_iter:
+                count += 1
+                # calc total shift dphi due to contribution of baseline and lambda
+                _dual_direction(P, g, tmp)
+                corr = 0
+                for i in range(P.size()):
+                    corr += (1 - g**P[i].l) ** 2 / P[i].w
+                corr = corr / T / (1 - g)
+                aa, bb = 0, 0
+                for t in range(T):
+                    tmp[t] -= corr
+                    aa += tmp[t] * tmp[t]
+                    bb += res[t] * tmp[t]
+                cc = RSS - thresh
+                if bb * bb - aa * cc > 0:
+                    dphi = (-bb + sqrt(bb * bb - aa * cc)) / aa
+                else:
+                    dphi = -bb / aa
+                if b_nonneg:
+                    dphi = fmax(dphi, -b[0] / (1 - g))
+                b[0] += dphi * (1 - g)
+                for i in range(P.size()):  # perform shift
+                    P[i].v -= dphi * (1 - g**P[i].l)
+                _merge_pools(P, g, 0)
+                for i in range(P.size()):
+                    _fill_pool(P[i], g, c)
+                # update b and lam
+                db = 0
+                for t in range(T):
+                    db += y[t] - c[t]
+                db = fmax(db / T, 0 if b_nonneg else -INFINITY) - b[0]
+                b[0] += db
+                dlam = -db / (1 - g)
+                lam += dlam
+                # correct last pool
+                i = P.size() - 1
+                P[i].v -= dlam * g**P[i].l  # |s|_1 instead |c|_1
+                _fill_pool(P[i], g, c)
+                RSS = _rss(y, c, b[0], T, res)
+                csum = 0
+                for t in range(T):
+                    csum += c[t]
+        free(res)
+
+    for i in range(P.size()):
+        _fill_pool(P[i], g, c)
+    # construct s
+    s[0] = 0
+    for t in range(1, T):
+        s[t] = c[t] - g * c[t - 1]
+    return lam
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def oasisAR1_batch(Y, g, sn=None, b=None, lam=None, s_min=0, bint optimize_b=False,
+                   bint b_nonneg=True, int max_iter=5, num_threads=None):
+    """ Infer the most likely discretized spike trains underlying many AR(1) fluorescence traces
+
+    All rows of Y are deconvolved in a single compiled loop that releases the GIL
+    and distributes the traces over num_threads OpenMP threads.
+    If sn is None the sparse non-negative deconvolution problem
+    min 1/2|c-y+b|^2 + lam |s|_1 subject to s_t = c_t-g c_{t-1} >=s_min or =0
+    is solved for each trace (see oasisAR1), otherwise the noise constrained problem
+    min |s|_1 subject to |c-y+b|^2 = sn^2 T and s_t = c_t-g c_{t-1} >= 0
+    (see constrained_oasisAR1 with optimize_g=0, decimate=1 and penalty=1).
+
+    Parameters
+    ----------
+    Y : array of float, shape (K, T)
+        Fluorescence intensities, one trace per row.
+    g : float or array of float, shape (K,)
+        Parameter(s) of the AR(1) process that models the fluorescence impulse response.
+    sn : float or array of float, shape (K,), optional, default None
+        Standard deviation of the noise distribution. Rows with sn <= 0 solve the
+        penalized problem with the given lam.
+    b : float or array of float, shape (K,), optional, default None
+        Fluorescence baseline. If optimize_b it is the initial estimate and defaults to
+        the 15th percentile of each row, otherwise it defaults to 0.
+    lam : float or array of float, shape (K,), optional, default None
+        Sparsity penalty parameter lambda, used for rows without noise constraint.
+    s_min : float or array of float, shape (K,), optional, default 0
+        Minimal non-zero activity within each bin, used for rows without noise constraint.
+    optimize_b : bool, optional, default False
+        Optimize the baseline of the noise constrained rows.
+    b_nonneg: bool, optional, default True
+        Enforce strictly non-negative baseline if True.
+    max_iter : int, optional, default 5
+        Maximal number of iterations when optimizing the baseline.
+    num_threads : int, optional, default None
+        Number of threads, defaults to 1. Use more threads only when the calling process
+        is not one of many workers sharing the cpus.
+
+    Returns
+    -------
+    c : array of float, shape (K, T)
+        The inferred denoised fluorescence signals (without baseline).
+    s : array of float, shape (K, T)
+        Discretized deconvolved neural activity (spikes).
+    b : array of float, shape (K,)
+        Fluorescence baseline values.
+    lam : array of float, shape (K,)
+        Sparsity penalty parameters lambda.
+
+    References
+    ----------
+    * Friedrich J and Paninski L, NIPS 2016
+    * Friedrich J, Zhou P, and Paninski L, PLOS Computational Biology 2017
+    """
+
+    cdef:
+        Py_ssize_t k, K, T
+        int n_threads
+        SINGLE[:, ::1] Y_, C_, S_
+        SINGLE[::1] g_, sn_, b_, lam_, s_min_
+
+    Y_ = np.ascontiguousarray(np.atleast_2d(Y), dtype=np.float32)
+    K, T = Y_.shape[0], Y_.shape[1]
+
+    def per_row(x, default=0):
+        return np.ascontiguousarray(np.broadcast_to(default if x is None else x, (K,)),
+                                    dtype=np.float32).copy()
+
+    g_ = per_row(g)
+    sn_ = per_row(sn)
+    lam_ = per_row(lam)
+    s_min_ = per_row(s_min)
+    if b is None and optimize_b:
+        b = np.percentile(Y_, 15, axis=1)
+        if b_nonneg:
+            b = np.maximum(b, 0)
+    b_ = per_row(b)
+    C_ = np.empty((K, T), dtype=np.float32)
+    S_ = np.empty((K, T), dtype=np.float32)
+    n_threads = 1 if num_threads is None else max(num_threads, 1)
+    if T > 0:
+        for k in prange(K, nogil=True, schedule='dynamic', num_threads=n_threads):
+            lam_[k] = _oasisAR1_row(&Y_[k, 0], T, g_[k], sn_[k], &b_[k], lam_[k], s_min_[k],
+                                    optimize_b, b_nonneg, max_iter, &C_[k, 0], &S_[k, 0])
+
+    return np.asarray(C_), np.asarray(S_), np.asarray(b_), np.asarray(lam_)
@@ -16,6 +16,7 @@ from .initialization import imblur, initialize_components, hals
 import scipy
 from scipy.sparse import coo_matrix, csc_matrix
 from caiman.components_evaluation import compute_event_exceptionality
+from caiman.utils.stats import running_quantile
 from .utilities import update_order
 from caiman.source_extraction.cnmf import oasis
 from sklearn.decomposition import NMF
@@ -27,6 +28,11 @@ try:
 except:
     profile = lambda a: a
 
+try:
+    from time import perf_counter as _clock
+except ImportError:  # python 2
+    from time import time as _clock
+
 
 #%%
 def bare_initialization(Y, init_batch = 1000, k = 1, method_init = 'greedy_roi', gnb = 1,
@@ -367,6 +373,252 @@ def update_shapes(CY, CC, Ab, ind_A, indicator_components=None, Ab_dense=None, u
     return Ab, ind_A, Ab_dense
 
 
+#%%
+def suff_stats_support(ind_A, nb, d):
+    """ block-sparse index of the entries of the sufficient statistics CY that are used
+
+    Only the entries CY[m, ind_A[m - nb]] of the neurons are ever accessed, hence the
+    index lists them component after component, in the same way a csr matrix would.
+
+    Parameters:
+    -----------
+    ind_A: list of ndarray
+        pixels in the support of each neuron
+
+    nb: int
+        number of background components (rows of CY preceding the neurons)
+
+    d: int
+        number of pixels (columns of CY)
+
+    Returns:
+    --------
+    rows, cols: ndarray of int
+        row and pixel of each entry of CY in the supports
+
+    indptr: ndarray of int
+        the entries of neuron m are rows[indptr[m]:indptr[m + 1]]
+
+    flat: ndarray of int
+        position of the entries in the flattened (C order) CY
+    """
+    lens = np.array([len(ind) for ind in ind_A], dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lens)])
+    rows = np.repeat(np.arange(nb, nb + len(ind_A)), lens)
+    cols = np.concatenate(ind_A).astype(np.int64) if len(ind_A) else np.zeros(0, np.int64)
+    return rows, cols, indptr, rows * d + cols
+
+
+def update_suff_stats(CY, CC, ccf, y, w1, w2, support, nb, max_elements=2**22):
+    """ in place update CY = w1 * CY + w2 * ccf.dot(y), CC = w1 * CC + w2 * ccf.dot(ccf.T)
+
+    For the neurons CY is only updated on the supports (see suff_stats_support) and the
+    rank-T correction only touches the components that were active in the minibatch,
+    such that the cost is driven by the number of active components.
+
+    Parameters:
+    -----------
+    CY, CC: ndarray
+        sufficient statistics, (nb + N) x d and (nb + N) x (nb + N)
+
+    ccf: ndarray
+        (nb + N) x T activity of the components in the minibatch
+
+    y: ndarray
+        T x d minibatch of frames
+
+    w1, w2: float
+        weights of the old statistics and of the minibatch
+
+    support: tuple
+        output of suff_stats_support
+
+    nb: int
+        number of background components
+
+    max_elements: int
+        maximal number of elements of the temporary arrays
+    """
+    rows, cols, indptr, flat = support
+    M = nb + len(indptr) - 1
+    active = np.where(np.any(ccf[:M] != 0, 1))[0]
+    # background
+    CY[:nb] *= w1
+    if nb:
+        CY[:nb] += w2 * ccf[:nb].dot(y)
+    # neurons, first decay on the supports then add the contribution of the active ones
+    if CY.flags['C_CONTIGUOUS']:
+        vals = CY.ravel().take(flat)
+    else:
+        vals = CY[rows, cols]
+    vals *= w1
+    act = active[active >= nb] - nb
+    if len(act):
+        lens = indptr[act + 1] - indptr[act]
+        sel = np.repeat(indptr[act] - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens) + \
+            np.arange(lens.sum())
+        step = max(1, max_elements // max(1, ccf.shape[1]))
+        for i in range(0, len(sel), step):
+            s = sel[i:i + step]
+            vals[s] += w2 * np.einsum('ti,ti->i', ccf[rows[s]].T, y[:, cols[s]])
+    if CY.flags['C_CONTIGUOUS']:
+        CY.ravel().put(flat, vals)
+    else:
+        CY[rows, cols] = vals
+    CC *= w1
+    if len(active):
+        CC[np.ix_(active, active)] += w2 * ccf[active].dot(ccf[active].T)
+    return CY, CC
+
+
+def update_AtA(AtA, Ab, idx=None):
+    """ incrementally maintain the overlap matrix AtA = Ab.T.dot(Ab)
+
+    Parameters:
+    -----------
+    AtA: ndarray
+        current overlap matrix, can have fewer rows/columns than Ab has components;
+        the missing ones are appended
+
+    Ab: csc matrix
+        spatial components
+
+    idx: array of int or None
+        components whose shapes changed, None recomputes the whole matrix
+
+    Returns:
+    --------
+    AtA: ndarray
+        updated overlap matrix
+    """
+    M = Ab.shape[1]
+    if idx is None:
+        return (Ab.T.dot(Ab)).toarray()
+    idx = np.union1d(np.asarray(idx, dtype=int), np.arange(AtA.shape[0], M))
+    if AtA.shape[0] < M:
+        AtA_ = np.zeros((M, M), dtype=AtA.dtype)
+        AtA_[:AtA.shape[0], :AtA.shape[0]] = AtA
+        AtA = AtA_
+    if len(idx):
+        tmp = (Ab.T.dot(Ab[:, idx])).toarray()
+        AtA[:, idx] = tmp
+        AtA[idx, :] = tmp.T
+    return AtA
+
+
+#%%
+class StageTimer(object):
+    """ per-frame timings of the stages of the online algorithm, kept in a ring buffer
+
+    Each call to start opens a new record; lap(stage) stores the time elapsed since the
+    previous lap (or start) under the given stage and stop stores the total duration of
+    the frame. Only the last buffer_size frames are kept, in a preallocated array, so
+    that the bookkeeping costs two clock reads per stage.
+
+    Parameters:
+    -----------
+    stages: list of str
+        names of the timed stages
+
+    buffer_size: int
+        number of frames that are kept
+    """
+
+    def __init__(self, stages=('hals', 'oasis', 'residual', 'update_num_components',
+                               'suff_stats', 'shapes'), buffer_size=10000):
+        self.stages = list(stages) + ['total']
+        self._index = dict((stage, i) for i, stage in enumerate(self.stages))
+        self.times = np.zeros((buffer_size, len(self.stages)))
+        self.frames = np.full(buffer_size, -1, dtype=np.int64)
+        self.num_components = np.zeros(buffer_size, dtype=np.int64)
+        self.cur = -1
+        self.count = 0
+
+    def start(self, t, num_components=0):
+        self.cur = (self.cur + 1) % len(self.frames)
+        self.count += 1
+        self.times[self.cur] = 0
+        self.frames[self.cur] = t
+        self.num_components[self.cur] = num_components
+        self._t0 = self._tlap = _clock()
+
+    def lap(self, stage):
+        now = _clock()
+        self.times[self.cur, self._index[stage]] += now - self._tlap
+        self._tlap = now
+
+    def stop(self):
+        self.times[self.cur, -1] = _clock() - self._t0
+
+    def get_records(self):
+        """ recorded frames in chronological order
+
+        Returns:
+        --------
+        frames, num_components: ndarray
+            frame index and number of components of each record
+
+        times: ndarray
+            len(frames) x len(stages) durations in seconds, the last column is the total
+        """
+        n = min(self.count, len(self.frames))
+        order = (np.arange(self.cur + 1 - n, self.cur + 1)) % len(self.frames)
+        return self.frames[order], self.num_components[order], self.times[order]
+
+    def summary(self, percentiles=(50, 90, 99), budget=None):
+        """ percentiles (and mean, max) of the duration of each stage in ms
+
+        Parameters:
+        -----------
+        percentiles: list of float
+            percentiles to report
+
+        budget: float or None
+            time budget per frame in ms, if given the fraction of frames exceeding it is reported
+
+        Returns:
+        --------
+        summary: dict
+            for each stage a dict with keys 'mean', 'max', 'p50', ... (and 'over_budget')
+        """
+        times = self.get_records()[2] * 1000
+        summary = {}
+        for i, stage in enumerate(self.stages):
+            tm = times[:, i]
+            summary[stage] = {'mean': tm.mean() if len(tm) else np.nan,
+                              'max': tm.max() if len(tm) else np.nan}
+            for p in percentiles:
+                summary[stage]['p' + str(p)] = np.percentile(tm, p) if len(tm) else np.nan
+            if budget is not None:
+                summary[stage]['over_budget'] = np.mean(tm > budget) if len(tm) else np.nan
+        return summary
+
+    def print_summary(self, percentiles=(50, 90, 99), budget=None):
+        summary = self.summary(percentiles, budget)
+        keys = ['mean'] + ['p' + str(p) for p in percentiles] + ['max'] + \
+            ([] if budget is None else ['over_budget'])
+        print(('%-22s' + ' %9s' * len(keys)) % tuple(['stage (ms)'] + keys))
+        for stage in self.stages:
+            print(('%-22s' + ' %9.3f' * len(keys)) % tuple([stage] + [summary[stage][k] for k in keys]))
+
+    def save(self, fname):
+        """ export the records to a structured file
+
+        Parameters:
+        -----------
+        fname: str
+            .csv (one row per frame, one column per stage, in seconds) or .npz file
+        """
+        frames, num_components, times = self.get_records()
+        if fname.endswith('.csv'):
+            np.savetxt(fname, np.column_stack([frames, num_components, times]), delimiter=',',
+                       header=','.join(['frame', 'num_components'] + self.stages),
+                       comments='', fmt=['%d', '%d'] + ['%.6e'] * len(self.stages))
+        else:
+            np.savez(fname, frames=frames, num_components=num_components, times=times,
+                     stages=np.array(self.stages))
+
+
 #%%
 class RingBuffer(np.ndarray):
     """ implements ring buffer efficiently"""
@@ -572,7 +824,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
                         np.diff(cin_res)[None, :], robust_std=robust_std, N=N_samples_exceptionality)
                     if remove_baseline:
                         num_samps_bl = min(len(cin_res) // 5, 800)
-                        bl = scipy.ndimage.percentile_filter(cin_res, 8, size=num_samps_bl)
+                        bl = running_quantile(cin_res, 8, num_samps_bl, n_threads=1)
                     else:
                         bl = 0
                     fitness_raw, erfc_raw, std_rr, _ = compute_event_exceptionality(
@@ -191,18 +191,24 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     print('memmaping')
     # we create a memory map file if not already the case, we send Cf, a
     # matrix that include background components
-    C_name, Y_name, folder = creatememmap(Y, np.vstack((C, f)), dview)
+    Cf = np.vstack((C, f))
+    gram = None
+    if method_ls == 'lasso_lars':
+        # the regressions only need the centered and normalized traces and their Gram matrix,
+        # computed once here and restricted to the components of each pixel by the workers
+        Cf, scale = center_and_scale(Cf)
+        gram = Cf.dot(Cf.T)
+    C_name, Y_name, folder = creatememmap(Y, Cf, dview)
+    if gram is not None:
+        gram = (save_temp_array(gram, folder, 'G_temp.npy', dview), scale)
 
     # we create a pixel group array (chunks for the cnmf)for the parrallelization of the process
     print('Updating Spatial Components using lasso lars')
     cct = np.diag(C.dot(C.T))
     pixel_groups = []
-    for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
-        pixel_groups.append([Y_name, C_name, sn, ind2_, list(
-            range(i, i + n_pixels_per_process)), method_ls, cct,])
-    if i < np.prod(dims):
-            pixel_groups.append([Y_name, C_name, sn, ind2_, list(
-            range(i, np.prod(dims))), method_ls, cct])
+    for px in group_pixels_by_support(ind2_, n_pixels_per_process):
+        pixel_groups.append([Y_name, C_name, dict(zip(px, sn[px])), dict((p, ind2_[p]) for p in px),
+                             px, method_ls, cct, gram])
     A_ = np.zeros((d, nr + np.size(f, 0)))    #init A_
     if dview is not None:
         if 'multiprocessing' in str(type(dview)):
@@ -293,6 +299,96 @@ def HALS4shape_bckgrnd(Y_resf, B, F, ind_B, iters=5):
     return B
 
 
+#%%
+def group_pixels_by_support(ind2_, n_pixels_per_process):
+    """split the pixels in chunks for the regression, pixels sharing the same set of
+    components are placed next to each other such that they are solved together
+
+    Parameters:
+    ----------
+    ind2_: list of arrays
+        components that can contribute to each pixel
+
+    n_pixels_per_process: int
+        number of pixels in each chunk
+
+    Returns:
+    --------
+    chunks: list of np.ndarray
+        sorted pixel indices of each chunk, pixels without components are skipped
+    """
+    labels = dict()
+    key = np.empty(len(ind2_), dtype=np.int64)
+    for px, idx in enumerate(ind2_):
+        key[px] = -1 if np.size(idx) == 0 else \
+            labels.setdefault(np.asarray(idx, dtype=np.int64).tobytes(), len(labels))
+    order = np.argsort(key, kind='mergesort')
+    order = order[key[order] >= 0]
+    return [np.sort(order[i:i + n_pixels_per_process])
+            for i in range(0, len(order), n_pixels_per_process)]
+
+
+def center_and_scale(C):
+    """center each trace and scale it to unit norm (as done by LassoLars with normalize=True)
+
+    Returns:
+    --------
+    Cn: np.ndarray
+        normalized traces
+
+    scale: np.ndarray
+        norm of each centered trace (1 for constant traces)
+    """
+    Cn = C - C.mean(1)[:, None]
+    scale = np.sqrt((Cn ** 2).sum(1))
+    scale[scale == 0] = 1
+    Cn /= scale[:, None]
+    return Cn, scale
+
+
+def lasso_positive_gram(G, Xy, lam, max_iter=1000, tol=1e-10):
+    """solve many nonnegative lasso problems sharing the same Gram matrix
+
+    For each column i of Xy solves
+        min_a 1/2 a' G a - Xy[:, i]' a + lam[i] sum(a)   subject to a >= 0
+    by coordinate descent vectorized across the problems. With G = X'X and Xy = X'y
+    this is the lasso min 1/2 ||y - X a||^2 + lam ||a||_1, a >= 0
+
+    Parameters:
+    ----------
+    G: np.ndarray
+        k x k Gram matrix
+
+    Xy: np.ndarray
+        k x n correlations
+
+    lam: np.ndarray
+        n penalties
+
+    Returns:
+    --------
+    a: np.ndarray
+        k x n solutions
+    """
+    k, n = Xy.shape
+    q = Xy - lam[None, :]
+    a = np.zeros((k, n))
+    diag = np.diag(G)
+    if k == 1:
+        return np.maximum(q / diag[0], 0) if diag[0] > 0 else a
+    for _ in range(max_iter):
+        delta = 0
+        for j in range(k):
+            if diag[j] <= 0:
+                continue
+            new = np.maximum(a[j] + (q[j] - G[j].dot(a)) / diag[j], 0)
+            delta = max(delta, np.max(np.abs(new - a[j])))
+            a[j] = new
+        if delta <= tol * max(1, np.max(np.abs(a))):
+            break
+    return a
+
+
 # %%lars_regression_noise_ipyparallel
 def regression_ipyparallel(pars):
     """update spatial footprints and background through Basis Pursuit Denoising
@@ -347,7 +443,8 @@ def regression_ipyparallel(pars):
     import gc
     from sklearn import linear_model
 
-    Y_name, C_name, noise_sn, idxs_C, idxs_Y, method_least_square, cct = pars
+    Y_name, C_name, noise_sn, idxs_C, idxs_Y, method_least_square, cct = pars[:7]
+    gram = pars[7] if len(pars) > 7 else None
     #we load from the memmap file
     if isinstance(Y_name, basestring):
         Y, _, _ = load_memmap(Y_name)
@@ -363,6 +460,28 @@ def regression_ipyparallel(pars):
     _, T = np.shape(C)  # initialize values
     As = []
 
+    if method_least_square == 'lasso_lars' and gram is not None:
+        # C holds the centered and normalized traces, pixels with the same components
+        # are solved together with the Gram matrix restricted to these components
+        G, scale = gram
+        if isinstance(G, basestring):
+            G = np.load(G, mmap_mode='r')
+        groups = dict()
+        for i, px in enumerate(idxs_Y):
+            if np.size(idxs_C[px]) > 0:
+                groups.setdefault(np.asarray(idxs_C[px], dtype=np.int64).tobytes(), []).append(i)
+        for rows in groups.values():
+            idx = np.asarray(idxs_C[idxs_Y[rows[0]]], dtype=np.int64)
+            pxs = [idxs_Y[i] for i in rows]
+            cct_ = cct[idx[idx < len(cct)]]
+            lam = np.zeros(len(rows)) if np.size(cct_) == 0 else \
+                .5 * np.sqrt(np.max(cct_)) * np.array([noise_sn[px] for px in pxs])
+            a = lasso_positive_gram(np.array(G[idx][:, idx]), C[idx].dot(Y[rows].T), lam)
+            a /= scale[idx][:, None]
+            for i, px in enumerate(pxs):
+                As.append((px, idxs_C[px], a[:, i]))
+        return As
+
     for y, px in zip(Y, idxs_Y):
         c = C[idxs_C[px], :]
         idx_only_neurons = idxs_C[px]
@@ -1268,6 +1387,15 @@ def computing_indicator(Y, A_in, b, C, f, nb, method, dims, min_size, max_size,
     return ind2_, nr, C, f, b, A_in
 
 
+def save_temp_array(X, folder, name, dview):
+    """save X in folder for the workers, if any (see creatememmap)"""
+    if dview is None:
+        return X
+    fname = os.path.join(folder, name)
+    np.save(fname, X)
+    return fname
+
+
 def creatememmap(Y, Cf, dview):
     """memmap the C and Y objects in parallel
 
@@ -1297,6 +1425,9 @@ def creatememmap(Y, Cf, dview):
         tmpf = os.environ.get('SLURM_SUBMIT_DIR')
         print(('cluster temporary folder:' + tmpf))
         folder = tempfile.mkdtemp(dir=tmpf)
+    elif 'multiprocessing' in str(type(dview)) and os.path.isdir('/dev/shm'):
+        # the workers run on the same machine, keep the temporary arrays in shared memory
+        folder = tempfile.mkdtemp(dir='/dev/shm')
     else:
         folder = tempfile.mkdtemp()
 
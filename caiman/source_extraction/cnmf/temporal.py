@@ -14,10 +14,11 @@ from scipy.sparse import spdiags, coo_matrix  # ,csgraph
 import scipy
 import numpy as np
 import platform
-from .deconvolution import constrained_foopsi
+from .deconvolution import constrained_foopsi, estimate_parameters
 from .utilities import update_order_greedy
 import sys
-from ...mmapping import parallel_dot_product
+from ...mmapping import parallel_dot_product, _n_workers
+import multiprocessing
 #%%
 
 
@@ -70,6 +71,48 @@ def constrained_foopsi_parallel(arg_in):
     return C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_
 
 
+def use_batched_oasis(argss):
+    """ whether the deconvolution requested by the parameters of constrained_foopsi
+    can be carried out by the batched AR(1) OASIS solver (no optimization of g, L1 penalty)
+    """
+    return (argss.get('method', 'oasis') == 'oasis' and argss.get('p') == 1 and
+            not argss.get('optimize_g', 0) and argss.get('penalty', 1) == 1)
+
+
+def constrained_foopsi_batch(Ytemp, argss, n_threads=1):
+    """ deconvolves all the columns of Ytemp in a single call to the batched OASIS solver
+
+    Parameters:
+    -----------
+    Ytemp: np.ndarray (2D)
+        traces with time in the first axis (T x K)
+
+    argss: dict
+        parameters of constrained_foopsi, see use_batched_oasis
+
+    n_threads: int
+        number of threads of the solver
+
+    Returns:
+    --------
+    results: list
+        one tuple per trace, in the format returned by constrained_foopsi_parallel
+    """
+    from caiman.source_extraction.cnmf.oasis import oasisAR1_batch
+
+    Ytemp = np.asarray(Ytemp)
+    pars = [estimate_parameters(y, p=1, range_ff=argss.get('noise_range', [.25, .5]),
+                                method=argss.get('noise_method', 'logmexp'),
+                                lags=argss.get('lags', 5),
+                                fudge_factor=argss.get('fudge_factor', 1.)) for y in Ytemp.T]
+    g = np.array([np.ravel(gg)[0] for gg, _ in pars])
+    sn = np.array([ss for _, ss in pars])
+    cc, sp, cb, lam = oasisAR1_batch(Ytemp.T, g, sn=sn, optimize_b=True,
+                                     b_nonneg=argss.get('bas_nonneg', True), num_threads=n_threads)
+    return [(cc[jj] + cb[jj], sp[jj], Ytemp[:, jj] - cc[jj] - cb[jj], cb[jj], cc[jj, 0],
+             sn[jj], np.ravel(g[jj]), jj, lam[jj]) for jj in range(Ytemp.shape[1])]
+
+
 #%%
 def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=None, nb=1, ITER=2, block_size=5000, num_blocks_per_run = 20, debug=False, dview=None, **kwargs):
     """Update temporal components and background given spatial components using a block coordinate descent approach.
@@ -354,6 +397,9 @@ def update_iteration (parrllcomp, len_parrllcomp, nb,C, S, bl, nr,
 """
 
     lam=np.repeat(None,nr)
+    # the batched solver uses as many threads as the workers of dview (one without dview, as in
+    # the workers processing the patches), so that the cores are not oversubscribed
+    n_threads = min(_n_workers(dview), multiprocessing.cpu_count())
     for _ in range(ITER):
 		 
         for count, jo_ in enumerate(parrllcomp):
@@ -366,7 +412,10 @@ def update_iteration (parrllcomp, len_parrllcomp, nb,C, S, bl, nr,
             args_in = [(np.squeeze(np.array(Ytemp[:, jj])), nT[jj], jj, None,
                         None, None, None, kwargs) for jj in range(len(jo))]
             #computing the most likely discretized spike train underlying a fluorescence trace
-            if 'multiprocessing' in str(type(dview)):                
+            if use_batched_oasis(kwargs):
+                results = constrained_foopsi_batch(Ytemp, kwargs, n_threads=n_threads)
+
+            elif 'multiprocessing' in str(type(dview)):                
                 results = dview.map_async(constrained_foopsi_parallel, args_in).get(4294967)
             
             elif dview is not None and platform.system()!='Darwin':                                    
@@ -30,6 +30,7 @@ from ...base.rois import com
 import pylab as pl
 import scipy
 from ...mmapping import parallel_dot_product
+from ...utils.stats import running_quantile
 
 
 #%%
@@ -346,7 +347,7 @@ def computeDFF_traces(Yr, A, C, bl, quantileMin=8, frames_window=200):
 
 
 #%%
-def extract_DF_F(Yr, A, C,  bl, quantileMin=8, frames_window=200, block_size=400, dview=None):
+def extract_DF_F(Yr, A, C,  bl, quantileMin=8, frames_window=200, block_size=400, dview=None, decimate=1):
     """ Compute DFF function from cnmf output.
 
      Disclaimer: it might be memory inefficient
@@ -371,6 +372,10 @@ def extract_DF_F(Yr, A, C,  bl, quantileMin=8, frames_window=200, block_size=400
     frames_window: int
         number of frames for running quantile
 
+    decimate: int
+        if larger than 1 the running quantile is approximated on one frame every decimate
+        frames (see utils.stats.running_quantile)
+
     Returns:
     -------
 
@@ -415,14 +420,14 @@ def extract_DF_F(Yr, A, C,  bl, quantileMin=8, frames_window=200, block_size=400
         C_df = Cf / Df[:, None]
 
     else:
-        Df = scipy.ndimage.percentile_filter(C2, quantileMin, (frames_window, 1))
+        Df = running_quantile(C2, quantileMin, frames_window, decimate=decimate)
         C_df = Cf / Df
 
     return C_df
 
 
 #%%
-def detrend_df_f(A, b, C, f, YrA = None, quantileMin=8, frames_window=200, block_size=400):
+def detrend_df_f(A, b, C, f, YrA = None, quantileMin=8, frames_window=200, block_size=400, decimate=1):
     """ Compute DF/F signal without using the original data.
     In general much faster than extract_DF_F
     
@@ -448,6 +453,10 @@ def detrend_df_f(A, b, C, f, YrA = None, quantileMin=8, frames_window=200, block
 
     frames_window: int
         number of frames for running quantile
+
+    decimate: int
+        if larger than 1 the running quantile is approximated on one frame every decimate
+        frames (see utils.stats.running_quantile)
         
     Returns:
     ----------
@@ -480,8 +489,8 @@ def detrend_df_f(A, b, C, f, YrA = None, quantileMin=8, frames_window=200, block
         Df = np.percentile(B, quantileMin, axis=1)
         F_df = (F - Fd) / (Df[:, None] +  Fd[:,None])
     else:
-        Fd = scipy.ndimage.percentile_filter(F, quantileMin, (frames_window, 1))
-        Df = scipy.ndimage.percentile_filter(B, quantileMin, (frames_window, 1))
+        Fd = running_quantile(F, quantileMin, frames_window, decimate=decimate)
+        Df = running_quantile(B, quantileMin, frames_window, decimate=decimate)
         F_df = (F - Fd) / (Df + Fd)
     return F_df
     
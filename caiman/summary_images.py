@@ -18,6 +18,7 @@ See Also:
 
 from __future__ import division
 from builtins import range
+from past.builtins import basestring
 import numpy as np
 from scipy.ndimage.filters import convolve
 import cv2
@@ -26,7 +27,7 @@ import pdb
 #%%
 
 
-def max_correlation_image(Y, bin_size=1000, eight_neighbours=True, swap_dim=True):
+def max_correlation_image(Y, bin_size=1000, eight_neighbours=True, swap_dim=True, dview=None):
     """Computes the max-correlation image for the input dataset Y with bin_size
 
     Parameters:
@@ -46,6 +47,9 @@ def max_correlation_image(Y, bin_size=1000, eight_neighbours=True, swap_dim=True
         True indicates that time is listed in the last axis of Y (matlab format)
         and moves it in the front
 
+    dview: ipyparallel view or multiprocessing pool
+        to process the bins in parallel
+
     Returns:
     --------
 
@@ -59,21 +63,15 @@ def max_correlation_image(Y, bin_size=1000, eight_neighbours=True, swap_dim=True
 
     T = Y.shape[0]
     if T <= bin_size:
-        Cn_bins = local_correlations_fft(Y, eight_neighbours=eight_neighbours, swap_dim=False)
-        return Cn_bins
-    else:
-        if T % bin_size < bin_size / 2.:
-            bin_size = T // (T // bin_size)
-
-        n_bins = T // bin_size
-        Cn_bins = np.zeros(((n_bins,) + Y.shape[1:]))
-        for i in range(n_bins):
-            Cn_bins[i] = local_correlations_fft(Y[i * bin_size:(i + 1) * bin_size],
-                                                eight_neighbours=eight_neighbours, swap_dim=False)
-            print(i * bin_size)
+        bin_size = T
+    elif T % bin_size < bin_size / 2.:
+        bin_size = T // (T // bin_size)
 
-        Cn = np.max(Cn_bins, axis=0)
-        return Cn
+    n_bins = T // bin_size
+    Cn_max = summary_images_chunked(Y[:n_bins * bin_size], swap_dim=False, chunk_size=bin_size,
+                                    eight_neighbours=eight_neighbours, dview=dview,
+                                    compute_pnr=False)[2]
+    return Cn_max
 
 
 #%%
@@ -220,14 +218,21 @@ def local_correlations(Y, eight_neighbours=True, swap_dim=True):
     return rho
 
 
-def correlation_pnr(Y, gSig=None, center_psf=True, swap_dim=True):
+def correlation_pnr(Y, gSig=None, center_psf=True, swap_dim=True, chunk_size=None, dview=None):
     """
     compute the correlation image and the peak-to-noise ratio (PNR) image.
     If gSig is provided, then spatially filtered the video.
 
+    The movie is processed in chunks of chunk_size frames (see summary_images_chunked):
+    a first pass computes the mean, max and noise level of each pixel, a second pass the
+    correlation image of the standardized and thresholded movie. When the movie is split
+    in several chunks the noise level is the geometric mean of the noise levels of the
+    chunks, which differs from the noise level of the whole movie, and so do the pnr and
+    correlation images.
+
     Args:
-        Y:  np.ndarray (3D or 4D).
-            Input movie data in 3D or 4D format
+        Y:  np.ndarray (3D or 4D), or str.
+            Input movie data in 3D or 4D format, or name of a movie file
         gSig:  scalar or vector.
             gaussian width. If gSig == None, no spatial filtering
         center_psf: Boolearn
@@ -235,6 +240,11 @@ def correlation_pnr(Y, gSig=None, center_psf=True, swap_dim=True):
         swap_dim: Boolean
             True indicates that time is listed in the last axis of Y (matlab format)
             and moves it in the front
+        chunk_size: int or None
+            number of frames processed at once. None processes the whole movie at once,
+            estimating the noise level on the whole movie
+        dview: ipyparallel view or multiprocessing pool
+            to process the chunks in parallel
 
     Returns:
         cn: np.ndarray (2D or 3D).
@@ -244,46 +254,265 @@ def correlation_pnr(Y, gSig=None, center_psf=True, swap_dim=True):
             peak-to-noise ratios of all pixels/voxels
 
     """
-    if swap_dim:
-        Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+    _, pnr, _, stats = summary_images_chunked(Y, gSig=gSig, center_psf=center_psf, swap_dim=swap_dim,
+                                              chunk_size=chunk_size, dview=dview)
+
+    # correlation image after removing small values
+    normalize = (stats['mean'], np.sqrt(stats['sn2']))
+    cn = summary_images_chunked(Y, gSig=gSig, center_psf=center_psf, swap_dim=swap_dim,
+                                chunk_size=chunk_size, dview=dview, normalize=normalize,
+                                compute_pnr=False)[0]
+
+    return cn, pnr
+
+
+#%%
+def _neighbour_offsets(ndim, eight_neighbours=True):
+    """ offsets to half of the neighbours of a pixel (the other half are their opposites),
+    with the same neighbourhoods as local_correlations_fft
+
+    Parameters:
+    -----------
+    ndim: int
+        number of spatial dimensions (2 or 3)
+
+    eight_neighbours: Boolean
+        see local_correlations_fft
+
+    Returns:
+    --------
+    offsets: list of tuples
+    """
+    if eight_neighbours:
+        offsets = [o for o in np.ndindex(*((3,) * ndim))]
+    else:
+        offsets = [tuple(1 + (np.arange(ndim) == d)) for d in range(ndim)]
+    offsets = [tuple(np.array(o) - 1) for o in offsets]
+    return [o for o in offsets if any(o) and o[np.flatnonzero(o)[0]] > 0]
 
-    # parameters
-    T, d1, d2 = Y.shape
-    data_raw = Y.reshape(-1, d1, d2).astype('float32')
 
-    # filter data
-    data_filtered = data_raw.copy()
+def _offset_slices(shape, offset):
+    """ slices selecting the pixels x such that x + offset is in the image, and x + offset """
+    src = tuple(slice(0, n - d) if d >= 0 else slice(-d, n) for n, d in zip(shape, offset))
+    dst = tuple(slice(d, n) if d >= 0 else slice(0, n + d) for n, d in zip(shape, offset))
+    return src, dst
+
+
+def _filter_frames(Y, gSig=None, center_psf=True):
+    """ float32 copy of the frames of Y, spatially filtered as in correlation_pnr """
+    Y = np.array(Y, dtype='float32')
     if gSig:
         if not isinstance(gSig, list):
             gSig = [gSig, gSig]
         ksize = tuple([(3 * i) // 2 * 2 + 1 for i in gSig])
-        # create a spatial filter for removing background
-        # psf = gen_filter_kernel(width=ksize, sigma=gSig, center=center_psf)
-
-        if center_psf:
-            for idx, img in enumerate(data_filtered):
-                data_filtered[idx, ] = cv2.GaussianBlur(img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1) \
+        for idx, img in enumerate(Y):
+            if center_psf:
+                Y[idx, ] = cv2.GaussianBlur(img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1) \
                     - cv2.boxFilter(img, ddepth=-1, ksize=ksize, borderType=1)
-            # data_filtered[idx, ] = cv2.filter2D(img, -1, psf, borderType=1)
-        else:
-            for idx, img in enumerate(data_filtered):
-                data_filtered[idx, ] = cv2.GaussianBlur(
-                    img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1)
-
-    # compute peak-to-noise ratio
-    data_filtered -= np.mean(data_filtered, axis=0)
-    data_max = np.max(data_filtered, axis=0)
-    data_std = get_noise_fft(data_filtered.transpose())[0].transpose()
-    # data_std = get_noise(data_filtered, method='diff2_med')
-    pnr = np.divide(data_max, data_std)
-    pnr[pnr < 0] = 0
-
-    # remove small values
-    tmp_data = data_filtered.copy() / data_std
-    tmp_data[tmp_data < 3] = 0
-
-    # compute correlation image
-    # cn = local_correlation(tmp_data, d1=d1, d2=d2)
-    cn = local_correlations_fft(tmp_data, swap_dim=False)
+            else:
+                Y[idx, ] = cv2.GaussianBlur(img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1)
+    return Y
 
-    return cn, pnr
+
+def correlations_from_stats(stats, eight_neighbours=True):
+    """ local correlation image from the sufficient statistics of a movie
+
+    Parameters:
+    -----------
+    stats: dict
+        with keys 'n' (number of frames), 'mean' (mean frame), 'm2' (sum over time of the
+        squared deviations from the mean) and 'mx' (for each offset of _neighbour_offsets,
+        sum over time of the product of the deviations of each pixel and of the pixel at
+        that offset), see summary_stats_chunk
+
+    eight_neighbours: Boolean
+        see local_correlations_fft
+
+    Returns:
+    --------
+    Cn: d1 x d2 [x d3] matrix, cross-correlation with adjacent pixels, as local_correlations_fft
+    """
+    std = np.sqrt(stats['m2'])
+    std[std == 0] = np.inf
+    Cn = np.zeros(std.shape)
+    n_neighbours = np.zeros(std.shape)
+    for offset, mx in zip(_neighbour_offsets(std.ndim, eight_neighbours), stats['mx']):
+        src, dst = _offset_slices(std.shape, offset)
+        corr = mx[src] / (std[src] * std[dst])
+        Cn[src] += corr
+        Cn[dst] += corr
+        n_neighbours[src] += 1
+        n_neighbours[dst] += 1
+    return Cn / n_neighbours
+
+
+def _merge_stats(stats, res, eight_neighbours=True):
+    """ add the statistics res of a chunk to the statistics of the previous chunks, updating
+    the sums of deviations with the pairwise formulas of Chan et al. """
+    n_a, n_b = stats['n'], res['n']
+    n = float(n_a + n_b)
+    delta = res['mean'] - stats['mean']
+    stats['mean'] = stats['mean'] + delta * (n_b / n)
+    stats['m2'] = stats['m2'] + res['m2'] + delta ** 2 * (n_a * n_b / n)
+    for mx, mx_res, offset in zip(stats['mx'], res['mx'], _neighbour_offsets(delta.ndim, eight_neighbours)):
+        src, dst = _offset_slices(delta.shape, offset)
+        mx[src] += mx_res[src] + delta[src] * delta[dst] * (n_a * n_b / n)
+    stats['n'] = n_a + n_b
+    return stats
+
+
+def summary_stats_chunk(pars):
+    """ sufficient statistics of a chunk of frames for the summary images
+
+    Parameters:
+    -----------
+    pars: tuple
+        Y: np.ndarray (frames first), or (file_name, first frame, last frame) to load the
+            frames in the worker
+        gSig, center_psf: see correlation_pnr
+        eight_neighbours: see local_correlations_fft
+        normalize: None, or (mean, std) images. The frames are then standardized and the
+            values below 3 set to 0 before computing the statistics (as in correlation_pnr)
+        compute_pnr: whether to compute the max and the noise of the frames
+
+    Returns:
+    --------
+    stats: dict
+        n, mean, m2, mx: see correlations_from_stats
+        max: max of the frames (if compute_pnr)
+        sn2: noise variance of each pixel, estimated with get_noise_fft (if compute_pnr)
+        Cn: local correlation image of the chunk
+    """
+    Y, gSig, center_psf, eight_neighbours, normalize, compute_pnr = pars
+    if isinstance(Y, tuple):
+        import caiman
+        Y = caiman.load(Y[0], subindices=slice(Y[1], Y[2]))
+    Y = _filter_frames(Y, gSig=gSig, center_psf=center_psf)
+    stats = {'n': len(Y)}
+    if compute_pnr:
+        stats['max'] = np.max(Y, axis=0)
+        stats['sn2'] = get_noise_fft(np.transpose(Y))[0].transpose() ** 2
+    if normalize is not None:
+        Y -= normalize[0].astype('float32')
+        Y /= normalize[1].astype('float32')
+        Y[Y < 3] = 0
+
+    # the deviations from the mean of the chunk are small enough to be summed in single precision
+    stats['mean'] = np.mean(Y, axis=0, dtype=np.float64)
+    Y -= stats['mean'].astype('float32')
+    stats['m2'] = np.einsum('t...,t...->...', Y, Y).astype(np.float64)
+    stats['mx'] = []
+    for offset in _neighbour_offsets(Y.ndim - 1, eight_neighbours):
+        src, dst = _offset_slices(Y.shape[1:], offset)
+        mx = np.zeros(Y.shape[1:])
+        mx[src] = np.einsum('t...,t...->...', Y[(slice(None),) + src], Y[(slice(None),) + dst])
+        stats['mx'].append(mx)
+    stats['Cn'] = correlations_from_stats(stats, eight_neighbours=eight_neighbours)
+    return stats
+
+
+def _chunk_bounds(T, chunk_size=None):
+    """ first and last frame of the chunks of chunk_size frames of a movie of T frames. A last
+    chunk shorter than half a chunk (or than 2 frames) is merged with the previous one, since
+    the noise level cannot be estimated on too few frames """
+    if chunk_size is None:
+        chunk_size = T
+    starts = list(range(0, T, chunk_size))
+    if len(starts) > 1 and T - starts[-1] < max(chunk_size / 2., 2):
+        starts.pop()
+    return list(zip(starts, starts[1:] + [T]))
+
+
+def summary_images_chunked(Y, gSig=None, center_psf=True, swap_dim=True, chunk_size=1000,
+                           eight_neighbours=True, dview=None, normalize=None, compute_pnr=True):
+    """ correlation, peak-to-noise ratio and max-correlation images in one pass over the movie
+
+    The movie is processed in chunks of chunk_size frames, possibly in parallel, and only
+    running statistics of the size of a frame are kept, so that arbitrarily long movies
+    can be summarized.
+
+    Parameters:
+    -----------
+    Y:  np.ndarray (3D or 4D), or str
+        Input movie data in 3D or 4D format, or name of a movie file (frames first) that
+        is read chunk by chunk
+
+    gSig, center_psf: see correlation_pnr
+        the frames are spatially filtered before computing the images
+
+    swap_dim: Boolean
+        True indicates that time is listed in the last axis of Y (matlab format)
+        and moves it in the front
+
+    chunk_size: int or None
+        number of frames per chunk, also the bin size of the max-correlation image. A last
+        chunk shorter than half a chunk is merged with the previous one. None processes
+        the whole movie as a single chunk
+
+    eight_neighbours: Boolean
+        see local_correlations_fft
+
+    dview: ipyparallel view or multiprocessing pool
+        to process the chunks in parallel
+
+    normalize: None or (mean, std) images
+        see summary_stats_chunk
+
+    compute_pnr: Boolean
+        whether to compute the peak-to-noise ratio image
+
+    Returns:
+    --------
+    Cn: d1 x d2 [x d3] matrix,
+        local correlation image of the (filtered) movie
+
+    pnr: d1 x d2 [x d3] matrix,
+        peak-to-noise ratio of the (filtered and centered) movie (None if not compute_pnr)
+
+    Cn_max: d1 x d2 [x d3] matrix,
+        max over the chunks of their local correlation images
+
+    stats: dict
+        statistics of the whole movie, see summary_stats_chunk
+    """
+    if isinstance(Y, basestring):
+        import caiman
+        T = caiman.mmapping.get_file_size(Y)[1]
+        chunks = ((Y, start, end) for start, end in _chunk_bounds(T, chunk_size))
+    else:
+        if swap_dim:
+            Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+        chunks = (Y[start:end] for start, end in _chunk_bounds(len(Y), chunk_size))
+    pars = ((chunk, gSig, center_psf, eight_neighbours, normalize, compute_pnr) for chunk in chunks)
+
+    if dview is None:
+        results = map(summary_stats_chunk, pars)
+    elif 'multiprocessing' in str(type(dview)):
+        results = dview.imap(summary_stats_chunk, pars)
+    else:
+        results = dview.map_sync(summary_stats_chunk, list(pars))
+
+    stats = None
+    for res in results:
+        if compute_pnr:
+            res['sn2'] = np.log(res['sn2']) * res['n']
+        if stats is None:
+            stats = res
+            stats['Cn_max'] = res['Cn']
+            continue
+        stats['Cn_max'] = np.maximum(stats['Cn_max'], res['Cn'])
+        if compute_pnr:
+            stats['max'] = np.maximum(stats['max'], res['max'])
+            stats['sn2'] += res['sn2']
+        stats = _merge_stats(stats, res, eight_neighbours=eight_neighbours)
+
+    Cn = correlations_from_stats(stats, eight_neighbours=eight_neighbours)
+    pnr = None
+    if compute_pnr:
+        # the power spectral densities of all the chunks are averaged in the log domain,
+        # as get_noise_fft does with noise_method='logmexp' on a single chunk
+        stats['sn2'] = np.exp(stats['sn2'] / stats['n'])
+        pnr = np.divide(stats['max'] - stats['mean'], np.sqrt(stats['sn2']))
+        pnr[pnr < 0] = 0
+
+    return Cn, pnr, stats['Cn_max'], stats
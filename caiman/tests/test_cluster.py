@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import numpy.testing as npt
+import numpy as np
+import caiman as cm
+from caiman import cluster
+
+
+def patch_mean(Y):
+    return Y.mean(0)
+
+
+def test_shared_patch_groups():
+    folder = tempfile.mkdtemp()
+    try:
+        np.random.seed(0)
+        mov = np.random.rand(40, 30, 34).astype(np.float32)
+        fname = cm.save_memmap([mov], base_name=os.path.join(folder, 'Yr'), order='C')
+        idx_flat, idx_2d = cluster.extract_patch_coordinates((30, 34), rf=(6, 6), stride=(3, 3))
+        idx_flat = list(idx_flat)
+        Yr, _, _ = cm.load_memmap(fname)
+        seen = []
+        for wave in cluster.iter_shared_patch_groups(fname, idx_flat, shared_dir=folder,
+                                                     max_shared_bytes=40 * 30 * 13 * 4):
+            for count, staged, offset in wave:
+                Ys, _, _ = cm.load_memmap(staged)
+                npt.assert_array_equal(Ys[idx_flat[count] - offset], Yr[idx_flat[count]])
+                seen.append(count)
+        npt.assert_equal(sorted(seen), list(range(len(idx_flat))))
+        npt.assert_equal([f for f in os.listdir(folder) if f.startswith('tmp')], [])
+
+        res, _, _ = cluster.apply_to_patch(Yr, (40, 30, 34), None, 6, 3, patch_mean)
+        res_shared, _, _ = cluster.apply_to_patch(Yr, (40, 30, 34), None, 6, 3, patch_mean,
+                                                  shared_memory=True)
+        npt.assert_equal(len(res_shared), len(idx_flat))
+        for r, r_shared in zip(res, res_shared):
+            npt.assert_allclose(r_shared, r)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_plan_resources():
+    np.random.seed(0)
+    Yr = np.random.rand(30 * 34, 200).astype(np.float32)
+    coefs = cluster.calibrate_memory(Yr, (30, 34))
+    npt.assert_equal(sorted(coefs), ['dot_product', 'preprocess', 'spatial'])
+    assert min(coefs.values()) >= 4
+    coefs['patch'] = 50.
+    dims, T = (512, 512), 10000
+    for max_memory in [64, 2]:
+        plan = cluster.plan_resources(dims, T, coefs, max_memory=max_memory, n_processes=8,
+                                      rf=40, stride=8)
+        budget = max_memory * 2.**30 / plan['n_processes']
+        assert plan['n_pixels_per_process'] * T * coefs['spatial'] <= budget
+        assert 2 * plan['block_size'] * T * coefs['dot_product'] <= budget
+        assert (2 * plan['rf'] + 1) ** 2 * T * coefs['patch'] <= budget
+        npt.assert_equal(plan['n_processes'], 8)
+    # the patches are reduced to fit in 2 GB, keeping the proportion of overlap
+    assert plan['rf'] < 40
+    npt.assert_equal(plan['stride'], int(round(8 * plan['rf'] / 40.)))
@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy.testing as npt
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.stats
+from caiman import components_evaluation
+
+
+def test_compute_r_values():
+    np.random.seed(0)
+    A = scipy.sparse.random(300, 12, density=0.1, format='csc', random_state=0)
+    Y = np.random.rand(300, 80).astype(np.float32)
+    frames = [None if i == 3 else np.sort(np.random.choice(80, 10, replace=False))
+              for i in range(12)]
+    expected = np.zeros(12)
+    for i, fr in enumerate(frames):
+        if fr is not None:
+            a = A[:, i].toarray().ravel()
+            px = np.where(a > 0)[0]
+            expected[i] = scipy.stats.pearsonr(Y[px][:, fr].mean(1), a[px])[0]
+    for Y_ in [Y, np.asfortranarray(Y)]:
+        rval = components_evaluation.compute_r_values(Y_, A, frames, num_comps_per_chunk=5)
+        npt.assert_allclose(rval, expected, atol=1e-6)
+
+
+def naive_forward(x, kernels, dense):
+    # x: rows x columns, network conv(valid, relu) -> conv(same, relu) -> maxpool -> dense -> softmax
+    for kernel, bias, padding in kernels:
+        kh, kw, _, n_filters = kernel.shape
+        if x.ndim == 2:
+            x = x[:, :, None]
+        if padding == 'same':
+            x = np.pad(x, ((kh // 2, kh // 2), (kw // 2, kw // 2), (0, 0)), mode='constant')
+        out = np.zeros((x.shape[0] - kh + 1, x.shape[1] - kw + 1, n_filters))
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                out[i, j] = np.tensordot(x[i:i + kh, j:j + kw], kernel, axes=3) + bias
+        x = np.maximum(out, 0)
+    h, w = x.shape[0] // 2, x.shape[1] // 2
+    x = np.array([[x[2 * i:2 * i + 2, 2 * j:2 * j + 2].max(axis=(0, 1)) for j in range(w)]
+                  for i in range(h)])
+    y = x.ravel().dot(dense[0]) + dense[1]
+    return np.exp(y) / np.exp(y).sum()
+
+
+def test_numpy_cnn():
+    import h5py
+    np.random.seed(0)
+    kernels = [(np.random.randn(3, 3, 1, 4), np.random.randn(4), 'valid'),
+               (np.random.randn(3, 3, 4, 5), np.random.randn(5), 'same')]
+    dense = [np.random.randn(5 * 5 * 5, 2) * .1, np.random.randn(2)]
+    layers = [{'class_name': 'Conv2D', 'config': {'name': 'conv_0', 'padding': 'valid', 'activation': 'relu',
+                                                  'strides': [1, 1], 'dilation_rate': [1, 1]}},
+              {'class_name': 'Conv2D', 'config': {'name': 'conv_1', 'padding': 'same', 'activation': 'linear',
+                                                  'strides': [1, 1], 'dilation_rate': [1, 1]}},
+              {'class_name': 'Activation', 'config': {'name': 'act_0', 'activation': 'relu'}},
+              {'class_name': 'MaxPooling2D', 'config': {'name': 'pool_0', 'pool_size': [2, 2], 'strides': [2, 2]}},
+              {'class_name': 'Dropout', 'config': {'name': 'drop_0', 'rate': 0.5}},
+              {'class_name': 'Flatten', 'config': {'name': 'flat_0'}},
+              {'class_name': 'Dense', 'config': {'name': 'dense_0', 'activation': 'softmax'}}]
+    folder = tempfile.mkdtemp()
+    try:
+        model_name = os.path.join(folder, 'model')
+        with open(model_name + '.json', 'w') as f:
+            json.dump({'class_name': 'Sequential', 'config': layers}, f)
+        with h5py.File(model_name + '.h5', 'w') as f:
+            for name, weights in [('conv_0', kernels[0][:2]), ('conv_1', kernels[1][:2]), ('dense_0', dense)]:
+                names = [(name + '/' + w + ':0').encode('utf8') for w in ['kernel', 'bias']]
+                f.create_group(name).attrs['weight_names'] = names
+                for w_name, w in zip(names, weights):
+                    f[name].create_dataset(w_name.decode('utf8'), data=w)
+        model = components_evaluation.load_CNN_model(model_name, use_keras=False)
+        assert components_evaluation.load_CNN_model(model_name, use_keras=False) is model
+        X = np.random.rand(7, 12, 12)
+        predictions = model.predict(X[:, :, :, None], batch_size=3)
+        npt.assert_allclose(predictions, [naive_forward(x, kernels, dense) for x in X], rtol=1e-4)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_evaluate_fitness_slow_baseline():
+    np.random.seed(0)
+    traces = np.random.randn(4, 500) + np.linspace(0, 5, 500)
+    fitness_raw = components_evaluation.evaluate_fitness(traces.copy(), slow_baseline=True)[0]
+    bl = scipy.ndimage.percentile_filter(traces, 8, size=(1, 100))
+    expected = components_evaluation.compute_event_exceptionality(traces - bl)[0]
+    npt.assert_allclose(fitness_raw, expected)
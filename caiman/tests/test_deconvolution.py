@@ -78,3 +78,33 @@ def test_oasis():
 #         foo('cvx', 2)
 #     except:
 #         pass
+
+
+def test_oasis_batch():
+    from caiman.source_extraction.cnmf.oasis import oasisAR1_batch, constrained_oasisAR1
+    Y = gen_data(sn=.3, N=5)[0].astype(np.float32)
+    c, s, b, lam = oasisAR1_batch(Y, .95, sn=.3, optimize_b=True, num_threads=2)
+    for k, y in enumerate(Y):
+        res = constrained_oasisAR1(y, .95, .3, optimize_b=True)
+        npt.assert_allclose(c[k], res[0], atol=1e-3)
+        npt.assert_allclose(s[k], res[1], atol=1e-3)
+        npt.assert_allclose(b[k], res[2], rtol=1e-4)
+
+
+def test_oasis_bank():
+    from caiman.source_extraction.cnmf.oasis import OASIS, OASISBank
+    Y = gen_data(sn=.3, N=6, T=300, b=0)[0].astype(np.float32)
+    g = [[.95, 0]] * 3 + [[1.7, -.71]] * 3
+    oases = [OASIS(gg[0], lam=.1, g2=gg[1]) for gg in g]
+    bank = OASISBank([OASIS(gg[0], lam=.1, g2=gg[1]) for gg in g])
+    C = np.zeros_like(Y)
+    C_ref = np.zeros_like(Y)
+    for t in range(Y.shape[1]):
+        bank.fit_next(Y[:, t], C, t)
+        for k, o in enumerate(oases):
+            o.fit_next(Y[k, t])
+            C_ref[k, t - o.get_l_of_last_pool() + 1:t + 1] = o.get_c_of_last_pool()
+    npt.assert_allclose(C, C_ref)
+    npt.assert_allclose(C[:, -1], [o.c[-1] for o in bank], rtol=1e-5)
+    del bank[0]
+    npt.assert_equal(len(bank), 5)
@@ -0,0 +1,20 @@
+import numpy.testing as npt
+import numpy as np
+from caiman.source_extraction.cnmf import initialization
+
+
+def test_compute_W():
+    np.random.seed(0)
+    dims, T, K, radius = (12, 15), 200, 3, 3
+    A = np.random.rand(np.prod(dims), K) * (np.random.rand(np.prod(dims), K) > 0.8)
+    C = np.random.rand(K, T)
+    Y = np.random.randn(np.prod(dims), T) + A.dot(C) + 5
+    W, b0 = initialization.compute_W(Y, A, C, dims, radius, block_size=50)
+    X = Y - A.dot(C) - b0[:, None]
+    # each row of W is the least squares fit of a pixel from the pixels on its ring
+    for p in [0, 5, 90, np.prod(dims) - 1]:
+        ring = W.indices[W.indptr[p]:W.indptr[p + 1]]
+        npt.assert_allclose(W.data[W.indptr[p]:W.indptr[p + 1]],
+                            np.linalg.lstsq(X[ring].T, X[p], rcond=None)[0], rtol=1e-3, atol=1e-5)
+    W_ooc, _ = initialization.compute_W(Y, A, C, dims, radius, data_fits_in_memory=False, block_size=70)
+    npt.assert_allclose(W_ooc.toarray(), W.toarray(), rtol=1e-4, atol=1e-6)
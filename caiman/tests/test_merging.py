@@ -0,0 +1,15 @@
+import numpy.testing as npt
+import numpy as np
+import scipy.stats
+from caiman.source_extraction.cnmf import merging
+
+
+def test_overlap_correlations():
+    np.random.seed(0)
+    C = np.random.randn(20, 100)
+    C[5] = 3.  # constant trace
+    rows, cols = np.triu_indices(20, 1)
+    corr = merging.overlap_correlations(C, rows, cols, max_pairs_per_chunk=7)
+    expected = [0 if 5 in (i, j) else scipy.stats.pearsonr(C[i], C[j])[0]
+                for i, j in zip(rows, cols)]
+    npt.assert_allclose(corr, expected, atol=1e-12)
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import numpy.testing as npt
+import numpy as np
+import scipy.sparse
+import caiman as cm
+from caiman import mmapping
+
+
+def gen_movie(T=50, dims=(20, 30), seed=0):
+    np.random.seed(seed)
+    return (10 + np.random.rand(T, *dims)).astype(np.float32)
+
+
+def test_header_roundtrip():
+    folder = tempfile.mkdtemp()
+    try:
+        mov = gen_movie()
+        for dtype in [np.float32, np.float16]:
+            fname = cm.save_memmap([mov], base_name=os.path.join(folder, 'my_movie'),
+                                   order='C', dtype=dtype)
+            header = mmapping.load_memmap_header(fname)
+            npt.assert_equal(header['dims'], [20, 30])
+            npt.assert_equal(header['T'], 50)
+            Yr, dims, T = cm.load_memmap(fname)
+            npt.assert_equal(Yr.dtype, np.dtype(dtype))
+            npt.assert_equal(dims, (20, 30))
+            images = np.reshape(Yr.T, [T] + list(dims), order='F')
+            npt.assert_allclose(images, mov, rtol=1e-3)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_append_to_memmap():
+    folder = tempfile.mkdtemp()
+    try:
+        mov = gen_movie()
+        fname = cm.save_memmap([mov[:30]], base_name=os.path.join(folder, 'Yr'), order='F')
+        T = mmapping.append_to_memmap(fname, mov[30:])
+        npt.assert_equal(T, 50)
+        Yr, dims, T = cm.load_memmap(fname)
+        images = np.reshape(Yr.T, [T] + list(dims), order='F')
+        npt.assert_allclose(images, mov, rtol=1e-6)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_save_memmap_chunked():
+    folder = tempfile.mkdtemp()
+    try:
+        mov = gen_movie(T=57)
+        fname_tif = os.path.join(folder, 'mov.tif')
+        mmapping.tifffile.imsave(fname_tif, mov)
+        idx_xy = (slice(2, 15), slice(5, 25))
+        for order in ['C', 'F']:
+            fname = cm.save_memmap([fname_tif, fname_tif], base_name=os.path.join(folder, 'Yr'),
+                                   order=order, remove_init=2, idx_xy=idx_xy, frames_per_chunk=10)
+            Yr, dims, T = cm.load_memmap(fname)
+            npt.assert_equal(dims, (13, 20))
+            npt.assert_equal(T, 110)
+            images = np.reshape(Yr.T, [T] + list(dims), order='F')
+            expected = np.concatenate([mov[2:, idx_xy[0], idx_xy[1]]] * 2)
+            npt.assert_allclose(images, expected, rtol=1e-6)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_transpose_memmap():
+    folder = tempfile.mkdtemp()
+    try:
+        mov = gen_movie()
+        fnames = [cm.save_memmap([m], base_name=os.path.join(folder, 'Yr' + str(i)), order='F')
+                  for i, m in enumerate([mov[:20], mov[20:]])]
+        for order in ['C', 'F']:
+            fname = mmapping.transpose_memmap(fnames, order=order, base_name='joined',
+                                              n_chunks=7, tile_bytes=1000)
+            Yr, dims, T = cm.load_memmap(fname)
+            npt.assert_equal(Yr.flags['C_CONTIGUOUS'], order == 'C')
+            images = np.reshape(Yr.T, [T] + list(dims), order='F')
+            npt.assert_allclose(images, mov, rtol=1e-6)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_parallel_dot_product():
+    folder = tempfile.mkdtemp()
+    try:
+        mov = gen_movie()
+        fname = cm.save_memmap([mov], base_name=os.path.join(folder, 'Yr'), order='C')
+        Yr, dims, T = cm.load_memmap(fname)
+        A = scipy.sparse.random(np.prod(dims), 7, density=0.02, format='csc', random_state=0)
+        # no component in the middle blocks of pixels
+        A = scipy.sparse.vstack([A[:200], scipy.sparse.csc_matrix((200, 7)), A[400:]]).tocsc()
+        f = np.random.rand(2, T)
+        Y = np.array(Yr)
+        for block_size, num_blocks_per_run in [(70, 2), (1000, 20)]:
+            YA = mmapping.parallel_dot_product(Yr, A, block_size=block_size, transpose=True,
+                                               num_blocks_per_run=num_blocks_per_run)
+            npt.assert_allclose(YA, A.T.dot(Y).T, rtol=1e-4)
+            Yf = mmapping.parallel_dot_product(Yr, f.T, block_size=block_size,
+                                               num_blocks_per_run=num_blocks_per_run)
+            npt.assert_allclose(Yf, Y.dot(f.T), rtol=1e-4)
+    finally:
+        shutil.rmtree(folder)
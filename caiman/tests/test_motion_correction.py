@@ -0,0 +1,143 @@
+import numpy.testing as npt
+import numpy as np
+import os
+import shutil
+import tempfile
+import h5py
+import scipy.ndimage as nd
+import caiman as cm
+from caiman import motion_correction as mc
+
+
+def gen_tiles(n=6, dims=(40, 36), seed=0):
+    np.random.seed(seed)
+    templates = nd.gaussian_filter(np.random.rand(n, dims[0] + 10, dims[1] + 10), (0, 2, 2)) * 100
+    imgs = np.array([nd.shift(t, np.random.randn(2) * 2) for t in templates])
+    return imgs[:, 5:-5, 5:-5], templates[:, 5:-5, 5:-5]
+
+
+def test_register_translation_batch():
+    imgs, templates = gen_tiles()
+    for lb, ub in [(None, None), (np.array([-3, -2]), np.array([3, 4]))]:
+        shifts, src_freq, phasediff = mc.register_translation_batch(
+            imgs, templates, upsample_factor=10, shifts_lb=lb, shifts_ub=ub, max_shifts=(6, 6))
+        for img, tmpl, sh, ph in zip(imgs, templates, shifts, phasediff):
+            sh_single, _, ph_single = mc.register_translation(
+                img, tmpl, upsample_factor=10, shifts_lb=lb, shifts_ub=ub, max_shifts=(6, 6))
+            npt.assert_allclose(sh, sh_single)
+            npt.assert_allclose(ph, ph_single, atol=1e-8)
+
+
+def test_apply_shifts_dft_batch():
+    imgs, _ = gen_tiles()
+    shifts = np.random.randn(len(imgs), 2) * 3
+    phases = np.random.randn(len(imgs)) * 1e-3
+    new_imgs = mc.apply_shifts_dft_batch(imgs, shifts, phases, is_freq=False, border_nan=True)
+    for img, sh, ph, new_img in zip(imgs, shifts, phases, new_imgs):
+        npt.assert_allclose(new_img, mc.apply_shifts_dft(img, sh, ph, is_freq=False, border_nan=True))
+
+
+def test_blend_tiles():
+    np.random.seed(0)
+    img = np.random.rand(60, 50)
+    tiles, start_step, _ = mc.extract_tiles(img, overlaps=(8, 8), strides=(16, 16))
+    weights = np.array(list(mc.create_weight_matrix_for_blending(img, (8, 8), (16, 16))))
+    idx = mc.blending_indices(img.shape, start_step, tiles.shape[1:])
+    npt.assert_allclose(mc.blend_tiles(tiles, weights, idx, img.shape), img)
+
+
+def test_registration_plan():
+    imgs, templates = gen_tiles(n=3, dims=(64, 60))
+    template = templates[0]
+    plan = mc.RegistrationPlan(template, (16, 16), (8, 8), add_to_movie=1.)
+    for img in imgs:
+        new_img, shifts, _, _ = mc.tile_and_correct(img, template, (16, 16), (8, 8), (5, 5),
+                                                    add_to_movie=1., max_deviation_rigid=2)
+        new_img_plan, shifts_plan, _, _ = mc.tile_and_correct(img, template, (16, 16), (8, 8), (5, 5),
+                                                              add_to_movie=1., max_deviation_rigid=2,
+                                                              plan=plan)
+        npt.assert_allclose(new_img_plan, new_img)
+        npt.assert_allclose(shifts_plan, shifts)
+    npt.assert_raises(Exception, mc.tile_and_correct, imgs[0][:-1], template, (16, 16), (8, 8), (5, 5),
+                      add_to_movie=1., plan=plan)
+
+
+def test_float32_vs_float64():
+    m = cm.load(os.path.abspath(cm.__path__[0][:-7]) + '/example_movies/demoMovie.tif',
+                subindices=slice(0, 200))
+    template = cm.motion_correction.bin_median(m)
+    add_to_movie = -np.min(m)
+    for max_deviation_rigid in [0, 2]:
+        res = {}
+        for precision in ['float64', 'float32']:
+            plan = mc.RegistrationPlan(template, (24, 24) if max_deviation_rigid else None, (12, 12),
+                                       add_to_movie=add_to_movie, precision=precision)
+            res[precision] = [mc.tile_and_correct(img, template, (24, 24), (12, 12), (6, 6),
+                                                  add_to_movie=add_to_movie, shifts_opencv=True,
+                                                  max_deviation_rigid=max_deviation_rigid,
+                                                  plan=plan, precision=precision) for img in m]
+        for r64, r32 in zip(res['float64'], res['float32']):
+            npt.assert_equal(r32[0].dtype, np.float32)
+            npt.assert_allclose(r32[1], r64[1], atol=1e-3)
+            npt.assert_allclose(r32[0], r64[0], rtol=1e-4, atol=1e-3 * np.nanmax(np.abs(r64[0])))
+
+
+def test_online_motion_corrector():
+    np.random.seed(0)
+    base = nd.gaussian_filter(np.random.rand(128, 128), 3) * 1000
+    shifts = np.round(np.random.randn(60, 2) * 2)
+    frames = [np.roll(base, shift.astype(int), (0, 1)) + np.random.rand(128, 128) * 10 for shift in shifts]
+    omc = mc.OnlineMotionCorrector(max_shifts=(8, 8), init_frames_template=20, update_template_every=20)
+    est_shifts = np.array([omc.fit_next(frame)[1] for frame in frames])
+    npt.assert_allclose(est_shifts, shifts[0] - shifts, atol=0.3)
+    npt.assert_equal(omc.latency_stats()['n_frames'], 60)
+
+    omc = mc.OnlineMotionCorrector(template=base, max_shifts=(8, 8), strides=(32, 32), overlaps=(16, 16))
+    corrected, patch_shifts = omc.fit_next(frames[1])
+    npt.assert_equal(corrected.shape, base.shape)
+    npt.assert_allclose(np.median(patch_shifts, 0), -shifts[1], atol=0.3)
+
+
+def test_tile_and_correct_threads():
+    imgs, templates = gen_tiles(n=2, dims=(64, 60))
+    res = [mc.tile_and_correct(imgs[0], templates[0], (16, 16), (8, 8), (5, 5), max_deviation_rigid=2,
+                               shifts_opencv=shifts_opencv, n_threads=n_threads)
+           for shifts_opencv in [True, False] for n_threads in [1, 3]]
+    for single, threaded in [(res[0], res[1]), (res[2], res[3])]:
+        npt.assert_allclose(threaded[0], single[0])
+        npt.assert_allclose(threaded[1], single[1])
+
+
+def test_piecewise_resume():
+    folder = tempfile.mkdtemp()
+    try:
+        imgs, templates = gen_tiles(n=12, dims=(50, 60))
+        fname = os.path.join(folder, 'mov.hdf5')
+        with h5py.File(fname, 'w') as fl:
+            fl['mov'] = imgs.astype(np.float32)
+        kwargs = dict(template=templates.mean(0), max_shifts=(4, 4), max_deviation_rigid=2,
+                      shifts_opencv=True, save_movie=True)
+        fname_tot, res = mc.motion_correction_piecewise(fname, 4, (16, 16), (8, 8), **kwargs)
+        expected = np.array(cm.load(fname_tot))
+        # the results of the splits are only kept until the run is completed
+        assert not os.path.exists(mc.split_store_name(fname_tot))
+
+        # interrupt the run after two splits, then resume it
+        progress = []
+
+        def callback(n_done, n_splits):
+            progress.append(n_done)
+            if len(progress) == 3:
+                raise KeyboardInterrupt
+
+        npt.assert_raises(KeyboardInterrupt, mc.motion_correction_piecewise, fname, 4, (16, 16), (8, 8),
+                          progress_callback=callback, **kwargs)
+        fname_tot, res_resumed = mc.motion_correction_piecewise(fname, 4, (16, 16), (8, 8), resume=True,
+                                                                progress_callback=callback, **kwargs)
+        npt.assert_equal(progress, [0, 1, 2, 2, 3, 4])
+        assert not os.path.exists(mc.split_store_name(fname_tot))
+        npt.assert_allclose(np.array(cm.load(fname_tot)), expected)
+        for rr, rr_resumed in zip(res, res_resumed):
+            npt.assert_allclose(rr_resumed[2], rr[2])
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import numpy.testing as npt
+import numpy as np
+import caiman as cm
+from caiman import mmapping
+from caiman.base import movies
+
+
+def test_tiff_page_reader():
+    folder = tempfile.mkdtemp()
+    try:
+        np.random.seed(0)
+        mov = (np.random.rand(57, 20, 30) * 1000).astype(np.uint16)
+        for kwargs in [{}, {'imagej': True}, {'bigtiff': True}]:
+            fname = os.path.join(folder, 'mov.tif')
+            mmapping.tifffile.imsave(fname, mov, **kwargs)
+            reader = movies.TiffPageReader(fname)
+            npt.assert_equal(reader.shape, mov.shape)
+            npt.assert_(reader.raw and reader.is_stack)
+            npt.assert_(os.path.exists(movies.tiff_index_name(fname)))
+            for key in [slice(None, None, 7), [3, 5, 50], 4, (slice(2, 40, 3), slice(1, 5), 7)]:
+                npt.assert_array_equal(reader[key], mov[key])
+            npt.assert_array_equal(movies.TiffPageReader(fname).offsets, reader.offsets)
+            npt.assert_array_equal(cm.load(fname, subindices=slice(5, None, 10)), mov[5::10])
+            npt.assert_array_equal(cm.load_movie_chain([fname, fname], subindices=slice(0, 10)),
+                                   np.concatenate([mov[:10]] * 2))
+            os.remove(fname)
+            os.remove(movies.tiff_index_name(fname))
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_tiff_page_reader_tiled():
+    folder = tempfile.mkdtemp()
+    try:
+        np.random.seed(0)
+        mov = (np.random.rand(5, 64, 64) * 1000).astype(np.uint16)
+        fname = os.path.join(folder, 'mov.tif')
+        mmapping.tifffile.imwrite(fname, mov, tile=(32, 32))
+        reader = movies.TiffPageReader(fname)
+        npt.assert_equal(reader.shape, mov.shape)
+        npt.assert_(not reader.raw and reader.is_stack)
+        npt.assert_array_equal(reader[[1, 3]], mov[[1, 3]])
+        npt.assert_array_equal(cm.load(fname, subindices=slice(0, 3)), mov[:3])
+        npt.assert_equal(mmapping.get_file_size(fname), ((64, 64), 5))
+        fname_mmap = cm.save_memmap([fname], base_name=os.path.join(folder, 'Yr'), order='C')
+        Yr, dims, T = cm.load_memmap(fname_mmap)
+        npt.assert_allclose(np.reshape(Yr.T, [T] + list(dims), order='F'), mov, atol=1e-6)
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,48 @@
+import numpy.testing as npt
+import numpy as np
+import scipy.sparse
+from caiman.source_extraction.cnmf import online_cnmf
+
+
+def test_update_suff_stats():
+    np.random.seed(0)
+    N, d, nb, T = 20, 200, 2, 5
+    ind_A = [np.sort(np.random.choice(d, 15, replace=False)) for _ in range(N)]
+    CY = np.random.rand(N + nb + 3, d).astype(np.float32)
+    CC = np.random.rand(N + nb, N + nb).astype(np.float32)
+    ccf = np.random.rand(N + nb, T).astype(np.float32)
+    ccf[nb + np.arange(0, N, 3)] = 0  # inactive components
+    y = np.random.rand(T, d).astype(np.float32)
+    CY_, CC_ = CY.copy(), CC * .9 + .1 * ccf.dot(ccf.T)
+    for m in range(N):
+        CY_[m + nb, ind_A[m]] = .9 * CY_[m + nb, ind_A[m]] + .1 * ccf[m + nb].dot(y[:, ind_A[m]])
+    CY_[:nb] = .9 * CY_[:nb] + .1 * ccf[:nb].dot(y)
+    support = online_cnmf.suff_stats_support(ind_A, nb, d)
+    online_cnmf.update_suff_stats(CY, CC, ccf, y, .9, .1, support, nb, max_elements=50)
+    npt.assert_allclose(CY, CY_, rtol=1e-5)
+    npt.assert_allclose(CC, CC_, rtol=1e-5)
+
+
+def test_update_AtA():
+    Ab = scipy.sparse.random(100, 8, density=.2, format='csc', random_state=0)
+    AtA = online_cnmf.update_AtA(None, Ab[:, :6])
+    Ab.data[Ab.indptr[2]:Ab.indptr[3]] *= 2
+    AtA = online_cnmf.update_AtA(AtA, Ab, [2])
+    npt.assert_allclose(AtA, Ab.T.dot(Ab).toarray())
+
+
+def test_stage_timer():
+    timer = online_cnmf.StageTimer(stages=['a', 'b'], buffer_size=3)
+    for t in range(5):
+        timer.start(t, num_components=t + 10)
+        timer.lap('a')
+        timer.lap('b')
+        timer.lap('a')
+        timer.stop()
+    frames, num_components, times = timer.get_records()
+    npt.assert_equal(frames, [2, 3, 4])
+    npt.assert_equal(num_components, [12, 13, 14])
+    npt.assert_array_less(times[:, :2].sum(1), times[:, 2] + 1e-12)
+    summary = timer.summary(percentiles=[50], budget=1e3)
+    npt.assert_equal(sorted(summary['total'].keys()), ['max', 'mean', 'over_budget', 'p50'])
+    npt.assert_equal(summary['total']['over_budget'], 0)
@@ -0,0 +1,35 @@
+import numpy.testing as npt
+import numpy as np
+from caiman.source_extraction.cnmf import spatial
+
+
+def test_batched_lasso_regression():
+    np.random.seed(0)
+    T, K, d = 300, 5, 60
+    C = np.maximum(np.random.randn(K, T), 0)
+    idxs_C = [np.sort(np.random.choice(K, 1 + px % 3, replace=False)) if px % 4 else
+              np.array([], dtype=int) for px in range(d)]
+    idxs_C[5] = idxs_C[9] = idxs_C[13] = np.array([0, 2])
+    A = np.random.rand(d, K)
+    Y = np.array([A[px, idx].dot(C[idx]) for px, idx in enumerate(idxs_C)])
+    Y += .1 * np.random.randn(d, T)
+    sn = .1 * np.ones(d)
+    cct = np.diag(C[:4].dot(C[:4].T))
+    Cn, scale = spatial.center_and_scale(C)
+    result = spatial.regression_ipyparallel([Y, Cn, sn, idxs_C, list(range(d)), 'lasso_lars',
+                                             cct, (Cn.dot(Cn.T), scale)])
+    npt.assert_equal(sorted(r[0] for r in result), [px for px in range(d) if px % 4])
+    # optimality conditions of the nonnegative lasso on the normalized traces
+    for px, idx, a in result:
+        cct_ = cct[idx[idx < len(cct)]]
+        lam = .5 * sn[px] * np.sqrt(np.max(cct_)) if len(cct_) else 0
+        grad = Cn[idx].dot(Y[px] - (a * scale[idx]).dot(Cn[idx])) - lam
+        assert np.all(a >= 0)
+        npt.assert_allclose(grad[a > 0], 0, atol=1e-6)
+        assert np.all(grad[a == 0] <= 1e-6)
+
+
+def test_group_pixels_by_support():
+    ind2_ = [np.array([0, 1]), [], np.array([2]), np.array([0, 1]), np.array([2]), []]
+    chunks = spatial.group_pixels_by_support(ind2_, 2)
+    npt.assert_equal([list(c) for c in chunks], [[0, 3], [2, 4]])
@@ -0,0 +1,39 @@
+import numpy.testing as npt
+import numpy as np
+import scipy.ndimage
+from caiman.utils import stats
+
+
+def test_running_quantile():
+    np.random.seed(0)
+    X = np.random.randn(6, 300).astype(np.float32)
+    X[0, ::3] = 1.  # ties
+    for quantile, window in [(8, 50), (50, 7), (100, 10), (0, 4), (8, 1000)]:
+        npt.assert_array_equal(stats.running_quantile(X, quantile, window),
+                               scipy.ndimage.percentile_filter(X, quantile, size=(1, window)))
+    npt.assert_array_equal(stats.running_quantile(X[1], 8, 50),
+                           scipy.ndimage.percentile_filter(X[1], 8, size=50))
+    # the decimated approximation follows a slow baseline
+    trace = np.sin(np.linspace(0, 3, 2000)) + .01 * np.random.rand(2000)
+    npt.assert_allclose(stats.running_quantile(trace, 8, 200, decimate=10),
+                        stats.running_quantile(trace, 8, 200), atol=.02)
+
+
+def test_mode_robust_batch():
+    np.random.seed(0)
+    for n in [1, 2, 3, 6, 101]:
+        X = np.random.gamma(2, size=(20, n))
+        X[:5] = np.round(X[:5])  # ties
+        expected = [stats.mode_robust(x) for x in X]
+        npt.assert_array_equal(stats.mode_robust(X, axis=1), expected)
+        npt.assert_array_equal(stats.mode_robust_fast(X.T, axis=0), expected)
+
+
+def test_online_mode():
+    np.random.seed(0)
+    Y = np.random.randn(10, 80)
+    Y[:, ::7] = 0
+    om = stats.OnlineMode(10, 25)
+    for t in range(80):
+        om.update(Y[:, t])
+        npt.assert_array_equal(om.mode(), stats.mode_robust(Y[:, max(0, t - 24):t + 1], axis=1))
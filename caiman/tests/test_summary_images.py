@@ -0,0 +1,45 @@
+import numpy.testing as npt
+import numpy as np
+from caiman import summary_images
+
+
+def gen_movie(T=400, dims=(30, 40), seed=0):
+    np.random.seed(seed)
+    Y = np.random.randn(T, *dims).astype(np.float32) + 10
+    Y[:, 5:10, 5:12] += 3 * np.random.rand(T)[:, None, None] ** 4
+    Y[:, 20:24, 30:33] += 5 * np.random.rand(T)[:, None, None] ** 4
+    return Y
+
+
+def test_summary_images_chunked():
+    Y = gen_movie()
+    for eight_neighbours in [True, False]:
+        Cn = summary_images.local_correlations_fft(Y, eight_neighbours=eight_neighbours, swap_dim=False)
+        Cn_chunked, _, Cn_max, _ = summary_images.summary_images_chunked(
+            Y, swap_dim=False, chunk_size=70, eight_neighbours=eight_neighbours, compute_pnr=False)
+        npt.assert_allclose(Cn_chunked, Cn, atol=1e-5)
+        npt.assert_allclose(Cn_max, np.max([summary_images.local_correlations_fft(
+            Y[t:t + 70], eight_neighbours=eight_neighbours, swap_dim=False)
+            for t in range(0, len(Y), 70)], 0), atol=1e-5)
+
+
+def test_correlation_pnr():
+    Y = gen_movie()
+    cn, pnr = summary_images.correlation_pnr(Y, swap_dim=False)
+    Y -= Y.mean(0)
+    sn = summary_images.get_noise_fft(Y.transpose())[0].transpose()
+    npt.assert_allclose(pnr, np.maximum(Y.max(0) / sn, 0), rtol=1e-4)
+    Y /= sn
+    Y[Y < 3] = 0
+    npt.assert_allclose(cn, summary_images.local_correlations_fft(Y, swap_dim=False), atol=1e-5)
+    # the noise level is estimated on each chunk
+    _, pnr_chunked = summary_images.correlation_pnr(gen_movie(), swap_dim=False, chunk_size=100)
+    npt.assert_allclose(np.median(pnr_chunked / pnr), 1, atol=0.02)
+    # a tail of one frame is merged with the previous chunk
+    Y = gen_movie(T=201)
+    cn, pnr = summary_images.correlation_pnr(Y, swap_dim=False, chunk_size=100)
+    assert np.all(np.isfinite(pnr)) and np.all(np.isfinite(cn))
+    Cn_max = summary_images.summary_images_chunked(Y, swap_dim=False, chunk_size=100)[2]
+    npt.assert_allclose(Cn_max, np.maximum(
+        summary_images.local_correlations_fft(Y[:100], swap_dim=False),
+        summary_images.local_correlations_fft(Y[100:], swap_dim=False)), atol=1e-5)
@@ -0,0 +1,165 @@
+"""Running quantile of long traces with a sliding double heap
+"""
+
+import numpy as np
+cimport numpy as np
+cimport cython
+from cython.parallel cimport prange
+from libc.stdlib cimport malloc, free
+
+
+cdef struct Heaps:
+    # values of the window, in a circular buffer of slots
+    double * val
+    # slots of the lower (max-heap, the rank + 1 smallest values) and upper (min-heap) heaps
+    Py_ssize_t * heap[2]
+    Py_ssize_t size[2]
+    # heap (0: lower, 1: upper) and position in the heap of each slot
+    int * which
+    Py_ssize_t * pos
+
+
+cdef inline bint _before(Heaps * h, int k, Py_ssize_t a, Py_ssize_t b) nogil:
+    # whether slot a should be above slot b in heap k
+    if k == 0:
+        return h.val[a] > h.val[b]
+    return h.val[a] < h.val[b]
+
+
+cdef inline void _place(Heaps * h, int k, Py_ssize_t i, Py_ssize_t slot) nogil:
+    h.heap[k][i] = slot
+    h.which[slot] = k
+    h.pos[slot] = i
+
+
+cdef Py_ssize_t _sift_up(Heaps * h, int k, Py_ssize_t i) nogil:
+    cdef Py_ssize_t slot = h.heap[k][i], parent
+    while i > 0:
+        parent = (i - 1) // 2
+        if not _before(h, k, slot, h.heap[k][parent]):
+            break
+        _place(h, k, i, h.heap[k][parent])
+        i = parent
+    _place(h, k, i, slot)
+    return i
+
+
+cdef void _sift_down(Heaps * h, int k, Py_ssize_t i) nogil:
+    cdef Py_ssize_t slot = h.heap[k][i], child, n = h.size[k]
+    while True:
+        child = 2 * i + 1
+        if child >= n:
+            break
+        if child + 1 < n and _before(h, k, h.heap[k][child + 1], h.heap[k][child]):
+            child += 1
+        if not _before(h, k, h.heap[k][child], slot):
+            break
+        _place(h, k, i, h.heap[k][child])
+        i = child
+    _place(h, k, i, slot)
+
+
+cdef void _balance(Heaps * h) nogil:
+    # swap the tops of the heaps while the lower one has a larger value than the upper one
+    cdef Py_ssize_t a, b
+    while h.size[1] > 0 and h.val[h.heap[0][0]] > h.val[h.heap[1][0]]:
+        a = h.heap[0][0]
+        b = h.heap[1][0]
+        _place(h, 0, 0, b)
+        _place(h, 1, 0, a)
+        _sift_down(h, 0, 0)
+        _sift_down(h, 1, 0)
+
+
+cdef inline Py_ssize_t _reflect(Py_ssize_t i, Py_ssize_t T) nogil:
+    # index of the sample at position i of the trace extended with mode 'reflect'
+    i = i % (2 * T)
+    if i < 0:
+        i += 2 * T
+    if i >= T:
+        i = 2 * T - 1 - i
+    return i
+
+
+cdef void _running_quantile_row(double * x, double * out, Py_ssize_t T, Py_ssize_t w,
+                                Py_ssize_t rank) nogil:
+    cdef Heaps h
+    cdef Py_ssize_t t, i, slot, half = w // 2
+    cdef int k
+
+    h.val = <double *> malloc(w * sizeof(double))
+    h.heap[0] = <Py_ssize_t *> malloc(w * sizeof(Py_ssize_t))
+    h.heap[1] = h.heap[0] + rank + 1
+    h.which = <int *> malloc(w * sizeof(int))
+    h.pos = <Py_ssize_t *> malloc(w * sizeof(Py_ssize_t))
+    h.size[0] = rank + 1
+    h.size[1] = w - rank - 1
+    for slot in range(w):
+        h.val[slot] = x[_reflect(slot - half, T)]
+        if slot <= rank:
+            _place(&h, 0, slot, slot)
+        else:
+            _place(&h, 1, slot - rank - 1, slot)
+    for k in range(2):
+        for i in range(h.size[k] // 2 - 1, -1, -1):
+            _sift_down(&h, k, i)
+    _balance(&h)
+
+    for t in range(T):
+        out[t] = h.val[h.heap[0][0]]
+        if t + 1 < T:
+            # the oldest value of the window is replaced by the next one
+            slot = t % w
+            h.val[slot] = x[_reflect(t + w - half, T)]
+            k = h.which[slot]
+            _sift_down(&h, k, _sift_up(&h, k, h.pos[slot]))
+            _balance(&h)
+
+    free(h.val)
+    free(h.heap[0])
+    free(h.which)
+    free(h.pos)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def running_quantile_rows(double[:, ::1] X, Py_ssize_t window, Py_ssize_t rank, int n_threads=1):
+    """
+    Running order statistic of each row of X
+
+    out[k, t] is the rank-th smallest value of X[k, t - window // 2: t - window // 2 + window],
+    the rows being extended with mode 'reflect' as in scipy.ndimage.percentile_filter.
+    The window is kept in two heaps, the lower one holding its rank + 1 smallest values,
+    so that each step costs O(log(window)). The rows are processed in parallel.
+
+    Parameters:
+    -----------
+    X: ndarray of float64, C contiguous
+        traces (K x T)
+
+    window: int
+        number of samples of the window
+
+    rank: int
+        order statistic, between 0 and window - 1
+
+    n_threads: int
+        number of threads
+
+    Returns:
+    --------
+    out: ndarray of float64
+        K x T
+    """
+    cdef Py_ssize_t K = X.shape[0], T = X.shape[1], k
+    cdef double[:, ::1] out = np.empty((K, T))
+
+    if window < 1 or rank < 0 or rank >= window:
+        raise ValueError('rank must be between 0 and window - 1')
+    if T == 0:
+        return np.asarray(out)
+
+    for k in prange(K, nogil=True, schedule='dynamic', num_threads=n_threads):
+        _running_quantile_row(&X[k, 0], &out[k, 0], T, window, rank)
+
+    return np.asarray(out)
@@ -14,6 +14,12 @@ except:
     pass
 
 import numpy as np    
+import multiprocessing
+import scipy.ndimage
+try:
+    from .rank_filter import running_quantile_rows
+except ImportError:
+    running_quantile_rows = None
 
 #%%
 def mode_robust_fast(inputData,axis=None):
@@ -24,9 +30,7 @@ def mode_robust_fast(inputData,axis=None):
     """
 
     if axis is not None:
-
-        fnc = lambda x: mode_robust_fast(x)
-        dataMode = np.apply_along_axis(fnc, axis, inputData)
+        dataMode = mode_robust_batch(inputData, axis=axis)
     else:
         # Create the function that we can use for the half-sample mode        
         data = inputData.ravel()        
@@ -44,7 +48,9 @@ def mode_robust(inputData, axis=None, dtype=None):
     .. versionadded: 1.0.3
     """
     import numpy
-    if axis is not None:
+    if axis is not None and type(inputData).__name__ != "MaskedArray":
+        dataMode = mode_robust_batch(inputData, axis=axis, dtype=dtype)
+    elif axis is not None:
         fnc = lambda x: mode_robust(x, dtype=dtype)
         dataMode = numpy.apply_along_axis(fnc, axis, inputData)
     else:
@@ -117,4 +123,190 @@ def _hsm(data):
                 wMin = w
                 j = i
 
-        return _hsm(data[j:j + N])    
+        return _hsm(data[j:j + N])
+
+
+#%%
+def _hsm_sorted(data):
+    """ half-sample mode of each row of data, whose rows are sorted (see _hsm)
+
+    All the rows have the same number of samples, so that the intervals searched at each
+    level of the recursion have the same length for all the rows and are processed at once
+    """
+    K, n = data.shape
+    if n == 0:
+        raise ValueError('the half-sample mode of an empty set is not defined')
+    rows = np.arange(K)[:, None]
+    start = np.zeros(K, dtype=int)
+    while n > 3:
+        N = n // 2 + n % 2
+        idx = start[:, None] + np.arange(N)
+        # the shortest interval containing N samples, the first one in case of ties
+        start += np.argmin(data[rows, idx + N - 1] - data[rows, idx], axis=1)
+        n = N
+
+    d = data[rows, start[:, None] + np.arange(n)]
+    if n == 1:
+        return d[:, 0]
+    elif n == 2:
+        return d.mean(1)
+    return np.where(d[:, 1] - d[:, 0] < d[:, 2] - d[:, 1], d[:, :2].mean(1), d[:, 1])
+
+
+def mode_robust_batch(inputData, axis=-1, dtype=None):
+    """
+    Robust estimator of the mode along one axis using the half-sample mode.
+
+    Same result as mode_robust(inputData, axis), but each row is sorted once and the search
+    of the half-sample mode is vectorized over all the rows
+
+    Parameters:
+    -----------
+    inputData: ndarray
+        data
+
+    axis: int
+        axis along which the mode is computed
+
+    dtype: numpy dtype
+        type used for the computations
+
+    Returns:
+    --------
+    dataMode: ndarray
+        mode, with the dimension axis removed
+    """
+    data = np.moveaxis(np.asarray(inputData), axis, -1)
+    if dtype is not None:
+        data = data.astype(dtype)
+    shape = data.shape[:-1]
+    data = np.sort(data.reshape(-1, data.shape[-1]), axis=1)
+    return _hsm_sorted(data).reshape(shape)
+
+
+class OnlineMode(object):
+    """
+    Half-sample mode of several streams over their last samples, updated online
+
+    The last window samples of each stream are kept sorted. Each new sample is inserted in
+    place of the oldest one, so that the mode is obtained without sorting again.
+
+    Parameters:
+    -----------
+    n_streams: int
+        number of streams
+
+    window: int
+        number of samples over which the mode is computed
+
+    Attributes:
+    -----------
+    n: int
+        number of samples currently in the window
+    """
+
+    def __init__(self, n_streams, window):
+        self.window = window
+        self.n = 0
+        self.t = 0
+        self.samples = np.zeros((n_streams, window))
+        self.sorted = np.zeros((n_streams, window))
+
+    def update(self, x):
+        """ add one sample (array of length n_streams) to each stream """
+        x = np.asarray(x, dtype=np.float64)
+        rows = np.arange(len(x))
+        slot = self.t % self.window
+        n = self.n
+        if n == self.window:
+            # remove the oldest sample
+            old = self.samples[:, slot]
+            pos = (self.sorted < old[:, None]).sum(1)
+            keep = np.ones(self.sorted.shape, dtype=bool)
+            keep[rows, pos] = False
+            self.sorted[:, :n - 1] = self.sorted[keep].reshape(-1, n - 1)
+            n -= 1
+        pos = (self.sorted[:, :n] < x[:, None]).sum(1)
+        cols = np.arange(n + 1)
+        src = cols - (cols > pos[:, None])
+        new = self.sorted[rows[:, None], np.minimum(src, max(n - 1, 0))]
+        new[rows, pos] = x
+        self.sorted[:, :n + 1] = new
+        self.samples[:, slot] = x
+        self.n = n + 1
+        self.t += 1
+
+    def mode(self):
+        """ half-sample mode of the samples of each stream in the window """
+        return _hsm_sorted(self.sorted[:, :self.n])
+
+
+#%%
+def running_quantile(X, quantile, window, decimate=1, n_threads=None):
+    """
+    Running quantile (percentile filter) of each row of X over windows of window samples
+
+    Equivalent to scipy.ndimage.percentile_filter(X, quantile, size=(1, window)) (the
+    traces are extended with mode 'reflect' at the borders) but each step costs
+    O(log(window)) instead of O(window) and the rows are processed in parallel. Falls back
+    to scipy if the extension caiman.utils.rank_filter has not been compiled.
+
+    Parameters:
+    -----------
+    X: ndarray
+        traces (K x T), or a single trace
+
+    quantile: float
+        percentile between 0 and 100
+
+    window: int
+        number of samples of the window
+
+    decimate: int
+        if larger than 1, the quantile is computed on one sample every decimate samples with
+        a window of window / decimate samples and linearly interpolated, a faster approximation
+        for long windows
+
+    n_threads: int
+        number of threads, by default the number of rows of X, up to the number of cores.
+        Pass 1 when running in one of many worker processes
+
+    Returns:
+    --------
+    out: ndarray
+        running quantile, same shape as X
+    """
+    X = np.asarray(X)
+    if X.ndim == 1:
+        return running_quantile(X[None, :], quantile, window, decimate=decimate,
+                                n_threads=n_threads)[0]
+
+    dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+    T = X.shape[-1]
+    decimate = max(1, min(int(decimate), T))
+    if decimate > 1:
+        offset = (decimate - 1) // 2
+        Xd = X[:, offset::decimate]
+        Qd = running_quantile(Xd, quantile, max(1, int(round(float(window) / decimate))),
+                              n_threads=n_threads)
+        if Qd.shape[1] == 1:
+            return np.repeat(Qd, T, 1).astype(dtype)
+        # linear interpolation between the decimated samples, constant beyond the last ones
+        pos = np.clip((np.arange(T) - offset) / float(decimate), 0, Qd.shape[1] - 1)
+        j = np.minimum(pos.astype(int), Qd.shape[1] - 2)
+        frac = pos - j
+        return (Qd[:, j] * (1 - frac) + Qd[:, j + 1] * frac).astype(dtype)
+
+    window = max(1, int(window))
+    if quantile < 0:
+        quantile += 100
+    rank = window - 1 if quantile == 100 else int(float(window) * quantile / 100.)
+    if running_quantile_rows is None:
+        return scipy.ndimage.percentile_filter(X, quantile, size=(1, window)).astype(dtype)
+
+    if n_threads is None:
+        n_threads = min(X.shape[0], multiprocessing.cpu_count())
+    out = running_quantile_rows(np.ascontiguousarray(X, dtype=np.float64), window, rank,
+                                n_threads=int(n_threads))
+    return out.astype(dtype, copy=False)
+
@@ -106,7 +106,8 @@ cnm_init = bare_initialization(Y[:initbatch].transpose(1, 2, 0), init_batch=init
                                  thresh_fitness_raw = thresh_fitness_raw,
                                  batch_update_suff_stat=True, max_comp_update_shape = max_comp_update_shape, 
                                  deconv_flag = False, use_dense = True,
-                                 simultaneously=False, n_refit=0)
+                                 simultaneously=False, n_refit=0,
+                                 stage_timing=10000)    # keep per-stage timings of the last 10000 frames
 
 #%% Plot initialization results
 
@@ -251,6 +252,7 @@ for iter in range(epochs):
                     break                                
     
         print('Cumulative processing speed is ' + str((t - initbatch) / np.sum(tottime))[:5] + ' frames per second.')
+        cnm2.stage_timer.print_summary(budget=33)                    # which stage exceeds the 33 ms frame budget
     cnm2.Ab_epoch.append(cnm2.Ab.copy())                        # save the shapes at the end of each epoch
         
 if save_movie:
@@ -1,5 +1,6 @@
 from setuptools import setup, find_packages
 from os import path
+import sys
 import numpy as np
 from Cython.Build import cythonize
 from setuptools.extension import Extension
@@ -15,10 +16,24 @@ with open('README.md', 'r') as rmf:
 
 # compile with:     python setup.py build_ext -i
 # clean up with:    python setup.py clean --all
+# OpenMP is used for the batched deconvolution and the running quantiles, apple's clang does not ship it
+if sys.platform == 'win32':
+    openmp_flags = ['/openmp']
+elif sys.platform == 'darwin':
+    openmp_flags = []
+else:
+    openmp_flags = ['-fopenmp']
 ext_modules = [Extension("caiman.source_extraction.cnmf.oasis",
                          sources=["caiman/source_extraction/cnmf/oasis.pyx"],
                          include_dirs=[np.get_include()],
-                         language="c++")]
+                         extra_compile_args=openmp_flags,
+                         extra_link_args=openmp_flags if sys.platform != 'win32' else [],
+                         language="c++"),
+               Extension("caiman.utils.rank_filter",
+                         sources=["caiman/utils/rank_filter.pyx"],
+                         include_dirs=[np.get_include()],
+                         extra_compile_args=openmp_flags,
+                         extra_link_args=openmp_flags if sys.platform != 'win32' else [])]
 
 setup(
     name='caiman',